@@ -24,6 +24,12 @@ except ImportError:
 import customtkinter as ctk
 
 class FlaskServerGUI:
+    # 高级设置页面中按标题保存到 gui_settings.json 的设置项（变量名为 "<标题>_var"）
+    ADVANCED_SETTING_TITLES = ("显存预算", "内存预算", "张量缓存上限", "GPU并发任务数", "计算精度",
+                               "CPU推理模式", "CPU线程数", "CPU并行算子数",
+                               "注意力实现", "注意力切片", "VAE分块", "VAE分块重叠", "顺序CPU卸载",
+                               "草稿模式")
+    
     def __init__(self, root):
         self.root = root
         self.root.title("AI图形化工具")
@@ -272,10 +278,32 @@ class FlaskServerGUI:
             except Exception as e:
                 print(f"加载使用 CPU 运行 VAE 设置失败: {e}")
     
+    def load_budget_settings(self):
+        """加载保存的显存/内存预算、张量缓存上限、GPU并发任务数、计算精度、CPU推理和显存优化设置"""
+        settings_file = os.path.join(os.getcwd(), "gui_settings.json")
+        if os.path.exists(settings_file):
+            try:
+                with open(settings_file, 'r', encoding='utf-8') as f:
+                    settings = json.load(f)
+                    for title in self.ADVANCED_SETTING_TITLES:
+                        saved_value = settings.get(title)
+                        var = getattr(self, f"{title}_var", None)
+                        if saved_value and var is not None:
+                            var.set(saved_value)
+            except Exception as e:
+                print(f"加载预算设置失败: {e}")
+    
     def save_path_settings(self):
         """保存路径设置"""
         settings_file = os.path.join(os.getcwd(), "gui_settings.json")
+        # 先读取已有设置，保留本页面之外的设置项
         settings = {}
+        if os.path.exists(settings_file):
+            try:
+                with open(settings_file, 'r', encoding='utf-8') as f:
+                    settings = json.load(f)
+            except Exception as e:
+                print(f"读取已有设置失败: {e}")
         
         # 获取模型文件夹路径
         if hasattr(self, "模型文件夹路径_input"):
@@ -300,6 +328,12 @@ class FlaskServerGUI:
             vae_value = self.使用_CPU_运行_VAE_var.get()
             settings["使用 CPU 运行 VAE"] = vae_value
         
+        # 获取显存/内存预算、张量缓存上限、GPU并发任务数、计算精度、CPU推理和显存优化设置
+        for title in self.ADVANCED_SETTING_TITLES:
+            var = getattr(self, f"{title}_var", None)
+            if var is not None:
+                settings[title] = var.get()
+        
         try:
             with open(settings_file, 'w', encoding='utf-8') as f:
                 json.dump(settings, f, indent=2, ensure_ascii=False)
@@ -357,12 +391,68 @@ class FlaskServerGUI:
                                 ["检测中..."],  # 临时占位
                                 default="检测中...")
         
+        # 计算精度（选项与 core/device_policy.py 中的 PRECISION_OPTIONS 一致）
+        self.计算精度_var = self.create_setting_item(settings_frame, "计算精度", 
+                                "UNet/文本编码器的计算精度，自动：显卡fp16、CPU fp32", 
+                                ["自动", "fp16", "bf16", "fp32"], default="自动")
+        
+        # CPU推理（选项与 core/device_policy.py 中的 CPU_MODE_OPTIONS 等一致，生成引擎为CPU时生效）
+        self.CPU推理模式_var = self.create_setting_item(settings_frame, "CPU推理模式", 
+                                "优化：channels_last + bf16（CPU支持时）；优化+编译：再用 torch.compile 编译UNet，首次运行较慢", 
+                                ["标准", "优化", "优化+编译"], default="标准")
+        self.CPU线程数_var = self.create_setting_item(settings_frame, "CPU线程数", 
+                                "单个算子使用的线程数，自动：物理核心数", 
+                                ["自动", "1", "2", "4", "6", "8", "12", "16", "24", "32"], default="自动")
+        self.CPU并行算子数_var = self.create_setting_item(settings_frame, "CPU并行算子数", 
+                                "可同时执行的算子数，修改后需重启后端", 
+                                ["自动", "1", "2", "4"], default="自动")
+        
         # 使用 CPU 运行 VAE
         self.create_switch_setting(settings_frame, "使用 CPU 运行 VAE", 
                                  "显著降低峰值显存消耗，但会降低整体速度")
         
         # 加载保存的使用 CPU 运行 VAE 设置
         self.load_vae_setting()
+        
+        # 注意力与VAE显存选项（选项与 core/memory_options.py 一致，所有SD模块读取）
+        self.注意力实现_var = self.create_setting_item(settings_frame, "注意力实现", 
+                                "自动：PyTorch 2 的 SDPA；xformers 需要单独安装", 
+                                ["自动", "SDPA", "xformers", "标准"], default="自动")
+        self.注意力切片_var = self.create_setting_item(settings_frame, "注意力切片", 
+                                "分片计算UNet注意力，降低峰值显存，速度略降；开启时代替注意力实现", 
+                                ["关闭", "自动", "最大"], default="关闭")
+        self.VAE分块_var = self.create_setting_item(settings_frame, "VAE分块", 
+                                "大图按分块大小（像素）分块编码/解码，8 GB 显卡生成 768px 以上时建议开启", 
+                                ["关闭", "256", "512", "768"], default="关闭")
+        self.VAE分块重叠_var = self.create_setting_item(settings_frame, "VAE分块重叠", 
+                                "相邻分块重叠的比例，越大接缝越不明显、耗时越长", 
+                                ["0.125", "0.25", "0.5"], default="0.25")
+        self.create_switch_setting(settings_frame, "顺序CPU卸载", 
+                                 "模型权重常驻内存、逐个子模块搬到显卡执行，显存占用最低但速度最慢")
+        self.create_switch_setting(settings_frame, "草稿模式", 
+                                 "VAE编码/解码改用 TAESD 近似模型，快一个数量级，画质为预览级（节点上可单独选择）")
+        
+        # 模型缓存预算（选项直接取自 core/model_store.py 中的 BUDGET_OPTIONS）
+        budget_options = list(BUDGET_OPTIONS)
+        self.显存预算_var = self.create_setting_item(settings_frame, "显存预算", 
+                                "模型缓存可占用的显存，超出时把最久未用的模型卸载到内存", 
+                                budget_options, default="自动")
+        self.内存预算_var = self.create_setting_item(settings_frame, "内存预算", 
+                                "模型缓存可占用的内存，超出时释放最久未用的模型", 
+                                budget_options, default="自动")
+        
+        # 张量缓存上限（选项与 core/tensor_cache.py 中的 CACHE_LIMIT_OPTIONS 一致）
+        self.张量缓存上限_var = self.create_setting_item(settings_frame, "张量缓存上限", 
+                                "模块间传递的张量/图像在内存中的上限，超出时转存到磁盘", 
+                                ["1 GB", "2 GB", "4 GB", "8 GB", "不限制"], default="2 GB")
+        
+        # 任务队列中每个设备同时执行的任务数（选项与 core/job_queue.py 中的 CONCURRENCY_OPTIONS 一致）
+        self.GPU并发任务数_var = self.create_setting_item(settings_frame, "GPU并发任务数", 
+                                "排队任务中同一设备同时执行的任务数，显存较小时保持为1", 
+                                ["1", "2", "3", "4"], default="1")
+        
+        # 加载保存的预算设置
+        self.load_budget_settings()
     
     def create_setting_item(self, parent, title, description, options, default=None):
         """创建设置项（带下拉菜单）"""
@@ -1076,22 +1166,33 @@ os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
 os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "0"
 
 # Flask应用代码
-from flask import Flask, render_template, jsonify, request, send_from_directory
+from flask import Flask, render_template, jsonify, request, send_from_directory, Response
 import importlib.util
+import inspect
 import json
 import zipfile
 import io
 import uuid
+import gc
 import torch
+from core.module_registry import ModuleRegistry
+from core.module_index import ModuleIndex
+from core.model_store import CheckpointHandle, checkpoint_store, BUDGET_OPTIONS
+from core.tensor_cache import TensorCache
+from core.workflow_executor import WorkflowExecutor, WorkflowError, ResourceGate, resolve_resource
+from core.cancellation import RunRegistry, ExecutionCancelled, wait_for_future
+from core.job_queue import JobQueue, load_gpu_concurrency, load_user_priority
+from core.sampling import list_samplers, SCHEDULES
+from core.progress import StepProgress
+from core.settings_service import settings_service
+from core.device_policy import device_service
 
 # 创建线程池执行器，用于异步执行模块
 # 最大工作线程数设置为2，避免过多线程占用资源
 executor = concurrent.futures.ThreadPoolExecutor(max_workers=2)
 
-# 全局停止标志，用于停止正在执行的模块
-stop_execution_flag = False
-# 存储正在执行的future对象，用于取消
-ongoing_futures = set()
+# 运行上下文注册表：每次运行有自己的运行ID和取消令牌，停止执行只影响该运行
+run_registry = RunRegistry()
 
 app = Flask(__name__)
 
@@ -1102,12 +1203,15 @@ CUSTOM_MODULES_DIR = 'custom_modules'
 # 存储加载的模块
 loaded_modules = {}
 
-# 全局张量缓存
-tensor_cache = {}
+# 全局张量缓存：按下游读取次数引用计数，超出上限时转存磁盘
+tensor_cache = TensorCache()
 
-# 全局模型缓存
+# 全局模型缓存：存放Checkpoint组件句柄，权重本身在组件仓库中
 model_cache = {}
 
+# 常驻模块注册表：模块只导入一次，文件变化时才重新导入
+module_registry = ModuleRegistry()
+
 # 解析模块文件的注释参数
 def parse_module_params(file_path):
     params = {}
@@ -1144,29 +1248,16 @@ def parse_module_params(file_path):
         print(f"解析模块文件失败: {e}")
     return params
 
+# 模块头部索引：文件未变化时直接使用缓存的参数，模块清单带版本号（ETag）
+module_index = ModuleIndex(parse_module_params, [(DEFAULT_MODULES_DIR, 'default'), (CUSTOM_MODULES_DIR, 'custom')])
+
 # 加载模块
 def load_modules():
+    """检查模块文件夹并更新模块清单（只重新解析有变化的文件）"""
+    module_index.scan()
+    manifest, _ = module_index.manifest()
     loaded_modules.clear()
-    
-    # 加载默认模块
-    if os.path.exists(DEFAULT_MODULES_DIR):
-        for filename in os.listdir(DEFAULT_MODULES_DIR):
-            if filename.endswith('.py'):
-                file_path = os.path.join(DEFAULT_MODULES_DIR, filename)
-                module_name = os.path.splitext(filename)[0]
-                params = parse_module_params(file_path)
-                params['source'] = 'default'  # 添加来源信息
-                loaded_modules[module_name] = params
-    
-    # 加载自定义模块
-    if os.path.exists(CUSTOM_MODULES_DIR):
-        for filename in os.listdir(CUSTOM_MODULES_DIR):
-            if filename.endswith('.py'):
-                file_path = os.path.join(CUSTOM_MODULES_DIR, filename)
-                module_name = os.path.splitext(filename)[0]
-                params = parse_module_params(file_path)
-                params['source'] = 'custom'  # 添加来源信息
-                loaded_modules[module_name] = params
+    loaded_modules.update(manifest)
 
 # 初始化时加载模块
 load_modules()
@@ -1177,30 +1268,105 @@ def index():
 
 @app.route('/api/modules')
 def get_modules():
-    # 重新加载模块，确保包含最新的自定义模块
-    load_modules()
-    return jsonify(loaded_modules)
+    # 模块清单由索引提供（监视线程会及时发现新增/修改的模块），清单未变化时返回304
+    manifest, etag = module_index.manifest()
+    response = jsonify(manifest)
+    response.set_etag(etag)
+    # 要求浏览器每次都带上 If-None-Match 重新验证
+    response.headers['Cache-Control'] = 'no-cache'
+    return response.make_conditional(request)
 
 @app.route('/api/refresh_modules')
 def refresh_modules():
     load_modules()
     return jsonify(loaded_modules)
 
-def _execute_module_async(module_name, input_values, settings):
-    """异步执行模块的内部函数"""
+@app.route('/api/module_index_stats', methods=['GET'])
+def module_index_stats():
+    """
+    获取模块头部索引的解析/命中/清单重建次数和当前版本号
+    """
+    return jsonify({'success': True, **module_index.stats()}), 200
+
+@app.route('/api/samplers', methods=['GET'])
+def get_samplers():
+    """
+    获取采样器列表（含推荐步数、CFG范围）和可用的sigma调度
+    """
+    return jsonify({'success': True, 'samplers': list_samplers(), 'schedules': list(SCHEDULES)}), 200
+
+def _find_module_path(module_name):
+    """确定模块文件路径，默认模块优先，不存在时返回None"""
+    if os.path.exists(os.path.join(DEFAULT_MODULES_DIR, f'{module_name}.py')):
+        return os.path.join(DEFAULT_MODULES_DIR, f'{module_name}.py')
+    if os.path.exists(os.path.join(CUSTOM_MODULES_DIR, f'{module_name}.py')):
+        return os.path.join(CUSTOM_MODULES_DIR, f'{module_name}.py')
+    return None
+
+def _resolve_input_ref(val):
+    """
+    把前端传来的引用字符串解析为缓存中的对象
+    每读取一次计为一次下游消费，读取次数用完后缓存条目自动释放
+    :raises ValueError: 引用的条目已不存在（下游读取次数已用完或运行已结束），不把引用字符串原样传给模块
+    """
+    if not isinstance(val, str):
+        return val
+    # 张量、图像、图像列表引用，从张量缓存中取出
+    for prefix in ('TENSOR_REF:', 'IMAGE_REF:', 'IMAGE_LIST_REF:'):
+        if val.startswith(prefix):
+            value = tensor_cache.get(val[len(prefix):], consume=True)
+            if value is None:
+                raise ValueError(f'输入 {val} 已失效（上游结果已被读取或所属运行已结束），请重新运行上游模块')
+            return value
+    # 如果是模型组件引用，从模型缓存中取出句柄
+    if val.startswith('MODEL_REF:'):
+        model_id = val[len('MODEL_REF:'):]
+        if model_id not in model_cache:
+            raise ValueError(f'输入 {val} 已失效（所属运行已结束），请重新运行上游的加载模块')
+        return model_cache[model_id]
+    return val
+
+def _call_module_function(module_name, func, prepared_inputs, settings, cancel_token=None, progress_callback=None):
+    """
+    调用模块函数
+    - 调用模块和加载图像模块额外传递settings参数
+    - 函数声明了 cancel_token / progress_callback 参数（且没有被输入变量占用）时，传入本次运行的取消令牌和进度回调
+    - 函数声明了 settings_service / device_service 参数时，传入共享的设置服务和设备服务（设置文件未变化时不重新读取）
+    """
     try:
-        # 确定模块文件路径
-        module_path = None
-        if os.path.exists(os.path.join(DEFAULT_MODULES_DIR, f'{module_name}.py')):
-            module_path = os.path.join(DEFAULT_MODULES_DIR, f'{module_name}.py')
-        elif os.path.exists(os.path.join(CUSTOM_MODULES_DIR, f'{module_name}.py')):
-            module_path = os.path.join(CUSTOM_MODULES_DIR, f'{module_name}.py')
+        parameter_names = list(inspect.signature(func).parameters)
+    except (TypeError, ValueError):
+        parameter_names = []
+    pass_settings = module_name in ('调用模块', '加载图像模块') and 'settings' in parameter_names
+    args = list(prepared_inputs) + ([settings] if pass_settings else [])
+    kwargs = {}
+    for name, value in (('cancel_token', cancel_token), ('progress_callback', progress_callback),
+                        ('settings_service', settings_service), ('device_service', device_service)):
+        if name in parameter_names and parameter_names.index(name) >= len(args):
+            kwargs[name] = value
+    return func(*args, **kwargs)
+
+def run_module(module_name, input_values, settings, resolve_input=None, cancel_token=None, progress_callback=None):
+    """
+    在进程内执行一个模块，输入输出都是Python对象
+    :param input_values: 输入端口的值
+    :param settings: 设置界面的值，用于补齐没有输入的变量
+    :param resolve_input: 可选，对每个输入端口的值做转换（例如解析引用字符串）
+    :param cancel_token: 可选，本次运行的取消令牌，传给声明了 cancel_token 参数的模块
+    :param progress_callback: 可选，按步报告进度的回调，传给声明了 progress_callback 参数的模块
+    :return: {'result': 原始返回值列表, 'output_quantity', 'time_late', 'variable_quantity'} 或 {'error': ...}
+    """
+    try:
+        # 排队期间已被取消的模块不再执行
+        if cancel_token is not None and cancel_token():
+            return {'error': '执行已被用户取消'}
         
+        module_path = _find_module_path(module_name)
         if not module_path:
             return {'error': f'模块 {module_name} 不存在'}
         
-        # 解析模块参数
-        module_params = parse_module_params(module_path)
+        # 从头部索引获取模块参数（文件未变化时不重新解析）
+        module_params = module_index.params(module_path)
         input_quantity = module_params.get('input_quantity', 0)
         variable_quantity = module_params.get('variable_quantity', 0)
         output_quantity = module_params.get('output_quantity', 0)
@@ -1220,21 +1386,8 @@ def _execute_module_async(module_name, input_values, settings):
         for i in range(input_quantity):
             if i < len(input_values):
                 val = input_values[i]
-                # 如果是张量引用，从缓存中取出
-                if isinstance(val, str) and val.startswith('TENSOR_REF:'):
-                    tensor_id = val[len('TENSOR_REF:'):]
-                    if tensor_id in tensor_cache:
-                        val = tensor_cache[tensor_id]
-                # 如果是图像引用，从缓存中取出
-                elif isinstance(val, str) and val.startswith('IMAGE_REF:'):
-                    image_id = val[len('IMAGE_REF:'):]
-                    if image_id in tensor_cache:
-                        val = tensor_cache[image_id]
-                # 如果是图像列表引用，从缓存中取出
-                elif isinstance(val, str) and val.startswith('IMAGE_LIST_REF:'):
-                    image_list_id = val[len('IMAGE_LIST_REF:'):]
-                    if image_list_id in tensor_cache:
-                        val = tensor_cache[image_list_id]
+                if resolve_input is not None:
+                    val = resolve_input(val)
                 prepared_inputs.append(val)
             else:
                 # 从设置中获取默认值
@@ -1257,50 +1410,37 @@ def _execute_module_async(module_name, input_values, settings):
         print(f'准备好的输入变量: {prepared_inputs}')
         print(f'接收到的settings: {settings}')
         
-        # 加载模块
-        spec = importlib.util.spec_from_file_location(module_name, module_path)
-        module = importlib.util.module_from_spec(spec)
-        spec.loader.exec_module(module)
+        # 从常驻注册表获取模块（文件未变化时复用已导入的模块对象）
+        module = module_registry.get(module_name, module_path)
+        
+        # 开始组件仓库会话：本次执行取用的模型组件被钉住，不会被预算淘汰
+        checkpoint_store.begin_session()
         
         # 自动发现模块中的执行函数
-        # 查找模块中定义的所有函数
+        # 只查找模块文件自己定义的函数：从 core 导入的函数和类（ExecutionCancelled、prepare_model 等）不是模块的执行入口
         module_functions = []
         for name in dir(module):
-            # 排除内置函数和私有函数
-            if not name.startswith('_') and callable(getattr(module, name)):
+            # 排除私有函数
+            obj = getattr(module, name)
+            if (not name.startswith('_') and inspect.isfunction(obj)
+                    and getattr(obj, '__module__', None) == module.__name__):
                 module_functions.append(name)
         
         # 尝试调用模块中的函数
         result = None
         executed_function = None
         
-        # 创建取消令牌函数，检查全局停止标志
-        def cancel_token():
-            global stop_execution_flag
-            return stop_execution_flag
-        
         # 优先调用主执行函数
         main_functions = ['execute', 'run', 'process']
         for func_name in main_functions:
             if func_name in module_functions:
                 try:
-                    # 对于调用模块和加载图像模块，额外传递settings参数
-                    if module_name == '调用模块' or module_name == '加载图像模块':
-                        # 检查函数是否接受settings参数
-                        import inspect
-                        func = getattr(module, func_name)
-                        sig = inspect.signature(func)
-                        
-                        if module_name == '调用模块' and 'cancel_token' in sig.parameters:
-                            result = getattr(module, func_name)(*prepared_inputs, settings, cancel_token=cancel_token)
-                        elif 'settings' in sig.parameters:
-                            result = getattr(module, func_name)(*prepared_inputs, settings)
-                        else:
-                            result = getattr(module, func_name)(*prepared_inputs)
-                    else:
-                        result = getattr(module, func_name)(*prepared_inputs)
+                    result = _call_module_function(module_name, getattr(module, func_name),
+                                                   prepared_inputs, settings, cancel_token, progress_callback)
                     executed_function = func_name
                     break
+                except ExecutionCancelled:
+                    raise
                 except Exception as e:
                     print(f'调用主函数 {func_name} 失败: {e}')
                     continue
@@ -1309,23 +1449,12 @@ def _execute_module_async(module_name, input_values, settings):
         if result is None and module_functions:
             for func_name in module_functions:
                 try:
-                    # 对于调用模块和加载图像模块，额外传递settings参数
-                    if module_name == '调用模块' or module_name == '加载图像模块':
-                        # 检查函数是否接受settings参数
-                        import inspect
-                        func = getattr(module, func_name)
-                        sig = inspect.signature(func)
-                        
-                        if module_name == '调用模块' and 'cancel_token' in sig.parameters:
-                            result = getattr(module, func_name)(*prepared_inputs, settings, cancel_token=cancel_token)
-                        elif 'settings' in sig.parameters:
-                            result = getattr(module, func_name)(*prepared_inputs, settings)
-                        else:
-                            result = getattr(module, func_name)(*prepared_inputs)
-                    else:
-                        result = getattr(module, func_name)(*prepared_inputs)
+                    result = _call_module_function(module_name, getattr(module, func_name),
+                                                   prepared_inputs, settings, cancel_token, progress_callback)
                     executed_function = func_name
                     break
+                except ExecutionCancelled:
+                    raise
                 except Exception as e:
                     print(f'调用函数 {func_name} 失败: {e}')
                     continue
@@ -1338,31 +1467,103 @@ def _execute_module_async(module_name, input_values, settings):
         if not isinstance(result, (list, tuple)):
             result = [result]
         
+        print(f'执行模块 {module_name} 成功，调用函数: {executed_function}')
+        
+        return {
+            'result': list(result),
+            'output_quantity': output_quantity,
+            'time_late': time_late,
+            'variable_quantity': variable_quantity
+        }
+    
+    except ExecutionCancelled:
+        print(f'模块 {module_name} 在执行中途被取消')
+    except Exception as e:
+        print(f'执行模块时出错: {e}')
+        return {'error': str(e)}
+    finally:
+        checkpoint_store.end_session()
+    
+    # 中途取消：异常处理结束后，模块的中间张量（部分完成的Latent等）已没有引用，立即归还显存
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+    return {'error': '执行已被用户取消'}
+
+def _cleanup_run(run):
+    """释放一次运行在张量缓存和模型缓存中留下的条目"""
+    released = tensor_cache.clear(run.run_id)
+    for model_id in run.model_refs:
+        model_cache.pop(model_id, None)
+    print(f'运行 {run.run_id} 已结束，释放张量缓存条目 {released} 个，模型句柄 {len(run.model_refs)} 个')
+
+def _execute_module_async(module_name, input_values, settings, output_consumers=None, run=None, module_id=None):
+    """
+    异步执行模块的内部函数（前端逐个模块执行时使用）
+    输入中的引用字符串解析为缓存对象，输出中的张量/图像/组件句柄存入缓存并返回引用
+    :param output_consumers: 每个输出端口的下游读取次数，用于张量缓存的引用计数
+    :param run: 本次运行的上下文（运行ID、取消令牌、进度通道），输出缓存条目归属于该运行
+    :param module_id: 前端模块id，随进度事件返回
+    """
+    cancel_token = run.token if run is not None else None
+    run_id = run.run_id if run is not None else None
+    progress_callback = StepProgress(run.progress.publish, module_id, module_name) if run is not None else None
+    # 与服务端运行、排队任务共用资源闸门：GPU模块同时执行的数量受「GPU并发任务数」限制
+    module_path = _find_module_path(module_name)
+    resource = resolve_resource(module_index.params(module_path).get('resource') if module_path else None)
+    release = resource_gate.acquire(resource, _gpu_device())
+    try:
+        outcome = run_module(module_name, input_values, settings, resolve_input=_resolve_input_ref,
+                             cancel_token=cancel_token, progress_callback=progress_callback)
+    finally:
+        release()
+    if 'error' in outcome:
+        return outcome
+    if cancel_token is not None and cancel_token():
+        # 请求已被取消，结果不再有人读取，不存入缓存
+        print(f'模块 {module_name} 已取消，丢弃执行结果')
+        return {'error': '执行已被用户取消'}
+    result = outcome['result']
+    output_quantity = outcome['output_quantity']
+    time_late = outcome['time_late']
+    variable_quantity = outcome['variable_quantity']
+    
+    try:
         # 处理张量和图像：将PyTorch张量和PIL图像存入缓存，返回引用
+        # 每个输出端口的下游读取次数由前端统计，None表示未知
+        output_consumers = output_consumers or []
         processed_result = []
-        for val in result:
+        for index, val in enumerate(result):
+            consumers = output_consumers[index] if index < len(output_consumers) else None
             # 处理包含samples字段的字典（新Latent格式）
             if isinstance(val, dict) and "samples" in val and isinstance(val["samples"], torch.Tensor):
                 tensor_id = str(uuid.uuid4())
-                tensor_cache[tensor_id] = val
+                tensor_cache.put(tensor_id, val, consumers, run_id)
                 processed_result.append(f'TENSOR_REF:{tensor_id}')
             # 处理原始张量格式（向后兼容）
             elif isinstance(val, torch.Tensor):
                 tensor_id = str(uuid.uuid4())
-                tensor_cache[tensor_id] = val
+                tensor_cache.put(tensor_id, val, consumers, run_id)
                 processed_result.append(f'TENSOR_REF:{tensor_id}')
+            # 处理Checkpoint组件句柄
+            elif isinstance(val, CheckpointHandle):
+                model_id = str(uuid.uuid4())
+                model_cache[model_id] = val
+                if run is not None:
+                    run.model_refs.add(model_id)
+                processed_result.append(f'MODEL_REF:{model_id}')
             elif val is not None:
                 try:
                     from PIL import Image
                     if isinstance(val, Image.Image):
                         # 是PIL图像，存入缓存
                         image_id = str(uuid.uuid4())
-                        tensor_cache[image_id] = val
+                        tensor_cache.put(image_id, val, consumers, run_id)
                         processed_result.append(f'IMAGE_REF:{image_id}')
                     elif isinstance(val, list) and len(val) > 0 and isinstance(val[0], Image.Image):
                         # 是PIL图像列表，保存为列表引用
                         image_list_id = str(uuid.uuid4())
-                        tensor_cache[image_list_id] = val
+                        tensor_cache.put(image_list_id, val, consumers, run_id)
                         processed_result.append(f'IMAGE_LIST_REF:{image_list_id}')
                     else:
                         processed_result.append(val)
@@ -1376,7 +1577,6 @@ def _execute_module_async(module_name, input_values, settings):
         if time_late == variable_quantity:
             expected_outputs = output_quantity + 1
         
-        print(f'执行模块 {module_name} 成功，调用函数: {executed_function}')
         print(f'返回值: {result}, 处理后: {processed_result}, 预期输出数量: {expected_outputs}')
         
         # 返回执行结果
@@ -1388,44 +1588,259 @@ def _execute_module_async(module_name, input_values, settings):
         }
                 
     except Exception as e:
-        print(f'执行模块时出错: {e}')
+        print(f'处理模块返回值时出错: {e}')
         return {'error': str(e)}
 
+def _make_workflow_preview(module_name, inputs):
+    """服务端执行工作流时，为图片保存/显示模块生成预览图（base64）"""
+    if module_name != '图片保存/显示模块' or not inputs:
+        return None
+    try:
+        from PIL import Image
+        import base64
+        image = inputs[0]
+        if isinstance(image, list):
+            image = image[0] if image else None
+        if not isinstance(image, Image.Image):
+            return None
+        buffered = io.BytesIO()
+        image.save(buffered, format="PNG")
+        return f'data:image/png;base64,{base64.b64encode(buffered.getvalue()).decode("utf-8")}'
+    except Exception as e:
+        print(f'生成预览图失败: {e}')
+        return None
+
+def _gpu_device():
+    """当前GPU模块所用设备（生成引擎）的标识，资源闸门和任务队列按它区分设备"""
+    return f'gpu:{get_engine_from_settings()}'
+
+# 模块资源闸门：服务端运行、排队任务和 /api/execute_module 共用，
+# 同一生成引擎上同时执行的GPU模块数不超过「GPU并发任务数」
+resource_gate = ResourceGate(gpu_slots=load_gpu_concurrency)
+
+# 服务端工作流执行器：模块调用逻辑与 /api/execute_module 共用 run_module
+# 相互独立的分支并发执行，GPU模块的并发受共用的资源闸门限制
+workflow_executor = WorkflowExecutor(run_module, make_preview=_make_workflow_preview,
+                                     gpu_device=_gpu_device, gate=resource_gate)
+
+@app.route('/api/run_workflow', methods=['POST'])
+def run_workflow():
+    """
+    在服务端执行整个工作流
+    请求体与 project.json 相同（modules、connections），模块之间在进程内直接传递对象
+    返回 text/event-stream 进度事件流（start / module_start / module_done / module_error / done）
+    """
+    data = request.get_json(silent=True) or {}
+    modules = data.get('modules') or []
+    connections = data.get('connections') or []
+    
+    # 本次运行的上下文，点击「停止」时只取消这次运行
+    run = run_registry.get(data.get('run_id') or str(uuid.uuid4()))
+    events = queue.Queue()
+    
+    def worker():
+        try:
+            workflow_executor.run(modules, connections, on_event=events.put, cancel_token=run.token)
+        except WorkflowError as e:
+            print(f'工作流结构错误: {e}')
+            events.put({'type': 'error', 'error': str(e)})
+        except Exception as e:
+            print(f'执行工作流时出错: {e}')
+            import traceback
+            traceback.print_exc()
+            events.put({'type': 'error', 'error': str(e)})
+        finally:
+            finished = run_registry.finish(run.run_id)
+            if finished is not None:
+                _cleanup_run(finished)
+            events.put(None)
+    
+    threading.Thread(target=worker, daemon=True).start()
+    
+    def generate():
+        while True:
+            event = events.get()
+            if event is None:
+                break
+            yield f'data: {json.dumps(event, ensure_ascii=False)}\n\n'
+    
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+@app.route('/api/progress/<run_id>', methods=['GET'])
+def stream_progress(run_id):
+    """
+    订阅一次运行的模块进度（前端逐个模块执行时使用，服务端运行的进度直接包含在 /api/run_workflow 事件流中）
+    返回 text/event-stream，事件类型为 module_progress（步数、it/s、预计剩余时间、可选的Latent预览图）
+    运行结束（停止）后事件流结束；每个事件带 id（事件序号），浏览器自动重连时按 Last-Event-ID 续传，不重放已收到的事件
+    只订阅已存在的运行，不为未知ID创建运行：运行已结束时立即返回 closed 事件，短时间内仍未创建时返回404
+    """
+    # 前端先订阅进度、再发出第一个模块请求，运行可能稍后才创建
+    run = run_registry.lookup(run_id, timeout=5)
+    if run is None and not run_registry.is_finished(run_id):
+        return jsonify({'error': f'运行 {run_id} 不存在'}), 404
+    since = request.headers.get('Last-Event-ID', type=int)
+    if since is None:
+        since = request.args.get('since', 0, type=int)
+    
+    def generate():
+        if run is None:
+            yield 'event: closed\ndata: {}\n\n'
+            return
+        position = since
+        while True:
+            events, position, closed = run.progress.read(position)
+            for index, event in enumerate(events, start=position - len(events) + 1):
+                yield f'id: {index}\ndata: {json.dumps(event, ensure_ascii=False)}\n\n'
+            if closed and not events:
+                yield 'event: closed\ndata: {}\n\n'
+                break
+            if not events:
+                # 保持连接，同时让服务器及时发现浏览器已断开
+                yield ': keepalive\n\n'
+    
+    return Response(generate(), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+def _run_job(job, on_event):
+    """在任务队列的工作线程中执行一个排队任务（整个工作流）"""
+    run = run_registry.get(job['id'])
+    try:
+        workflow_executor.run(job['payload']['modules'], job['payload']['connections'],
+                              on_event=on_event, cancel_token=run.token)
+    finally:
+        finished = run_registry.finish(job['id'])
+        if finished is not None:
+            _cleanup_run(finished)
+
+def _cancel_running_job(job_id):
+    run = run_registry.finish(job_id)
+    if run is not None:
+        _cleanup_run(run)
+
+# 任务队列：局域网内多个用户提交的工作流按优先级排队，每个设备同时执行的任务数受「GPU并发任务数」限制
+job_queue = JobQueue(_run_job, _cancel_running_job, device_of=_gpu_device)
+
+@app.route('/api/jobs', methods=['POST'])
+def submit_job():
+    """
+    提交工作流任务
+    请求体与 /api/run_workflow 相同，另有可选的 user（默认为客户端IP）和 priority（默认取「用户优先级」设置）
+    priority 只接受本机（GUI所在电脑）的请求；局域网客户端的优先级按其IP在「用户优先级」中的配置，
+    请求中的 priority 和 user 都不能提高它
+    返回任务状态，包括排队位置 position 和预计等待秒数 eta
+    """
+    data = request.get_json(silent=True) or {}
+    modules = data.get('modules') or []
+    if not modules:
+        return jsonify({'error': '工作流为空'}), 400
+    try:
+        priority = data.get('priority')
+        if request.remote_addr not in ('127.0.0.1', '::1'):
+            if priority is not None:
+                print(f'忽略局域网客户端 {request.remote_addr} 指定的优先级: {priority}')
+            priority = load_user_priority(request.remote_addr)
+        job = job_queue.submit(modules, data.get('connections') or [],
+                               user=data.get('user') or request.remote_addr,
+                               priority=int(priority) if priority is not None else None)
+        return jsonify({'success': True, 'job': job}), 200
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'优先级必须是整数: {e}'}), 400
+
+@app.route('/api/jobs', methods=['GET'])
+def list_jobs():
+    """
+    列出排队中、执行中和最近结束的任务
+    """
+    return jsonify({'success': True, 'jobs': job_queue.list()}), 200
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """
+    获取任务状态
+    可选参数 since：只返回该序号之后的进度事件，返回值中的 next 为下一次查询使用的序号
+    """
+    job = job_queue.status(job_id, since=request.args.get('since', 0, type=int))
+    if job is None:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify({'success': True, 'job': job}), 200
+
+@app.route('/api/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    """
+    取消任务：排队中的任务直接移出队列，执行中的任务在当前模块完成后停止
+    """
+    job = job_queue.cancel(job_id)
+    if job is None:
+        return jsonify({'error': '任务不存在'}), 404
+    return jsonify({'success': True, 'job': job}), 200
+
+@app.route('/api/module_registry_stats', methods=['GET'])
+def module_registry_stats():
+    """
+    获取模块注册表的命中/未命中/重新导入计数
+    """
+    return jsonify({'success': True, **module_registry.stats()}), 200
+
+@app.route('/api/checkpoint_store_stats', methods=['GET'])
+def checkpoint_store_stats():
+    """
+    获取Checkpoint组件仓库的文件读取/命中/转换/卸载/释放计数、预算占用及当前驻留的组件
+    """
+    return jsonify({'success': True, **checkpoint_store.stats()}), 200
+
+@app.route('/api/cache_stats', methods=['GET'])
+def cache_stats():
+    """
+    获取张量缓存的条目数、字节数、磁盘转存情况和自动释放计数
+    """
+    return jsonify({'success': True, 'active_runs': run_registry.active(), **tensor_cache.stats()}), 200
+
+@app.route('/api/release_models', methods=['POST'])
+def release_models():
+    """
+    手动释放组件仓库中的模型（正在使用的组件除外）
+    可选参数 path：只释放该checkpoint的组件
+    """
+    try:
+        data = request.get_json(silent=True) or {}
+        path = data.get('path')
+        checkpoint_store.release(path)
+        print(f'已释放模型组件: {path if path else "全部"}')
+        return jsonify({'success': True, 'message': '已释放模型组件'}), 200
+    except Exception as e:
+        print(f'释放模型组件失败: {e}')
+        return jsonify({'success': False, 'error': str(e)}), 500
+
 @app.route('/api/execute_module', methods=['POST'])
 def execute_module():
-    global stop_execution_flag
     try:
         data = request.json
         module_name = data.get('module_name')
         input_values = data.get('input_values', [])
         settings = data.get('settings', {})  # 获取设置界面的默认值
+        output_consumers = data.get('output_consumers')  # 每个输出端口的下游读取次数
+        module_id = data.get('module_id')  # 前端模块id（进度事件用）
+        
+        # 回收长时间没有请求的运行（例如标签页被直接关闭）
+        for stale in run_registry.expire():
+            _cleanup_run(stale)
         
-        # 重置停止标志（每次新请求开始时）
-        stop_execution_flag = False
+        # 本次运行的上下文：停止执行时取消令牌，令牌同时传给正在执行的模块
+        run = run_registry.get(data.get('run_id'))
+        if run.token.cancelled:
+            print(f'运行 {run.run_id} 已停止，不再执行模块: {module_name}')
+            return jsonify({'error': '执行已被用户取消'}), 499
         
         # 使用线程池执行器异步执行模块
-        future = executor.submit(_execute_module_async, module_name, input_values, settings)
+        future = executor.submit(_execute_module_async, module_name, input_values, settings,
+                                 output_consumers, run, module_id)
         
-        # 添加到正在执行的集合中
-        ongoing_futures.add(future)
+        # 等待模块完成或被取消（由回调唤醒，不轮询）
+        if not wait_for_future(future, run.token):
+            future.cancel()
+            print(f'模块执行被取消: {module_name}')
+            return jsonify({'error': '执行已被用户取消'}), 499
         
-        try:
-            # 等待执行完成并获取结果，支持检查停止标志
-            while not future.done():
-                if stop_execution_flag:
-                    future.cancel()
-                    print(f'模块执行被取消: {module_name}')
-                    return jsonify({'error': '执行已被用户取消'}), 499
-                import time
-                time.sleep(0.1)
-            
-            result = future.result()
-        finally:
-            # 从正在执行的集合中移除
-            try:
-                ongoing_futures.remove(future)
-            except:
-                pass
+        result = future.result()
         
         # 检查是否有错误
         if 'error' in result:
@@ -1495,6 +1910,8 @@ def get_image_base64():
     """
     try:
         image_ref = request.args.get('image_ref', '')
+        # consume=1 表示这是一次计入引用计数的读取（图片保存/显示模块的预览）
+        consume = request.args.get('consume', '0') == '1'
         if not image_ref:
             return jsonify({'error': '缺少image_ref参数'}), 400
         
@@ -1503,7 +1920,7 @@ def get_image_base64():
         if image_ref not in tensor_cache:
             return jsonify({'error': '图像引用不存在'}), 404
         
-        image_data = tensor_cache[image_ref]
+        image_data = tensor_cache.get(image_ref, consume=consume)
         
         from PIL import Image
         import io
@@ -1745,28 +2162,41 @@ def get_default_model_path():
         print(f'获取默认路径失败: {e}')
         return jsonify({'error': f'获取默认路径失败: {str(e)}'}), 500
 
+@app.route('/api/finish_run', methods=['POST'])
+def finish_run():
+    """
+    运行正常结束（前端一次运行或连续运行的一次迭代完成时调用）
+    释放该运行在张量缓存中剩余的条目（下游读取次数未知的条目、磁盘转存文件）和模型句柄
+    """
+    data = request.get_json(silent=True) or {}
+    run_id = data.get('run_id')
+    run = run_registry.finish(run_id) if run_id else None
+    if run is not None:
+        _cleanup_run(run)
+    return jsonify({'success': True, 'finished': run is not None})
+
 @app.route('/api/stop_execution', methods=['POST'])
 def stop_execution():
     """
-    停止当前正在执行的所有模块，并清空显存
+    停止运行并清空显存
+    可选参数 run_id：只停止该运行并释放它的缓存条目（为null时不停止任何运行）；不传时停止全部运行
     """
-    global stop_execution_flag
-    stop_execution_flag = True
-    
-    # 取消所有正在执行的future
-    for future in ongoing_futures:
-        try:
-            future.cancel()
-        except:
-            pass
+    data = request.get_json(silent=True) or {}
     
-    # 清空张量缓存
-    tensor_cache.clear()
-    print('已清空张量缓存')
-    
-    # 清空模型缓存
-    model_cache.clear()
-    print('已清空模型缓存')
+    if 'run_id' in data:
+        # 结束该运行：等待中的请求立即返回，正在执行的模块通过令牌收到取消信号，
+        # 释放该运行在张量缓存中剩余的条目（含下游读取次数未知的条目和磁盘转存文件）
+        run = run_registry.finish(data['run_id']) if data['run_id'] else None
+        if run is not None:
+            _cleanup_run(run)
+    else:
+        for run in run_registry.finish_all():
+            print(f'已停止运行: {run.run_id}')
+        tensor_cache.clear()
+        print('已清空张量缓存')
+        # 清空模型缓存（只清除组件句柄，组件仓库中的权重保持常驻）
+        model_cache.clear()
+        print('已清空模型缓存')
     
     # 释放PyTorch显存
     try:
@@ -1908,8 +2338,8 @@ def get_module_source():
         with open(module_path, 'r', encoding='utf-8') as f:
             source_code = f.read()
         
-        # 解析模块参数
-        module_params = parse_module_params(module_path)
+        # 从头部索引获取模块参数
+        module_params = module_index.params(module_path)
         
         return jsonify({
             'success': True,
@@ -2073,7 +2503,9 @@ if __name__ == '__main__':
     
     # 检查是否以模块方式运行
     if len(sys.argv) > 1 and sys.argv[1] == 'run':
-        # 以模块方式运行，启动Flask服务器
+        # 以模块方式运行，启动任务队列调度线程和Flask服务器
+        job_queue.start()
+        module_index.start_watcher()
         app.run(debug=False, host='0.0.0.0', port=5000)
     else:
         # 直接运行，启动GUI
@@ -0,0 +1,5 @@
+"""
+核心运行时组件
+功能：放置服务端与各个模块共享的基础设施（模块注册表、缓存等）
+说明：本文件夹不是模块文件夹，里面的文件不会出现在左侧模块库中
+"""
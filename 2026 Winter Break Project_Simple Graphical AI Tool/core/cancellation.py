@@ -0,0 +1,204 @@
+"""
+取消令牌、运行上下文与事件驱动的等待
+功能：每次运行（一个浏览器标签的一次「运行」或一次服务端运行）有自己的运行ID和取消令牌，
+停止执行只影响该运行，多个标签/用户共用一个后端时互不干扰
+- 令牌本身可调用，返回是否已取消（与模块中 cancel_token() 的写法兼容）
+- 运行结束（停止）后，同一运行ID的后续请求直接视为已取消，不会把停止信号"重置"掉
+- 等待模块完成时由 future 回调和取消回调唤醒，不再定时轮询
+- 长时间运行的模块（采样、VAE、CLIP）在每步/每块之间调用 check_cancelled，收到取消信号后立即停止并释放中间张量
+"""
+
+import time
+import threading
+from collections import OrderedDict
+
+from core.progress import ProgressChannel
+
+# 请求未携带运行ID时使用的默认运行
+DEFAULT_RUN_ID = 'default'
+
+
+class CancelToken:
+    """取消令牌"""
+
+    def __init__(self):
+        self._event = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def __call__(self):
+        return self._event.is_set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def cancel(self):
+        """发出取消信号，并依次调用已注册的回调"""
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"取消回调执行失败: {e}")
+
+    def add_callback(self, callback):
+        """注册取消回调；令牌已取消时立即调用"""
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(callback)
+                return
+        callback()
+
+    def remove_callback(self, callback):
+        """注销尚未调用的取消回调（未注册或已被 cancel 取走时不做任何事）"""
+        with self._lock:
+            try:
+                self._callbacks.remove(callback)
+            except ValueError:
+                pass
+
+    def wait(self, timeout=None):
+        """等待取消信号，返回是否已取消"""
+        return self._event.wait(timeout)
+
+
+class ExecutionCancelled(Exception):
+    """模块执行中途检测到取消信号（由 run_module 捕获并返回取消错误）"""
+
+
+def check_cancelled(cancel_token):
+    """令牌已取消时抛出 ExecutionCancelled；cancel_token 为 None 时不检查"""
+    if cancel_token is not None and cancel_token():
+        raise ExecutionCancelled('执行已被用户取消')
+
+
+def wait_for_future(future, cancel_token=None):
+    """
+    等待 future 完成或令牌取消（先发生者唤醒）
+    :return: True 表示 future 已完成，False 表示等待期间被取消
+    """
+    wakeup = threading.Event()
+    future.add_done_callback(lambda f: wakeup.set())
+    if cancel_token is not None:
+        cancel_token.add_callback(wakeup.set)
+    try:
+        wakeup.wait()
+    finally:
+        # 注销回调，避免同一令牌上的回调随调用次数累积并一直引用已完成的 future
+        if cancel_token is not None:
+            cancel_token.remove_callback(wakeup.set)
+    return future.done()
+
+
+class RunContext:
+    """一次运行的执行上下文"""
+
+    def __init__(self, run_id):
+        self.run_id = run_id
+        self.token = CancelToken()
+        self.created = time.time()
+        self.last_active = self.created
+        # 本次运行产生的模型句柄引用id（运行结束时从 model_cache 中移除）
+        self.model_refs = set()
+        # 模块按步报告的进度事件（浏览器通过 /api/progress/<运行ID> 订阅）
+        self.progress = ProgressChannel()
+
+    def touch(self):
+        self.last_active = time.time()
+
+
+class RunRegistry:
+    """
+    运行上下文注册表
+    - get(run_id)：取得（或创建）运行上下文
+    - lookup(run_id)：只查找不创建（进度订阅使用，客户端随意传入的ID不会登记新的运行）
+    - finish(run_id)：结束运行，取消令牌并返回上下文，由调用方清理该运行的缓存
+    - 长时间没有请求的运行（例如标签页被直接关闭）视为已放弃，由 expire() 回收
+    """
+
+    def __init__(self, history=256, max_idle=3600):
+        self._lock = threading.Lock()
+        # 运行被创建或结束时唤醒 lookup 的等待
+        self._changed = threading.Condition(self._lock)
+        self._runs = {}
+        # 最近结束的运行ID，迟到的请求据此直接返回已取消
+        self._finished = OrderedDict()
+        self._history = history
+        self.max_idle = max_idle
+
+    def get(self, run_id=None):
+        run_id = run_id or DEFAULT_RUN_ID
+        with self._changed:
+            context = self._runs.get(run_id)
+            if context is None:
+                context = RunContext(run_id)
+                if run_id in self._finished and run_id != DEFAULT_RUN_ID:
+                    # 运行已结束：返回一个已取消、不登记的上下文
+                    context.token.cancel()
+                    context.progress.close()
+                    return context
+                self._runs[run_id] = context
+                self._changed.notify_all()
+            context.touch()
+            return context
+
+    def lookup(self, run_id=None, timeout=0):
+        """
+        查找正在进行的运行，不创建新的上下文
+        :param timeout: 运行尚未创建时最多等待的秒数（前端先订阅进度、再发出第一个模块请求）
+        :return: 运行上下文；运行已结束、或等待超时仍不存在时返回None
+        """
+        run_id = run_id or DEFAULT_RUN_ID
+        deadline = time.time() + timeout
+        with self._changed:
+            while True:
+                context = self._runs.get(run_id)
+                if context is not None or run_id in self._finished:
+                    return context
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self._changed.wait(remaining)
+
+    def finish(self, run_id=None):
+        """结束运行，返回被结束的上下文（不存在时返回None）"""
+        run_id = run_id or DEFAULT_RUN_ID
+        with self._changed:
+            context = self._runs.pop(run_id, None)
+            if run_id != DEFAULT_RUN_ID:
+                self._finished[run_id] = time.time()
+                while len(self._finished) > self._history:
+                    self._finished.popitem(last=False)
+            self._changed.notify_all()
+        if context is not None:
+            context.token.cancel()
+            context.progress.close()
+        return context
+
+    def is_finished(self, run_id):
+        """运行是否在最近结束的运行中"""
+        with self._lock:
+            return run_id in self._finished
+
+    def finish_all(self):
+        """结束全部运行，返回被结束的上下文列表"""
+        with self._lock:
+            run_ids = list(self._runs)
+        return [context for context in (self.finish(run_id) for run_id in run_ids) if context is not None]
+
+    def expire(self):
+        """结束长时间没有请求的运行，返回被结束的上下文列表"""
+        now = time.time()
+        with self._lock:
+            idle = [run_id for run_id, context in self._runs.items() if now - context.last_active > self.max_idle]
+        return [context for context in (self.finish(run_id) for run_id in idle) if context is not None]
+
+    def active(self):
+        """返回正在进行的运行ID列表"""
+        with self._lock:
+            return list(self._runs)
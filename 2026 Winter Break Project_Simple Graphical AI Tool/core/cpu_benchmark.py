@@ -0,0 +1,111 @@
+"""
+CPU推理基准
+功能：用一个随机初始化的小UNet（diffusers UNet2DConditionModel，结构与SD相同、通道数很小）比较CPU推理模式
+- 标准：fp32、contiguous，与以前的CPU路径相同
+- 优化：channels_last + bf16 autocast（CPU有原生bf16指令时）
+- 优化+编译：在优化的基础上 torch.compile
+报告每次UNet调用（CFG批量，即2倍批量）的中位耗时，以及与标准模式输出的最大误差
+用法（在项目目录下运行）：
+    python -m core.cpu_benchmark --batch 1 --size 64 --iters 20 --threads 8
+"""
+
+import time
+import argparse
+import statistics
+
+import torch
+
+from core.device_policy import DevicePolicy, cpu_supports_bf16, prepare_model, apply_cpu_threads
+
+MODES = {
+    'standard': '标准',
+    'optimized': '优化',
+    'compiled': '优化+编译',
+}
+
+
+def tiny_unet(seed=0):
+    """随机初始化的小UNet（两级下采样、带交叉注意力）"""
+    from diffusers import UNet2DConditionModel
+    torch.manual_seed(seed)
+    unet = UNet2DConditionModel(
+        sample_size=32,
+        in_channels=4,
+        out_channels=4,
+        layers_per_block=1,
+        block_out_channels=(32, 64),
+        down_block_types=("CrossAttnDownBlock2D", "DownBlock2D"),
+        up_block_types=("UpBlock2D", "CrossAttnUpBlock2D"),
+        cross_attention_dim=64,
+        attention_head_dim=8,
+    )
+    return unet.eval()
+
+
+def _policy(mode):
+    if mode == 'standard':
+        return DevicePolicy('unet', "cpu", torch.float32)
+    autocast_dtype = torch.bfloat16 if cpu_supports_bf16() else None
+    return DevicePolicy('unet', "cpu", torch.float32, True, autocast_dtype, compile=mode == 'compiled')
+
+
+def _run(mode, batch, size, iters, warmup, seed):
+    policy = _policy(mode)
+    # 每种模式使用新的模型实例，channels_last/编译不影响其他模式
+    model = prepare_model(tiny_unet(seed), policy)
+    generator = torch.Generator().manual_seed(seed)
+    sample = torch.randn((2 * batch, 4, size, size), generator=generator)
+    sample = sample.contiguous(memory_format=policy.memory_format)
+    hidden_states = torch.randn((2 * batch, 77, 64), generator=generator)
+    timestep = torch.tensor(500)
+
+    def call():
+        with torch.no_grad(), policy.autocast_context():
+            return model(sample, timestep, encoder_hidden_states=hidden_states).sample.float()
+
+    # 预热（编译模式在这里完成编译）
+    start = time.perf_counter()
+    for _ in range(warmup):
+        output = call()
+    warmup_seconds = time.perf_counter() - start
+
+    timings = []
+    for _ in range(iters):
+        start = time.perf_counter()
+        output = call()
+        timings.append(time.perf_counter() - start)
+    return {'mode': mode, 'policy': policy, 'median': statistics.median(timings),
+            'warmup': warmup_seconds, 'output': output}
+
+
+def benchmark(batch=1, size=64, iters=20, warmup=3, seed=0, modes=None):
+    """
+    :return: [{'mode', 'policy', 'median', 'warmup', 'max_error'}]，max_error 为与标准模式输出的最大绝对误差
+    """
+    results = [_run(mode, batch, size, iters, warmup, seed) for mode in modes or MODES]
+    reference = next((row['output'] for row in results if row['mode'] == 'standard'), None)
+    for row in results:
+        output = row.pop('output')
+        row['max_error'] = (output - reference).abs().max().item() if reference is not None else None
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="CPU推理基准（随机初始化的小UNet）")
+    parser.add_argument("--batch", type=int, default=1, help="Latent批量（CFG时UNet批量为2倍）")
+    parser.add_argument("--size", type=int, default=64, help="Latent边长（512图像对应64）")
+    parser.add_argument("--iters", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--threads", default="自动", help="CPU线程数（与设置中的「CPU线程数」相同）")
+    parser.add_argument("--modes", nargs="*", choices=list(MODES), help="只测试这些模式")
+    args = parser.parse_args()
+
+    apply_cpu_threads({"CPU线程数": args.threads})
+    print(f"线程数: {torch.get_num_threads()}，CPU原生bf16: {'是' if cpu_supports_bf16() else '否（优化模式不使用bf16）'}")
+    rows = benchmark(args.batch, args.size, args.iters, args.warmup, modes=args.modes)
+    baseline = next((row['median'] for row in rows if row['mode'] == 'standard'), None)
+    print(f"\n{'模式':<12}{'中位耗时(ms)':>14}{'加速':>8}{'预热(秒)':>10}{'最大误差':>12}")
+    for row in rows:
+        speedup = f"{baseline / row['median']:.2f}x" if baseline else "-"
+        error = f"{row['max_error']:.2e}" if row['max_error'] is not None else "-"
+        print(f"{MODES[row['mode']]:<12}{row['median'] * 1000:>14.2f}{speedup:>8}{row['warmup']:>10.2f}{error:>12}")
@@ -0,0 +1,334 @@
+"""
+设备策略
+功能：把 gui_settings.json 中的「生成引擎」「计算精度」「使用 CPU 运行 VAE」解析为每个组件（unet / vae / text_encoder）
+使用的设备、精度和内存格式，SD模块按同一规则放置模型和张量
+- 生成引擎中的GPU序号生效：多卡时 UNet、文本向量、Latent 都在所选的那块卡上
+- 计算精度：自动（CUDA/DML 用 fp16，CPU 用 fp32）、fp16、bf16、fp32；VAE 不使用 bf16
+- CUDA 上的 UNet 使用 channels_last 内存格式（半精度卷积走 NHWC 更快）
+- ensure_on_device 检查输入张量是否已在目标设备/精度上，不在时打印警告并只转换一次，统计隐式拷贝次数
+- CPU推理模式（生成引擎为CPU时）：
+  - 标准：fp32、默认线程数，与以前相同
+  - 优化：UNet/VAE 使用 channels_last（oneDNN 的 NHWC 卷积），CPU 有原生 bf16 指令（AVX512_BF16/AMX）时
+    UNet 和文本编码器在 bf16 autocast 中运行，线程数按「CPU线程数」「CPU并行算子数」设置
+  - 优化+编译：在优化的基础上用 torch.compile（inductor 后端，卷积/线性层经 oneDNN 预打包并与逐元素运算融合）编译 UNet，
+    第一次运行需要额外的编译时间
+- 注意力实现、注意力切片、VAE分块、顺序CPU卸载由 core/memory_options.py 解析，prepare_model 时应用到模型上（VAE分块除外，由编码/解码时按次处理）
+- 设置经 core/settings_service.py 读取；DeviceService 按设置版本缓存各组件的策略，设置文件未变化时不重新解析，
+  app.py 把它注入声明了 device_service 参数的模块
+"""
+
+import re
+import threading
+import contextlib
+
+import torch
+
+from core.settings_service import settings_service
+from core.memory_options import MemoryOptions, apply_memory_options, disable_sequential_offload
+
+# 计算精度的可选值（GUI下拉菜单与此保持一致）
+PRECISION_OPTIONS = ["自动", "fp16", "bf16", "fp32"]
+
+DEFAULT_PRECISION = "自动"
+
+COMPONENTS = ('unet', 'vae', 'text_encoder')
+
+# CPU推理模式、CPU线程数、CPU并行算子数的可选值（GUI下拉菜单与此保持一致）
+CPU_MODE_OPTIONS = ["标准", "优化", "优化+编译"]
+CPU_THREAD_OPTIONS = ["自动", "1", "2", "4", "6", "8", "12", "16", "24", "32"]
+CPU_INTEROP_OPTIONS = ["自动", "1", "2", "4"]
+
+DEFAULT_CPU_MODE = "标准"
+
+# 统计：输入张量不在目标设备/精度上而被转换的次数
+transfer_stats = {'checked': 0, 'device_copies': 0, 'dtype_casts': 0}
+
+
+class DevicePolicy:
+    """一个组件的放置策略"""
+
+    def __init__(self, component, device, dtype, channels_last=False, autocast_dtype=None, compile=False,
+                 memory=None):
+        self.component = component
+        self.device = device
+        self.dtype = dtype
+        self.channels_last = channels_last
+        # autocast 中的计算精度（None表示不使用autocast）
+        self.autocast_dtype = autocast_dtype
+        self.compile = compile
+        self.memory = memory or MemoryOptions()
+
+    @property
+    def is_cuda(self):
+        return self.device.startswith("cuda")
+
+    @property
+    def cpu_offload(self):
+        """是否顺序CPU卸载（只对显卡设备有意义）"""
+        return self.memory.cpu_offload and self.device != "cpu"
+
+    @property
+    def load_device(self):
+        """向组件仓库请求模型时使用的设备：顺序CPU卸载时模型留在CPU上，执行时按子模块搬运"""
+        return "cpu" if self.cpu_offload else self.device
+
+    @property
+    def memory_format(self):
+        return torch.channels_last if self.channels_last else torch.contiguous_format
+
+    def autocast_context(self):
+        """模型推理外层的 autocast 上下文（CUDA 半精度 / CPU bf16），不需要时为空上下文"""
+        if self.autocast_dtype is None:
+            return contextlib.nullcontext()
+        return torch.autocast(device_type="cuda" if self.is_cuda else "cpu", dtype=self.autocast_dtype)
+
+    def __repr__(self):
+        return (f"<DevicePolicy {self.component}: {self.device}, {self.dtype}, channels_last={self.channels_last}, "
+                f"autocast={self.autocast_dtype}, compile={self.compile}, offload={self.cpu_offload}>")
+
+
+# 生成引擎名称 -> 设备字符串（检测 torch_directml 和解析GPU序号只做一次）
+_engine_devices = {}
+
+
+def resolve_engine_device(engine):
+    """
+    生成引擎名称 -> PyTorch设备字符串
+    例如 "CUDA GPU 1: ..." -> "cuda:1"，"DML GPU 0: ..." -> "privateuseone:0"，不可用时回退
+    """
+    engine = engine or "CPU"
+    device = _engine_devices.get(engine)
+    if device is None:
+        device = _engine_devices[engine] = _resolve_engine_device(engine)
+    return device
+
+
+def _resolve_engine_device(engine):
+    if engine == "CPU":
+        return "cpu"
+    has_cuda = torch.cuda.is_available()
+    match = re.search(r'GPU\s+(\d+)', engine)
+    gpu_idx = int(match.group(1)) if match else 0
+
+    def cuda_device():
+        return f"cuda:{gpu_idx}" if gpu_idx < torch.cuda.device_count() else "cuda"
+
+    if "DML" in engine:
+        try:
+            import torch_directml  # noqa: F401
+            return f"privateuseone:{gpu_idx}"
+        except ImportError:
+            if has_cuda:
+                print("警告: DML不可用，回退到CUDA")
+                return cuda_device()
+            print("警告: 选择了DML引擎但DML和CUDA都不可用，回退到CPU")
+            return "cpu"
+    if any(name in engine for name in ("CUDA", "TensorRT", "ZLUDA")):
+        if has_cuda:
+            return cuda_device()
+        print(f"警告: 选择了{engine.split()[0]}引擎但CUDA不可用，回退到CPU")
+    return "cpu"
+
+
+def _resolve_dtype(precision, component, device):
+    half_device = device.startswith("cuda") or device.startswith("privateuseone")
+    if precision == "fp32" or (device == "cpu" and precision != "bf16"):
+        return torch.float32
+    if precision == "bf16":
+        if component == 'vae':
+            # VAE不支持bf16，半精度设备上用fp16
+            return torch.float16 if device.startswith("cuda") else torch.float32
+        if device == "cpu" or (device.startswith("cuda") and torch.cuda.is_bf16_supported()):
+            return torch.bfloat16
+        print(f"设备 {device} 不支持bf16，改用fp16")
+        return torch.float16
+    if component == 'vae':
+        # 与VAE模块一致：只有CUDA上使用fp16
+        return torch.float16 if device.startswith("cuda") else torch.float32
+    return torch.float16 if half_device else torch.float32
+
+
+def cpu_supports_bf16():
+    """CPU是否有原生bf16指令（AMX 或 AVX512_BF16）；没有时bf16只能模拟，反而比fp32慢"""
+    for name in ('_is_amx_tile_supported', '_is_avx512_bf16_supported'):
+        check = getattr(torch.cpu, name, None)
+        try:
+            if check is not None and check():
+                return True
+        except Exception:
+            pass
+    return False
+
+
+# 已应用的线程设置（线程数是进程级的，只在变化时重新设置）
+_applied_threads = {'intra': None, 'interop': None}
+
+
+def apply_cpu_threads(settings):
+    """按「CPU线程数」「CPU并行算子数」设置PyTorch的算子内/算子间线程数，「自动」时保持PyTorch默认值"""
+    intra = settings.get("CPU线程数", "自动")
+    if intra != "自动" and intra != _applied_threads['intra']:
+        try:
+            torch.set_num_threads(max(1, int(intra)))
+            _applied_threads['intra'] = intra
+            print(f"CPU线程数: {torch.get_num_threads()}")
+        except (TypeError, ValueError) as e:
+            print(f"无法识别的CPU线程数: {intra} ({e})")
+    interop = settings.get("CPU并行算子数", "自动")
+    if interop != "自动" and _applied_threads['interop'] is None:
+        try:
+            # 算子间线程池只能在第一次并行计算之前设置一次
+            torch.set_num_interop_threads(max(1, int(interop)))
+            print(f"CPU并行算子数: {interop}")
+        except (TypeError, ValueError, RuntimeError) as e:
+            print(f"设置CPU并行算子数失败（需要重启后端生效）: {e}")
+        _applied_threads['interop'] = interop
+
+
+def load_device_policy(component='unet', settings=None):
+    """
+    读取设置，返回组件的放置策略
+    :param component: unet / vae / text_encoder
+    :param settings: 已读取的设置字典（不传时使用共享设备服务中缓存的策略）
+    """
+    if component not in COMPONENTS:
+        raise ValueError(f"未知的组件: {component}")
+    if settings is None:
+        return device_service.policy(component)
+    return build_device_policy(component, settings)
+
+
+def build_device_policy(component, settings):
+    """按设置字典构建组件的放置策略（不经过缓存）"""
+    if component == 'vae' and settings.get("使用 CPU 运行 VAE", False):
+        device = "cpu"
+    else:
+        device = resolve_engine_device(settings.get("生成引擎"))
+    precision = settings.get("计算精度", DEFAULT_PRECISION)
+    if precision not in PRECISION_OPTIONS:
+        print(f"无法识别的计算精度: {precision}，使用 {DEFAULT_PRECISION}")
+        precision = DEFAULT_PRECISION
+    dtype = _resolve_dtype(precision, component, device)
+    memory = MemoryOptions.from_settings(settings)
+    if device == "cpu":
+        return _cpu_policy(component, dtype, settings, memory)
+    channels_last = component == 'unet' and device.startswith("cuda")
+    autocast_dtype = dtype if device.startswith("cuda") and dtype != torch.float32 else None
+    return DevicePolicy(component, device, dtype, channels_last, autocast_dtype, memory=memory)
+
+
+class DeviceService:
+    """
+    模块共享的设备服务：按设置服务的版本缓存各组件的策略
+    设置文件没有变化时直接返回同一个策略对象，不读文件、不检测设备
+    """
+
+    def __init__(self, settings=None):
+        self._settings_service = settings or settings_service
+        self._lock = threading.Lock()
+        self._version = None
+        self._policies = {}
+
+    @property
+    def settings(self):
+        """当前设置字典（只读）"""
+        return self._settings_service.get()
+
+    def policy(self, component='unet'):
+        if component not in COMPONENTS:
+            raise ValueError(f"未知的组件: {component}")
+        version = self._settings_service.current_version()
+        with self._lock:
+            if version != self._version:
+                self._version, self._policies = version, {}
+            policy = self._policies.get(component)
+        if policy is None:
+            policy = build_device_policy(component, self._settings_service.get())
+            with self._lock:
+                if version == self._version:
+                    self._policies[component] = policy
+            print(f"设备策略: {policy}")
+        return policy
+
+
+# 全局共享的设备服务
+device_service = DeviceService()
+
+
+def _cpu_policy(component, dtype, settings, memory):
+    mode = settings.get("CPU推理模式", DEFAULT_CPU_MODE)
+    if mode not in CPU_MODE_OPTIONS:
+        print(f"无法识别的CPU推理模式: {mode}，使用 {DEFAULT_CPU_MODE}")
+        mode = DEFAULT_CPU_MODE
+    apply_cpu_threads(settings)
+    if mode == "标准":
+        return DevicePolicy(component, "cpu", dtype, memory=memory)
+    # 文本编码器没有卷积，channels_last 对它没有意义；VAE 在 bf16 下解码质量下降，保持 fp32
+    channels_last = component in ('unet', 'vae')
+    autocast_dtype = None
+    if component != 'vae' and dtype == torch.float32 and cpu_supports_bf16():
+        autocast_dtype = torch.bfloat16
+    return DevicePolicy(component, "cpu", dtype, channels_last, autocast_dtype,
+                        compile=mode == "优化+编译" and component == 'unet', memory=memory)
+
+
+def prepare_model(model, policy):
+    """
+    按策略调整模型（组件仓库已负责设备和精度）：应用显存选项、转换内存格式、按需编译
+    同一模型只转换/编译一次，返回用于推理调用的模型（编译时为编译后的包装）
+    顺序CPU卸载时模型须以 policy.load_device 从组件仓库取得
+    """
+    if policy.channels_last and not getattr(model, '_channels_last', False):
+        # 换内存格式会替换权重张量，已登记的顺序CPU卸载需要按新权重重新登记
+        disable_sequential_offload(model)
+        model.__dict__.pop('_memory_options', None)
+        model.to(memory_format=torch.channels_last)
+        model._channels_last = True
+    apply_memory_options(model, policy)
+    if policy.compile:
+        compiled = model.__dict__.get('_compiled_model')
+        if compiled is None:
+            try:
+                print(f"编译 {policy.component}（第一次运行需要额外时间）...")
+                compiled = torch.compile(model)
+            except Exception as e:
+                print(f"torch.compile 不可用，使用未编译的模型: {e}")
+                compiled = model
+            # 绕过 nn.Module 的子模块注册，避免编译包装被当作子模块参与 .to() 和 state_dict
+            object.__setattr__(model, '_compiled_model', compiled)
+        return compiled
+    return model
+
+
+def _same_device(tensor_device, device):
+    target = torch.device(device)
+    if tensor_device.type != target.type:
+        return False
+    if target.type == "cpu":
+        return True
+    # 不带序号的 "cuda" 指当前卡
+    default = torch.cuda.current_device() if target.type == "cuda" and torch.cuda.is_available() else 0
+    tensor_index = tensor_device.index if tensor_device.index is not None else default
+    return tensor_index == (target.index if target.index is not None else default)
+
+
+def ensure_on_device(name, tensor, policy):
+    """
+    检查输入张量是否已在策略的设备/精度上
+    不在时打印警告（说明上游模块与本模块的放置不一致）并转换，转换只发生在这里一次
+    :param name: 张量名称（用于日志）
+    """
+    if not isinstance(tensor, torch.Tensor):
+        return tensor
+    transfer_stats['checked'] += 1
+    wrong_device = not _same_device(tensor.device, policy.device)
+    wrong_dtype = tensor.is_floating_point() and tensor.dtype != policy.dtype
+    if wrong_device:
+        transfer_stats['device_copies'] += 1
+        print(f"警告: {name} 在 {tensor.device} 上，{policy.component} 在 {policy.device} 上，发生一次设备间拷贝")
+    elif wrong_dtype:
+        transfer_stats['dtype_casts'] += 1
+        print(f"提示: {name} 精度为 {tensor.dtype}，转换为 {policy.dtype}")
+    if wrong_device or wrong_dtype:
+        tensor = tensor.to(device=policy.device, dtype=policy.dtype if wrong_dtype else tensor.dtype)
+    return tensor
@@ -0,0 +1,125 @@
+"""
+VAE编码结果缓存
+功能：图生图/遮罩重绘时源图像通常不变，只改提示词和种子；同一张图（和遮罩）用同一个VAE编码过一次后直接返回上次的Latent字典
+- 按内容寻址：键为 (图像内容摘要, 遮罩内容摘要, VAE路径及文件修改时间, 精度, 设备, 编码变体)，与图像对象本身无关；
+  只有PIL图像/遮罩参与缓存（张量输入不读取数据算摘要，直接跳过缓存）
+- 只缓存确定性的编码结果：编码方式为「均值」时取 latent_dist.mode()，同样的输入总是得到同样的Latent，命中结果可复现；
+  「采样」每次从分布中重新采样，不读也不写缓存
+- 最多保留 MAX_ENTRIES 条（LRU），Latent很小（512x512 的图约 32 KB），条目常驻在输出所在的设备上
+"""
+
+import os
+import threading
+from collections import OrderedDict
+
+from PIL import Image
+
+from core.image_io import content_digest
+
+# 编码方式（前端下拉菜单与此保持一致）
+LATENT_MODES = ["均值", "采样"]
+
+# 默认从分布中采样（与以前的编码结果一致），需要可复现和缓存时在节点上选择均值
+DEFAULT_LATENT_MODE = "采样"
+
+MAX_ENTRIES = 16
+
+
+def resolve_latent_mode(value):
+    """节点上的编码方式 -> 均值 / 采样（空值为采样）"""
+    if value in LATENT_MODES:
+        return value
+    if value not in (None, ''):
+        print(f"无法识别的编码方式: {value}，使用{DEFAULT_LATENT_MODE}")
+    return DEFAULT_LATENT_MODE
+
+
+def _file_signature(path):
+    """VAE文件路径及修改时间（模型文件被替换后旧条目不再命中）"""
+    try:
+        return (path, os.stat(path).st_mtime_ns)
+    except (OSError, TypeError):
+        return (path, None)
+
+
+def _digest_images(images):
+    """:return: 内容摘要（列表为元组）；包含非PIL对象时返回False，表示不能缓存"""
+    items = images if isinstance(images, (list, tuple)) else [images]
+    if not all(isinstance(item, Image.Image) for item in items):
+        return False
+    digests = tuple(content_digest(item) for item in items)
+    return digests if isinstance(images, (list, tuple)) else digests[0]
+
+
+class EncodeCache:
+    """
+    内容寻址的编码结果缓存
+    条目: 键 -> 模块返回的Latent字典 {"samples", "noise_mask"（可选）}
+    """
+
+    def __init__(self, max_entries=MAX_ENTRIES):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(image, mask, vae_path, placement, variant=""):
+        """
+        :param image: PIL图像或图像列表
+        :param mask: PIL遮罩，没有遮罩时为None
+        :param vae_path: VAE（checkpoint）文件路径；草稿模式传 TAESD 的标识
+        :param placement: 影响结果的设备和精度，例如 (VAE设备, VAE精度, 输出设备, 输出精度)
+        :param variant: 其他影响结果的选项（完整/草稿等）
+        :return: 缓存键；图像或遮罩不是PIL对象时返回None（get/put 对None键不做任何事）
+        """
+        image_digest = _digest_images(image)
+        mask_digest = None if mask is None else _digest_images(mask)
+        if image_digest is False or mask_digest is False:
+            return None
+        return (image_digest, mask_digest, _file_signature(vae_path),
+                tuple(str(item) for item in placement), variant)
+
+    def get(self, key):
+        """
+        :return: 命中时返回Latent字典的副本（samples 为克隆，调用方和下游可以随意修改），未命中返回None
+        遮罩来自 core/image_io.py 的 latent_mask 缓存，本来就是只读共享的，不再克隆
+        """
+        if key is None:
+            return None
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+        result = dict(entry)
+        if result.get("samples") is not None:
+            result["samples"] = result["samples"].clone()
+        return result
+
+    def put(self, key, result):
+        """保存模块的返回值（保存副本，之后对返回值的修改不影响缓存）"""
+        if key is None or not isinstance(result, dict) or result.get("samples") is None:
+            return
+        entry = dict(result)
+        entry["samples"] = entry["samples"].detach().clone()
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+# 全局共享的编码结果缓存（VAE图像编码模块、VAE重绘编码器模块共用）
+encode_cache = EncodeCache()
@@ -0,0 +1,285 @@
+"""
+图像/遮罩与张量互转
+功能：所有图像模块共用的 PIL ↔ 张量转换
+- 主机与设备之间只传 uint8（数据量是 float32 的四分之一），归一化/反归一化在设备上按整批完成
+- CUDA 设备使用锁页内存做主机端缓冲区：上传时图像直接写入锁页缓冲区再异步复制，下载时复制到锁页缓冲区后零拷贝转 numpy；
+  锁页内存分配很慢，缓冲区按形状复用（异步上传的缓冲区在复制完成后才会被再次取用）
+- 遮罩的反转、缩放到Latent尺寸、高斯模糊都用 torch 在设备上完成，不再经过 PIL 重采样和 scipy
+- latent_mask 是遮罩处理的唯一入口：单通道、广播混合，编码模块和K采样器共用；
+  PIL遮罩按内容摘要缓存，张量遮罩按对象身份和版本号缓存（不为了算键把设备上的数据复制回主机）
+用法示例：
+    pixels = pil_to_tensor(image, device, torch.float16)      # [B, 3, H, W]，取值 [-1, 1]
+    images = tensor_to_pil(decoded)                            # PIL图像列表
+    mask = latent_mask(pil_mask, 64, 64, device, dtype, 2.0)  # [1, 1, 64, 64]，1表示重绘，已模糊
+"""
+
+import hashlib
+import weakref
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+# 可复用的锁页缓冲区（按形状LRU）：形状 -> [(缓冲区, 异步复制完成事件或None)]
+MAX_PINNED_SHAPES = 8
+MAX_PINNED_PER_SHAPE = 2
+_pinned_buffers = OrderedDict()
+_pinned_lock = threading.Lock()
+
+# 高斯卷积核缓存：(核大小, sigma, 设备, 精度) -> 一维卷积核
+_blur_kernels = {}
+
+# 处理好的Latent遮罩（LRU）：(遮罩键, 高, 宽, sigma, 设备, 精度) -> (张量遮罩的弱引用或None, [B, 1, H, W])
+MAX_CACHED_MASKS = 8
+_latent_masks = OrderedDict()
+_latent_masks_lock = threading.Lock()
+
+
+def _as_list(images):
+    if isinstance(images, (list, tuple)):
+        if not images:
+            raise ValueError("图像列表为空")
+        return list(images)
+    return [images]
+
+
+def _use_pinned(device):
+    return torch.device(device).type == 'cuda' and torch.cuda.is_available()
+
+
+def _acquire_host_buffer(shape, device):
+    """
+    取一个主机端 uint8 缓冲区，目标（或来源）是CUDA设备时复用缓存的锁页缓冲区
+    用完后调用 _release_host_buffer 归还
+    """
+    shape = tuple(shape)
+    if not _use_pinned(device):
+        return torch.empty(shape, dtype=torch.uint8)
+    with _pinned_lock:
+        free = _pinned_buffers.get(shape)
+        entry = free.pop() if free else None
+        if free is not None:
+            _pinned_buffers.move_to_end(shape)
+    if entry is None:
+        return torch.empty(shape, dtype=torch.uint8, pin_memory=True)
+    buffer, event = entry
+    # 上一次从这个缓冲区发出的异步复制完成后才能改写
+    if event is not None:
+        event.synchronize()
+    return buffer
+
+
+def _release_host_buffer(buffer, event=None):
+    """归还锁页缓冲区；event 为从该缓冲区发出的异步复制之后记录的CUDA事件"""
+    if not buffer.is_pinned():
+        return
+    shape = tuple(buffer.shape)
+    with _pinned_lock:
+        free = _pinned_buffers.setdefault(shape, [])
+        _pinned_buffers.move_to_end(shape)
+        if len(free) < MAX_PINNED_PER_SHAPE:
+            free.append((buffer, event))
+        while len(_pinned_buffers) > MAX_PINNED_SHAPES:
+            _pinned_buffers.popitem(last=False)
+
+
+def _upload(arrays, device):
+    """
+    把若干张相同尺寸的 uint8 数组 [H, W, C] 写入一个主机缓冲区并上传
+    :return: 设备上的 uint8 张量 [B, H, W, C]
+    """
+    buffer = _acquire_host_buffer((len(arrays),) + arrays[0].shape, device)
+    host = buffer.numpy()
+    for index, array in enumerate(arrays):
+        host[index] = array
+    if not buffer.is_pinned():
+        return buffer.to(device)
+    uploaded = buffer.to(device, non_blocking=True)
+    event = torch.cuda.Event()
+    event.record(torch.cuda.current_stream(uploaded.device))
+    _release_host_buffer(buffer, event)
+    return uploaded
+
+
+def _rgb_array(image):
+    if not isinstance(image, Image.Image):
+        raise TypeError(f"期望PIL.Image对象，实际得到: {type(image)}")
+    # 灰度图、带透明通道的图、调色板图统一转为RGB（透明通道直接丢弃）
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    return np.asarray(image)
+
+
+def pil_to_tensor(images, device="cpu", dtype=torch.float32, memory_format=torch.contiguous_format):
+    """
+    PIL图像（或尺寸相同的PIL图像列表）转为设备上的张量
+    :return: [B, 3, H, W]，取值 [-1, 1]（SD标准）
+    """
+    arrays = [_rgb_array(image) for image in _as_list(images)]
+    if any(array.shape != arrays[0].shape for array in arrays):
+        raise ValueError(f"批量中的图像尺寸不一致: {[array.shape[:2] for array in arrays]}")
+    pixels = _upload(arrays, device).permute(0, 3, 1, 2).to(dtype)
+    # x / 127.5 - 1，在设备上一次完成
+    pixels = pixels.mul_(1.0 / 127.5).sub_(1.0)
+    return pixels.contiguous(memory_format=memory_format)
+
+
+def tensor_to_pil(tensor):
+    """
+    取值 [-1, 1] 的图像张量（任意设备）转为PIL图像列表
+    反归一化和量化在张量所在的设备上完成，只有 uint8 结果复制到主机
+    :param tensor: [B, 3, H, W] 或 [3, H, W]
+    """
+    if tensor.dim() == 3:
+        tensor = tensor.unsqueeze(0)
+    # (x / 2 + 0.5) * 255，round() 避免浮点精度导致的偏色
+    pixels = (tensor.float() * 127.5 + 127.5).clamp_(0, 255).round_().to(torch.uint8)
+    pixels = pixels.permute(0, 2, 3, 1)
+    if pixels.device.type == 'cpu':
+        return [Image.fromarray(image) for image in pixels.contiguous().numpy()]
+    buffer = _acquire_host_buffer(pixels.shape, pixels.device)
+    try:
+        # 同步复制：返回后缓冲区中的数据已经可用；Image.fromarray 会复制数据，之后缓冲区可以归还
+        buffer.copy_(pixels)
+        return [Image.fromarray(image) for image in buffer.numpy()]
+    finally:
+        _release_host_buffer(buffer)
+
+
+def _mask_array(mask):
+    if not isinstance(mask, Image.Image):
+        raise TypeError(f"期望PIL.Image对象，实际得到: {type(mask)}")
+    # 多通道遮罩取第一个通道，其余模式（1位图、调色板等）转灰度
+    if len(mask.getbands()) > 1:
+        mask = mask.getchannel(0)
+    elif mask.mode != "L":
+        mask = mask.convert("L")
+    return np.asarray(mask)[..., None]
+
+
+def resize_mask(mask, height, width):
+    """
+    遮罩缩放（缩小用区域平均，放大用双线性）
+    :param mask: [B, 1, H, W]
+    """
+    if mask.shape[-2:] == (height, width):
+        return mask
+    if height <= mask.shape[-2] and width <= mask.shape[-1]:
+        return F.interpolate(mask, size=(height, width), mode='area')
+    return F.interpolate(mask, size=(height, width), mode='bilinear', align_corners=False)
+
+
+def blur_kernel_size(sigma):
+    """与 scipy.ndimage.gaussian_filter 默认截断（4倍sigma）相同的核大小"""
+    return 2 * int(4.0 * sigma + 0.5) + 1
+
+
+def gaussian_blur_mask(mask, sigma=2.0, kernel_size=5):
+    """
+    遮罩高斯模糊（可分离卷积，反射填充，默认5核，与 torchvision.transforms.GaussianBlur 结果一致）
+    :param mask: [B, 1, H, W]
+    :param kernel_size: 核大小；边长不大于填充宽度的极小遮罩不模糊
+    """
+    pad = kernel_size // 2
+    if min(mask.shape[-2:]) <= pad:
+        return mask
+    key = (kernel_size, float(sigma), str(mask.device), mask.dtype)
+    kernel = _blur_kernels.get(key)
+    if kernel is None:
+        x = torch.arange(kernel_size, dtype=torch.float32) - (kernel_size - 1) / 2
+        kernel = torch.exp(-0.5 * (x / sigma) ** 2)
+        kernel = (kernel / kernel.sum()).to(device=mask.device, dtype=mask.dtype)
+        _blur_kernels[key] = kernel
+    blurred = F.pad(mask, (pad, pad, pad, pad), mode='reflect')
+    blurred = F.conv2d(blurred, kernel.view(1, 1, 1, -1))
+    return F.conv2d(blurred, kernel.view(1, 1, -1, 1))
+
+
+def mask_to_tensor(mask, height, width, device="cpu", dtype=torch.float32, blur_sigma=1.0, invert=True):
+    """
+    PIL遮罩转为Latent尺寸的单通道遮罩张量
+    :param invert: 为True时反转遮罩：用户涂掉的地方（黑色）为1表示重绘，没涂的地方（白色）为0表示保留
+    :param blur_sigma: 缩放后边缘高斯模糊的sigma，0表示不模糊
+    :return: [1, 1, height, width]，取值 [0, 1]
+    """
+    if isinstance(mask, (list, tuple)):
+        mask = _as_list(mask)[0]
+    values = _upload([_mask_array(mask)], device).permute(0, 3, 1, 2).float().div_(255.0)
+    if invert:
+        values = 1.0 - values
+    values = resize_mask(values, height, width)
+    if blur_sigma > 0:
+        # 与以前的 scipy gaussian_filter 相同的4倍sigma截断
+        values = gaussian_blur_mask(values, blur_sigma, blur_kernel_size(blur_sigma))
+    return values.clamp_(0.0, 1.0).to(dtype)
+
+
+# ====================== 内容摘要与Latent遮罩 ======================
+
+def content_digest(image):
+    """PIL图像/遮罩内容的摘要（按模式、尺寸和像素）"""
+    if not isinstance(image, Image.Image):
+        raise TypeError(f"期望PIL.Image对象，实际得到: {type(image)}")
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(f"{image.mode}{image.size}".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+def tensor_identity(tensor):
+    """
+    张量的身份键（对象id、原地修改版本号、形状、精度、设备），不读取张量数据
+    id 可能在张量释放后被复用，使用方需要同时保存弱引用并在命中时核对
+    """
+    return ('tensor', id(tensor), tensor._version, tuple(tensor.shape), tensor.dtype, str(tensor.device))
+
+
+def latent_mask(mask, height, width, device="cpu", dtype=torch.float32, blur_sigma=0.0):
+    """
+    遮罩处理的唯一入口：转为Latent尺寸、单通道、留在Latent所在设备上的遮罩
+    - PIL遮罩（或列表中的第一张）按 mask_to_tensor 反转；张量遮罩视为已反转（1表示重绘），多通道时取第一个通道
+    - 返回 [B, 1, height, width]，混合时按通道广播，不复制成4通道
+    - 结果按 (遮罩键, Latent尺寸, 模糊sigma, 设备, 精度) 缓存，连续运行时同一个遮罩只处理一次；
+      PIL遮罩的键为内容摘要，张量遮罩的键为 tensor_identity（每次采样不产生设备到主机的同步和复制）；
+      返回的张量是共享的，调用方不要原地修改
+    :param blur_sigma: 边缘高斯模糊的sigma，0表示不模糊（5核，与K采样器以前的遮罩模糊相同）
+    """
+    if isinstance(mask, (list, tuple)):
+        mask = _as_list(mask)[0]
+    is_image = isinstance(mask, Image.Image)
+    mask_key = content_digest(mask) if is_image else tensor_identity(mask)
+    key = (mask_key, height, width, float(blur_sigma), str(device), dtype)
+    with _latent_masks_lock:
+        cached = _latent_masks.get(key)
+        if cached is not None:
+            ref, result = cached
+            # 张量遮罩核对是否仍是同一个对象（id被新张量复用时视为未命中）
+            if ref is None or ref() is mask:
+                _latent_masks.move_to_end(key)
+                return result
+            del _latent_masks[key]
+
+    if is_image:
+        values = mask_to_tensor(mask, height, width, device, torch.float32, blur_sigma=0.0)
+    else:
+        values = mask
+        while values.dim() < 4:
+            values = values.unsqueeze(0)
+        values = resize_mask(values[:, 0:1].to(device=device, dtype=torch.float32), height, width)
+    if blur_sigma > 0:
+        values = gaussian_blur_mask(values, blur_sigma)
+    result = values.clamp(0.0, 1.0).to(dtype)
+
+    with _latent_masks_lock:
+        _latent_masks[key] = (None if is_image else weakref.ref(mask), result)
+        while len(_latent_masks) > MAX_CACHED_MASKS:
+            _latent_masks.popitem(last=False)
+    return result
+
+
+def clear_mask_cache():
+    with _latent_masks_lock:
+        _latent_masks.clear()
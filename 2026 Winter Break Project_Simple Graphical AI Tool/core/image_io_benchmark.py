@@ -0,0 +1,123 @@
+"""
+图像/遮罩转换基准
+功能：在 512 / 1024 / 2048 像素下比较 core/image_io.py 与各模块以前的转换函数
+- 图像→张量：以前是 numpy float32 归一化后整张复制到设备；现在 uint8 经锁页内存上传后在设备上归一化
+- 张量→图像：以前是整张 float32 复制到CPU后用 numpy 量化；现在在设备上量化后只复制 uint8
+- 遮罩：以前是 PIL LANCZOS 缩放 + scipy 高斯模糊；现在在设备上区域平均缩放 + 可分离卷积模糊
+报告中位耗时（包含到设备/从设备的复制），以及两种实现结果的最大差异
+设备按当前 gui_settings.json 中VAE的设备和精度解析
+用法（在项目目录下运行）：
+    python -m core.image_io_benchmark --sizes 512 1024 2048 --batch 1 --iters 10
+"""
+
+import time
+import argparse
+import statistics
+
+import numpy as np
+import torch
+from PIL import Image
+
+from core.device_policy import load_device_policy
+from core.image_io import pil_to_tensor, tensor_to_pil, mask_to_tensor
+
+
+# ====================== 以前的实现（对照） ======================
+
+def legacy_pil_to_tensor(image, device, dtype):
+    image_np = np.array(image).astype(np.float32) / 127.5 - 1.0
+    return torch.from_numpy(image_np).permute(2, 0, 1).unsqueeze(0).to(device=device, dtype=dtype)
+
+
+def legacy_tensor_to_pil(tensor):
+    tensor = (tensor / 2 + 0.5).clamp(0, 1)
+    tensor = tensor.cpu().permute(0, 2, 3, 1).float().numpy()
+    images = (tensor * 255).round().astype(np.uint8)
+    return [Image.fromarray(image) for image in images]
+
+
+def legacy_mask_to_latent_mask(pil_mask, latent_height, latent_width, device):
+    from scipy.ndimage import gaussian_filter
+
+    mask_np = 1.0 - np.array(pil_mask).astype(np.float32) / 255.0
+    mask_pil = Image.fromarray((mask_np * 255).astype(np.uint8))
+    mask_pil = mask_pil.resize((latent_width, latent_height), Image.LANCZOS)
+    mask_np = np.clip(gaussian_filter(np.array(mask_pil).astype(np.float32) / 255.0, sigma=1.0), 0.0, 1.0)
+    return torch.from_numpy(mask_np).unsqueeze(0).unsqueeze(0).to(device)
+
+
+# ====================== 测试数据与计时 ======================
+
+def _test_images(size, batch):
+    generator = np.random.default_rng(0)
+    return [Image.fromarray(generator.integers(0, 256, (size, size, 3), dtype=np.uint8)) for _ in range(batch)]
+
+
+def _test_mask(size):
+    """白底上一个黑色圆（黑色为要重绘的区域）"""
+    axis = np.linspace(-1.0, 1.0, size)
+    inside = (axis[None, :] ** 2 + axis[:, None] ** 2) < 0.4
+    return Image.fromarray(np.where(inside, 0, 255).astype(np.uint8), mode="L")
+
+
+def _time(policy, call, iters):
+    """:return: (中位耗时秒, 最后一次的结果)"""
+    timings, result = [], None
+    for index in range(iters + 1):
+        start = time.perf_counter()
+        result = call()
+        if policy.is_cuda:
+            torch.cuda.synchronize()
+        if index > 0:
+            timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def benchmark(sizes=(512, 1024, 2048), batch=1, iters=10):
+    """
+    :return: [{'size', 'case', 'legacy', 'new'（中位耗时秒，对照实现不可用时为None）, 'max_diff'}]
+    """
+    policy = load_device_policy('vae')
+    device, dtype = policy.device, policy.dtype
+    print(f"设备: {device}, 精度: {dtype}, 批量: {batch}")
+    rows = []
+    for size in sizes:
+        images = _test_images(size, batch)
+        old_time, old = _time(policy, lambda: torch.cat([legacy_pil_to_tensor(i, device, dtype) for i in images]), iters)
+        new_time, new = _time(policy, lambda: pil_to_tensor(images, device, dtype), iters)
+        rows.append({'size': size, 'case': '图像→张量', 'legacy': old_time, 'new': new_time,
+                     'max_diff': (old.float() - new.float()).abs().max().item()})
+
+        decoded = new
+        old_time, old = _time(policy, lambda: legacy_tensor_to_pil(decoded), iters)
+        new_time, new = _time(policy, lambda: tensor_to_pil(decoded), iters)
+        diff = max(int(np.abs(np.asarray(a, dtype=np.int16) - np.asarray(b, dtype=np.int16)).max())
+                   for a, b in zip(old, new))
+        rows.append({'size': size, 'case': '张量→图像', 'legacy': old_time, 'new': new_time, 'max_diff': diff})
+
+        mask, latent = _test_mask(size), size // 8
+        new_time, new = _time(policy, lambda: mask_to_tensor(mask, latent, latent, device), iters)
+        try:
+            old_time, old = _time(policy, lambda: legacy_mask_to_latent_mask(mask, latent, latent, device), iters)
+            diff = (old.float() - new.float()).abs().max().item()
+        except ImportError:
+            print("未安装 scipy，跳过以前的遮罩实现")
+            old_time, diff = None, None
+        rows.append({'size': size, 'case': '遮罩→Latent遮罩', 'legacy': old_time, 'new': new_time, 'max_diff': diff})
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="图像/遮罩与张量互转的耗时对比")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512, 1024, 2048], help="图像边长（像素）")
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--iters", type=int, default=10)
+    args = parser.parse_args()
+
+    rows = benchmark(args.sizes, args.batch, args.iters)
+    print(f"\n{'尺寸':<8}{'转换':<16}{'以前(ms)':>12}{'现在(ms)':>12}{'加速':>8}{'最大差异':>12}")
+    for row in rows:
+        legacy = f"{row['legacy'] * 1000:.2f}" if row['legacy'] is not None else "-"
+        speedup = f"{row['legacy'] / row['new']:.1f}x" if row['legacy'] is not None else "-"
+        diff = f"{row['max_diff']:.4g}" if row['max_diff'] is not None else "-"
+        print(f"{row['size']:<8}{row['case']:<16}{legacy:>12}{row['new'] * 1000:>12.2f}{speedup:>8}{diff:>12}")
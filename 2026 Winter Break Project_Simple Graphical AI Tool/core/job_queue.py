@@ -0,0 +1,295 @@
+"""
+任务队列
+功能：局域网内多个用户共用一个后端时，整个工作流作为任务提交，排队后在服务端执行
+- 优先级高的任务先执行；同一优先级内，正在执行任务少、最久没有轮到的用户优先，其余按提交顺序
+- 每个设备（生成引擎）同时执行的任务数不超过「GPU并发任务数」设置
+- 队列保存到 job_queue.json，后端重启后未完成的任务重新排队
+- 根据最近完成任务的平均耗时估计排队位置和预计等待时间
+"""
+
+import os
+import json
+import time
+import uuid
+import threading
+
+from core.settings_service import settings_service
+
+# GPU并发任务数的可选值（GUI下拉菜单与此保持一致）
+CONCURRENCY_OPTIONS = ["1", "2", "3", "4"]
+
+DEFAULT_CONCURRENCY = "1"
+
+# 没有历史耗时记录时，每个任务的预计耗时（秒）
+DEFAULT_JOB_SECONDS = 60
+
+# 保留的已结束任务数量
+HISTORY_LIMIT = 100
+
+# 每个任务在内存中保留的进度事件数量
+EVENT_LIMIT = 500
+
+FINISHED_STATUSES = ('done', 'error', 'cancelled')
+
+
+def _load_settings():
+    return settings_service.get()
+
+
+def load_gpu_concurrency():
+    """从 gui_settings.json 读取每个设备同时执行的任务数"""
+    value = _load_settings().get("GPU并发任务数", DEFAULT_CONCURRENCY)
+    try:
+        return max(1, int(value))
+    except (TypeError, ValueError):
+        print(f"无法识别的GPU并发任务数: {value}，使用默认值 {DEFAULT_CONCURRENCY}")
+        return int(DEFAULT_CONCURRENCY)
+
+
+def load_user_priority(user):
+    """从 gui_settings.json 的「用户优先级」读取用户的默认优先级（未配置时为0）"""
+    priorities = _load_settings().get("用户优先级") or {}
+    try:
+        return int(priorities.get(user, 0))
+    except (TypeError, ValueError):
+        return 0
+
+
+class JobQueue:
+    """
+    持久化的任务队列
+    run_job 由 app.py 注入，签名为 run_job(任务字典, on_event)，在任务线程中执行整个工作流
+    cancel_running 由 app.py 注入，签名为 cancel_running(任务id)，用于取消正在执行的任务
+    device_of 返回新任务所用设备的标识
+    """
+
+    def __init__(self, run_job, cancel_running, device_of=None, path=None):
+        self.run_job = run_job
+        self.cancel_running = cancel_running
+        self.device_of = device_of or (lambda: 'gpu')
+        self.path = path or os.path.join(os.getcwd(), "job_queue.json")
+        self._cond = threading.Condition()
+        self._jobs = {}
+        self._seq = 0
+        # 每个设备最近完成任务的平均耗时（秒）
+        self._durations = {}
+        # 每个用户最近一次开始执行任务的时间，用于同优先级内的轮转
+        self._user_last_start = {}
+        self._dispatcher = None
+        self._load()
+
+    # ---------- 持久化 ----------
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+        except Exception as e:
+            print(f"读取任务队列失败: {e}")
+            return
+        self._durations = data.get('durations') or {}
+        requeued = 0
+        for job in data.get('jobs') or []:
+            if job.get('status') == 'running':
+                # 后端重启前正在执行的任务重新排队
+                job['status'] = 'queued'
+                job['started'] = None
+                requeued += 1
+            if job.get('status') == 'queued':
+                # 重启前对正在执行的任务发出的取消请求已随进程结束，不应取消重新排队后的执行
+                job.pop('cancel_requested', None)
+            job['events'] = []
+            job['event_offset'] = 0
+            self._jobs[job['id']] = job
+            self._seq = max(self._seq, job.get('seq', 0))
+        queued = sum(1 for job in self._jobs.values() if job['status'] == 'queued')
+        print(f"已恢复任务队列: 排队 {queued} 个（其中重新排队 {requeued} 个）")
+
+    def _save(self):
+        """保存队列（调用方需持有 self._cond）"""
+        jobs = [{k: v for k, v in job.items() if k not in ('events', 'event_offset')}
+                for job in sorted(self._jobs.values(), key=lambda job: job['seq'])]
+        temp_path = self.path + '.tmp'
+        try:
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump({'jobs': jobs, 'durations': self._durations}, f, ensure_ascii=False)
+            os.replace(temp_path, self.path)
+        except Exception as e:
+            print(f"保存任务队列失败: {e}")
+
+    def _trim_history(self):
+        finished = sorted((job for job in self._jobs.values() if job['status'] in FINISHED_STATUSES),
+                          key=lambda job: job['seq'])
+        for job in finished[:max(0, len(finished) - HISTORY_LIMIT)]:
+            del self._jobs[job['id']]
+
+    # ---------- 调度 ----------
+
+    def _running(self, device=None, user=None):
+        return [job for job in self._jobs.values() if job['status'] == 'running'
+                and (device is None or job['device'] == device)
+                and (user is None or job['user'] == user)]
+
+    def _sort_key(self, job):
+        return (-job['priority'], len(self._running(user=job['user'])),
+                self._user_last_start.get(job['user'], 0), job['seq'])
+
+    def _queued_in_order(self):
+        return sorted((job for job in self._jobs.values() if job['status'] == 'queued'), key=self._sort_key)
+
+    def _next_job(self):
+        limit = load_gpu_concurrency()
+        for job in self._queued_in_order():
+            if len(self._running(device=job['device'])) < limit:
+                return job
+        return None
+
+    def start(self):
+        """启动调度线程（只在服务器模式下调用）"""
+        with self._cond:
+            if self._dispatcher is not None:
+                return
+            self._dispatcher = threading.Thread(target=self._dispatch_loop, daemon=True)
+            self._dispatcher.start()
+
+    def _dispatch_loop(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    # 设置可能在等待期间修改，定时重新检查
+                    self._cond.wait(timeout=5)
+                    job = self._next_job()
+                job['status'] = 'running'
+                job['started'] = time.time()
+                self._user_last_start[job['user']] = job['started']
+                self._save()
+            print(f"开始执行任务 {job['id']}（用户 {job['user']}，优先级 {job['priority']}，设备 {job['device']}）")
+            threading.Thread(target=self._run, args=(job,), daemon=True).start()
+
+    def _on_event(self, job, event):
+        with self._cond:
+            job['events'].append(event)
+            if len(job['events']) > EVENT_LIMIT:
+                drop = len(job['events']) - EVENT_LIMIT
+                del job['events'][:drop]
+                job['event_offset'] += drop
+            if event.get('type') == 'module_done':
+                job['completed_modules'] = job.get('completed_modules', 0) + 1
+            elif event.get('type') == 'start':
+                job['total_modules'] = event.get('total', 0)
+
+    def _run(self, job):
+        error = None
+        try:
+            self.run_job(job, lambda event: self._on_event(job, event))
+        except Exception as e:
+            print(f"任务 {job['id']} 执行失败: {e}")
+            error = str(e)
+            self._on_event(job, {'type': 'error', 'error': error})
+        with self._cond:
+            job['finished'] = time.time()
+            if job.get('cancel_requested'):
+                job['status'] = 'cancelled'
+            elif error:
+                job['status'] = 'error'
+                job['error'] = error
+            else:
+                job['status'] = 'done'
+                # 平均耗时：指数滑动平均，最近的任务权重更高
+                elapsed = job['finished'] - job['started']
+                previous = self._durations.get(job['device'])
+                self._durations[job['device']] = elapsed if previous is None else previous * 0.7 + elapsed * 0.3
+            job['payload'] = None
+            self._trim_history()
+            self._save()
+            self._cond.notify_all()
+        print(f"任务 {job['id']} 结束: {job['status']}")
+
+    # ---------- 接口 ----------
+
+    def submit(self, modules, connections, user, priority=None):
+        """提交任务，返回任务状态"""
+        with self._cond:
+            self._seq += 1
+            job = {
+                'id': str(uuid.uuid4()),
+                'seq': self._seq,
+                'user': user,
+                'priority': int(priority) if priority is not None else load_user_priority(user),
+                'device': self.device_of(),
+                'status': 'queued',
+                'submitted': time.time(),
+                'started': None,
+                'finished': None,
+                'error': None,
+                'payload': {'modules': modules, 'connections': connections},
+                'events': [],
+                'event_offset': 0,
+            }
+            self._jobs[job['id']] = job
+            self._save()
+            self._cond.notify_all()
+            print(f"任务已提交 {job['id']}（用户 {user}，优先级 {job['priority']}）")
+            return self._describe(job)
+
+    def cancel(self, job_id):
+        """取消任务：排队中的任务直接取消，正在执行的任务通知其停止，返回任务状态（不存在时返回None）"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            if job['status'] == 'queued':
+                job['status'] = 'cancelled'
+                job['finished'] = time.time()
+                job['payload'] = None
+                self._save()
+                self._cond.notify_all()
+            elif job['status'] == 'running':
+                job['cancel_requested'] = True
+            running = job['status'] == 'running'
+        if running:
+            self.cancel_running(job_id)
+        with self._cond:
+            return self._describe(job)
+
+    def status(self, job_id, since=0):
+        """返回任务状态和第 since 个之后的进度事件"""
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None:
+                return None
+            info = self._describe(job)
+            start = max(0, since - job['event_offset'])
+            info['events'] = job['events'][start:]
+            info['next'] = job['event_offset'] + len(job['events'])
+            return info
+
+    def list(self):
+        with self._cond:
+            return [self._describe(job) for job in sorted(self._jobs.values(), key=lambda job: job['seq'])]
+
+    def _estimate(self, job):
+        """估计排队位置和预计开始等待时间（调用方需持有 self._cond）"""
+        device = job['device']
+        average = self._durations.get(device, DEFAULT_JOB_SECONDS)
+        limit = load_gpu_concurrency()
+        now = time.time()
+        ahead = [other for other in self._queued_in_order() if other['device'] == device]
+        position = ahead.index(job) if job in ahead else 0
+        running_left = sum(max(0, average - (now - other['started'])) for other in self._running(device=device))
+        return position, (running_left + position * average) / limit
+
+    def _describe(self, job):
+        info = {key: job.get(key) for key in ('id', 'user', 'priority', 'device', 'status', 'submitted',
+                                               'started', 'finished', 'error')}
+        info['progress'] = {'completed': job.get('completed_modules', 0), 'total': job.get('total_modules', 0)}
+        if job['status'] == 'queued':
+            info['position'], info['eta'] = self._estimate(job)
+        elif job['status'] == 'running':
+            average = self._durations.get(job['device'], DEFAULT_JOB_SECONDS)
+            info['position'], info['eta'] = 0, 0
+            info['remaining'] = max(0, average - (time.time() - job['started']))
+        return info
@@ -0,0 +1,126 @@
+"""
+显存选项基准
+功能：对高级设置中的每个显存选项，分别测量一次UNet推理（CFG批量）和一次VAE解码的耗时与峰值显存
+- 设备、精度按当前 gui_settings.json 的生成引擎和计算精度解析（与K采样器/VAE解码模块相同）
+- 峰值显存为 torch.cuda.max_memory_allocated，包含常驻的模型权重；非CUDA设备只报告耗时
+- 顺序CPU卸载的耗时包含每次推理搬运权重的时间
+用法（在项目目录下运行）：
+    python -m core.memory_benchmark 模型文件路径 --size 768 --iters 3
+"""
+
+import time
+import argparse
+import statistics
+
+import torch
+
+from core.model_store import checkpoint_store
+from core.device_policy import DevicePolicy, load_device_policy, prepare_model
+from core.memory_options import MemoryOptions
+from core.vae_decode import decode_latents
+
+CONFIGS = [
+    ('标准注意力', MemoryOptions(attention="标准")),
+    ('SDPA', MemoryOptions(attention="SDPA")),
+    ('xformers', MemoryOptions(attention="xformers")),
+    ('注意力切片(自动)', MemoryOptions(attention_slicing="自动")),
+    ('注意力切片(最大)', MemoryOptions(attention_slicing="最大")),
+    ('VAE分块 512/0.25', MemoryOptions(vae_tile=512, vae_tile_overlap=0.25)),
+    ('VAE分块 256/0.25', MemoryOptions(vae_tile=256, vae_tile_overlap=0.25)),
+    ('顺序CPU卸载', MemoryOptions(cpu_offload=True)),
+]
+
+
+def _with_memory(policy, memory):
+    return DevicePolicy(policy.component, policy.device, policy.dtype, policy.channels_last,
+                        policy.autocast_dtype, policy.compile, memory)
+
+
+def _measure(policy, call, iters):
+    """:return: (中位耗时秒, 峰值显存字节或None)"""
+    if policy.is_cuda:
+        torch.cuda.synchronize()
+        torch.cuda.empty_cache()
+        torch.cuda.reset_peak_memory_stats()
+    timings = []
+    # 第一次调用包含注意力处理器切换后的预热，不计时
+    for index in range(iters + 1):
+        start = time.perf_counter()
+        with torch.no_grad(), policy.autocast_context():
+            call()
+        if policy.is_cuda:
+            torch.cuda.synchronize()
+        if index > 0:
+            timings.append(time.perf_counter() - start)
+    peak = torch.cuda.max_memory_allocated() if policy.is_cuda else None
+    return statistics.median(timings), peak
+
+
+def benchmark(checkpoint_path, size=768, iters=3, configs=None):
+    """
+    :return: [{'name', 'unet_seconds', 'unet_peak', 'vae_seconds', 'vae_peak'}]
+    """
+    unet_base, vae_base = load_device_policy('unet'), load_device_policy('vae')
+    latent_size = size // 8
+    generator = torch.Generator().manual_seed(0)
+    latents = torch.randn((1, 4, latent_size, latent_size), generator=generator)
+    hidden_states = torch.randn((2, 77, 768), generator=generator)
+    print(f"UNet: {unet_base}\nVAE: {vae_base}")
+
+    results = []
+    for name, memory in configs or CONFIGS:
+        print(f"\n测试: {name}")
+        row = {'name': name}
+        unet_policy = _with_memory(unet_base, memory)
+        unet = prepare_model(checkpoint_store.get(checkpoint_path, 'unet', unet_policy.dtype,
+                                                  unet_policy.load_device), unet_policy)
+        sample = torch.cat([latents, latents]).to(device=unet_policy.device, dtype=unet_policy.dtype)
+        sample = sample.contiguous(memory_format=unet_policy.memory_format)
+        states = hidden_states.to(device=unet_policy.device, dtype=unet_policy.dtype)
+        timestep = torch.tensor(500, device=unet_policy.device)
+        try:
+            row['unet_seconds'], row['unet_peak'] = _measure(
+                unet_policy, lambda: unet(sample, timestep, encoder_hidden_states=states), iters)
+        except torch.cuda.OutOfMemoryError:
+            print("UNet显存不足")
+            row['unet_seconds'], row['unet_peak'] = None, None
+        del unet, sample, states
+
+        vae_policy = _with_memory(vae_base, memory)
+        vae = prepare_model(checkpoint_store.get(checkpoint_path, 'vae', vae_policy.dtype,
+                                                 vae_policy.load_device), vae_policy)
+        scaled = (latents / vae.config.scaling_factor).to(device=vae_policy.device, dtype=vae_policy.dtype)
+        try:
+            row['vae_seconds'], row['vae_peak'] = _measure(
+                vae_policy, lambda: list(decode_latents(vae, scaled, tile_size=vae_policy.memory.vae_tile,
+                                                        overlap=vae_policy.memory.vae_tile_overlap)), iters)
+        except torch.cuda.OutOfMemoryError:
+            print("VAE显存不足")
+            row['vae_seconds'], row['vae_peak'] = None, None
+        del vae, scaled
+        results.append(row)
+    return results
+
+
+def _format(seconds, peak):
+    if seconds is None:
+        return f"{'显存不足':>12}{'-':>12}"
+    memory = f"{peak / 1024 ** 3:.2f}" if peak is not None else "-"
+    return f"{seconds * 1000:>12.0f}{memory:>12}"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="显存选项基准（峰值显存与耗时）")
+    parser.add_argument("checkpoint", help="checkpoint文件路径")
+    parser.add_argument("--size", type=int, default=768, help="图像边长（像素）")
+    parser.add_argument("--iters", type=int, default=3)
+    parser.add_argument("--configs", nargs="*", help="只测试这些配置（按名称）")
+    args = parser.parse_args()
+
+    selected = [c for c in CONFIGS if not args.configs or c[0] in args.configs]
+    rows = benchmark(args.checkpoint, args.size, args.iters, selected)
+    print(f"\n{args.size}x{args.size}，UNet为CFG批量（2），VAE解码1张")
+    print(f"{'配置':<20}{'UNet(ms)':>12}{'UNet峰值(GB)':>12}{'VAE(ms)':>12}{'VAE峰值(GB)':>12}")
+    for row in rows:
+        print(f"{row['name']:<20}{_format(row['unet_seconds'], row['unet_peak'])}"
+              f"{_format(row['vae_seconds'], row['vae_peak'])}")
@@ -0,0 +1,189 @@
+"""
+模型显存/速度选项
+功能：把高级设置中的注意力实现、注意力切片、VAE分块、顺序CPU卸载应用到组件仓库中的模型上
+- 注意力实现：自动（PyTorch 2 的 SDPA，不可用时为标准实现）、SDPA、xformers（未安装时回退SDPA）、标准
+- 注意力切片：按注意力头分片计算，降低UNet注意力的峰值显存，开启时代替上面的注意力实现
+- VAE分块：只在这里解析；分块由VAE编码/解码模块按每次调用处理（core/vae_decode.py），不修改共享的VAE模型
+- 顺序CPU卸载：权重常驻内存，每个子模块执行前才把它的权重复制到显卡、执行后释放，显存占用最低但速度最慢
+同一个模型的选项没有变化时不会重复设置；由 core/device_policy.py 的 prepare_model 调用
+"""
+
+import threading
+
+import torch
+
+# 可选值（GUI下拉菜单与此保持一致）
+ATTENTION_OPTIONS = ["自动", "SDPA", "xformers", "标准"]
+ATTENTION_SLICING_OPTIONS = ["关闭", "自动", "最大"]
+VAE_TILE_OPTIONS = ["关闭", "256", "512", "768"]
+VAE_TILE_OVERLAP_OPTIONS = ["0.125", "0.25", "0.5"]
+
+DEFAULT_VAE_TILE_OVERLAP = "0.25"
+
+
+class MemoryOptions:
+    """一组显存/速度选项"""
+
+    def __init__(self, attention="自动", attention_slicing="关闭", vae_tile=None, vae_tile_overlap=0.25,
+                 cpu_offload=False):
+        self.attention = attention
+        self.attention_slicing = attention_slicing
+        # VAE分块大小（像素），None表示不分块
+        self.vae_tile = vae_tile
+        self.vae_tile_overlap = vae_tile_overlap
+        self.cpu_offload = cpu_offload
+
+    @classmethod
+    def from_settings(cls, settings):
+        attention = settings.get("注意力实现", "自动")
+        if attention not in ATTENTION_OPTIONS:
+            print(f"无法识别的注意力实现: {attention}，使用自动")
+            attention = "自动"
+        slicing = settings.get("注意力切片", "关闭")
+        if slicing not in ATTENTION_SLICING_OPTIONS:
+            print(f"无法识别的注意力切片: {slicing}，不切片")
+            slicing = "关闭"
+        tile = settings.get("VAE分块", "关闭")
+        try:
+            overlap = float(settings.get("VAE分块重叠", DEFAULT_VAE_TILE_OVERLAP))
+        except (TypeError, ValueError):
+            overlap = float(DEFAULT_VAE_TILE_OVERLAP)
+        return cls(attention, slicing,
+                   int(tile) if tile in VAE_TILE_OPTIONS and tile != "关闭" else None,
+                   min(max(overlap, 0.0), 0.5),
+                   bool(settings.get("顺序CPU卸载", False)))
+
+    def key(self):
+        return (self.attention, self.attention_slicing, self.vae_tile, self.vae_tile_overlap, self.cpu_offload)
+
+    def __repr__(self):
+        return (f"<MemoryOptions attention={self.attention}, slicing={self.attention_slicing}, "
+                f"vae_tile={self.vae_tile}/{self.vae_tile_overlap}, cpu_offload={self.cpu_offload}>")
+
+
+def _set_attention(model, attention, slicing):
+    """设置 diffusers 模型（UNet/VAE）的注意力处理器；transformers 的文本编码器没有这些接口，保持不变"""
+    if not hasattr(model, 'set_attn_processor'):
+        return
+    from diffusers.models.attention_processor import AttnProcessor, AttnProcessor2_0
+
+    has_sdpa = hasattr(torch.nn.functional, 'scaled_dot_product_attention')
+    if attention == "xformers":
+        try:
+            model.enable_xformers_memory_efficient_attention()
+        except Exception as e:
+            print(f"xformers 不可用，改用SDPA: {e}")
+            attention = "SDPA"
+    if attention == "自动":
+        attention = "SDPA" if has_sdpa else "标准"
+    if attention == "SDPA" and not has_sdpa:
+        print("当前PyTorch不支持SDPA，使用标准注意力")
+        attention = "标准"
+    if attention == "SDPA":
+        model.set_attn_processor(AttnProcessor2_0())
+    elif attention == "标准":
+        model.set_attn_processor(AttnProcessor())
+
+    if slicing != "关闭" and hasattr(model, 'set_attention_slice'):
+        model.set_attention_slice("auto" if slicing == "自动" else "max")
+
+
+# ====================== 顺序CPU卸载 ======================
+
+def _offload_units(model):
+    """直接持有参数或缓冲区的子模块（权重以它们为单位搬运）"""
+    for module in model.modules():
+        own = [t for t in module._parameters.values() if t is not None]
+        own += [t for t in module._buffers.values() if t is not None]
+        if own:
+            yield module
+
+
+def _load_weights(module):
+    device = module._offload_device
+    for store in (module._parameters, module._buffers):
+        for name, tensor in store.items():
+            if tensor is not None:
+                tensor.data = module._offload_weights[name].to(device, non_blocking=True)
+
+
+def _release_weights(module):
+    # 内存中的权重始终保留，执行后只需把引用换回来，显卡上的副本随之释放
+    for store in (module._parameters, module._buffers):
+        for name, tensor in store.items():
+            if tensor is not None:
+                tensor.data = module._offload_weights[name]
+
+
+def _offloaded_forward(module, forward):
+    """
+    包装子模块的 forward：执行前搬入权重，执行后（包括抛出异常时）换回内存中的权重
+    同一子模块的搬入-执行-换回加锁串行，并发任务共用同一个模型时不会互相换走对方正在用的权重
+    """
+    lock = threading.RLock()
+
+    def offloaded(*args, **kwargs):
+        with lock:
+            _load_weights(module)
+            try:
+                return forward(*args, **kwargs)
+            finally:
+                _release_weights(module)
+
+    return offloaded
+
+
+def enable_sequential_offload(model, device):
+    """
+    开启顺序CPU卸载（模型须在CPU上），可用 disable_sequential_offload 撤销
+    与 accelerate 的 cpu_offload 不同，这里不把参数换成 meta 张量，模型仍是完整的CPU模型，组件仓库可以照常管理
+    """
+    if model.__dict__.get('_offload_units') is not None:
+        if model.__dict__.get('_offload_target') == str(device):
+            return model
+        disable_sequential_offload(model)
+    units = list(_offload_units(model))
+    for module in units:
+        weights = {}
+        for store in (module._parameters, module._buffers):
+            for name, tensor in store.items():
+                if tensor is not None:
+                    weights[name] = tensor.data
+        module._offload_weights = weights
+        module._offload_device = device
+        # 实例属性覆盖类上的 forward，nn.Module.__call__ 会调用它
+        module.forward = _offloaded_forward(module, module.forward)
+    model.__dict__['_offload_units'] = units
+    model.__dict__['_offload_target'] = str(device)
+    print(f"顺序CPU卸载: {len(units)} 个子模块按需搬运到 {device}")
+    return model
+
+
+def disable_sequential_offload(model):
+    units = model.__dict__.pop('_offload_units', None)
+    if units is None:
+        return model
+    model.__dict__.pop('_offload_target', None)
+    for module in units:
+        module.__dict__.pop('forward', None)
+        module.__dict__.pop('_offload_weights', None)
+        module.__dict__.pop('_offload_device', None)
+    return model
+
+
+def apply_memory_options(model, policy):
+    """按策略中的选项设置模型，选项与上次相同时直接返回"""
+    options = policy.memory
+    # VAE分块不属于模型状态（由调用方按次处理），不参与比较，修改分块设置不会重新设置模型
+    key = (policy.component, str(policy.device), options.attention, options.attention_slicing, options.cpu_offload)
+    if model.__dict__.get('_memory_options') == key:
+        return model
+    if policy.component in ('unet', 'vae'):
+        _set_attention(model, options.attention, options.attention_slicing)
+    if policy.cpu_offload:
+        enable_sequential_offload(model, policy.device)
+    else:
+        disable_sequential_offload(model)
+    model.__dict__['_memory_options'] = key
+    print(f"{policy.component} 显存选项: {options}")
+    return model
@@ -0,0 +1,526 @@
+"""
+Checkpoint组件仓库
+功能：同一个 .safetensors/.ckpt 文件在进程内只解析一次，
+把 UNet / VAE / 文本编码器 / 分词器 分发给各个模块
+以前 CLIP文本编码、K采样器、VAE解码 会各自调用一次 from_single_file，
+一张文生图要把同一个checkpoint读三遍；现在只读一遍
+解析结果以全精度（fp32）暂存在CPU上作为母本，各模块请求的设备/精度都由母本复制转换，
+不会出现先按fp16解析、再由fp16权重转换出fp32组件而损失精度的情况
+仓库按 gui_settings.json 中的「显存预算」「内存预算」做LRU淘汰：
+显存超出预算时先把最久未用的组件卸载到CPU，内存也超出时才彻底释放；
+正在执行的模块所用的组件会被钉住，不参与淘汰
+"""
+
+import os
+import gc
+import copy
+import threading
+from collections import OrderedDict
+
+os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
+os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "0"
+
+import torch
+
+from core.settings_service import settings_service
+
+# 可以从checkpoint中取出的组件
+COMPONENT_NAMES = ('unet', 'vae', 'text_encoder', 'tokenizer')
+
+# 句柄类型对应需要的组件
+HANDLE_COMPONENTS = {
+    'unet': ('unet',),
+    'vae': ('vae',),
+    'clip': ('text_encoder', 'tokenizer'),
+}
+
+# 预算设置的可选值（GUI下拉菜单与此保持一致）
+BUDGET_OPTIONS = ["自动", "不限制", "2 GB", "4 GB", "6 GB", "8 GB", "12 GB", "16 GB", "24 GB", "32 GB"]
+
+# 「自动」显存预算时为中间激活值预留的显存
+AUTO_VRAM_RESERVE = int(1.5 * 1024 ** 3)
+
+GB = 1024 ** 3
+
+
+class CheckpointHandle:
+    """
+    Checkpoint组件句柄
+    只记录checkpoint路径和组件类型，不持有权重；
+    真正的权重由下游模块按自己的设备/精度从组件仓库中取用
+    """
+
+    def __init__(self, path, kind):
+        if kind not in HANDLE_COMPONENTS:
+            raise ValueError(f"未知的组件类型: {kind}")
+        self.path = os.path.normpath(path)
+        self.kind = kind
+
+    def __repr__(self):
+        return f"<CheckpointHandle {self.kind}: {os.path.basename(self.path)}>"
+
+    def __str__(self):
+        return self.path
+
+
+def resolve_checkpoint_path(value):
+    """
+    兼容旧工作流：输入既可能是组件句柄，也可能是路径字符串
+    :return: checkpoint文件路径，无法识别时返回None
+    """
+    if isinstance(value, CheckpointHandle):
+        return value.path
+    if isinstance(value, str) and value:
+        return value
+    return None
+
+
+def _free_memory():
+    gc.collect()
+    if torch.cuda.is_available():
+        torch.cuda.empty_cache()
+
+
+def _load_budget_settings():
+    """从 gui_settings.json 读取显存/内存预算设置（经共享的设置服务，文件未变化时不重新解析）"""
+    settings = settings_service.get()
+    return settings.get("显存预算", "自动"), settings.get("内存预算", "自动")
+
+
+def _parse_budget(value):
+    """
+    解析预算设置
+    :return: 字节数；'auto' 表示自动；None 表示不限制
+    """
+    if value in (None, "", "自动"):
+        return 'auto'
+    if value == "不限制":
+        return None
+    try:
+        return int(float(str(value).replace("GB", "").strip()) * GB)
+    except ValueError:
+        print(f"无法识别的预算设置: {value}，按自动处理")
+        return 'auto'
+
+
+def _total_system_memory():
+    """获取物理内存总量，获取失败时返回None"""
+    try:
+        if os.name == 'nt':
+            import ctypes
+
+            class MEMORYSTATUSEX(ctypes.Structure):
+                _fields_ = [
+                    ("dwLength", ctypes.c_ulong),
+                    ("dwMemoryLoad", ctypes.c_ulong),
+                    ("ullTotalPhys", ctypes.c_ulonglong),
+                    ("ullAvailPhys", ctypes.c_ulonglong),
+                    ("ullTotalPageFile", ctypes.c_ulonglong),
+                    ("ullAvailPageFile", ctypes.c_ulonglong),
+                    ("ullTotalVirtual", ctypes.c_ulonglong),
+                    ("ullAvailVirtual", ctypes.c_ulonglong),
+                    ("sullAvailExtendedVirtual", ctypes.c_ulonglong),
+                ]
+
+            status = MEMORYSTATUSEX()
+            status.dwLength = ctypes.sizeof(MEMORYSTATUSEX)
+            ctypes.windll.kernel32.GlobalMemoryStatusEx(ctypes.byref(status))
+            return status.ullTotalPhys
+        return os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except Exception:
+        return None
+
+
+def _device_group(device):
+    """把设备字符串归一化，'cuda' 与 'cuda:0' 视为同一块显卡"""
+    if device is None:
+        return None
+    device = str(device)
+    if device in ('cuda', 'privateuseone'):
+        return f"{device}:0"
+    return device
+
+
+def _component_bytes(component, dtype=None):
+    """估算组件放到目标精度后占用的字节数（分词器按0计算）"""
+    if not hasattr(component, 'parameters'):
+        return 0
+    tensors = list(component.parameters()) + list(component.buffers())
+    if dtype is None:
+        return sum(t.numel() * t.element_size() for t in tensors)
+    element_size = torch.empty((), dtype=dtype).element_size()
+    return sum(t.numel() * (element_size if t.is_floating_point() else t.element_size()) for t in tensors)
+
+
+class CheckpointComponentStore:
+    """
+    进程级组件仓库，组件按 (路径, 组件名, dtype, 设备) 存放
+    - 第一次请求某个checkpoint的任意组件时按全精度解析整个文件，所有组件作为母本暂存在CPU上
+    - 每次请求从母本复制一份再转换到目标设备/精度；母本因内存不足被丢弃后才重新读文件
+    - 按LRU顺序淘汰：显存超预算时先卸载到CPU，内存超预算时再彻底释放
+    - 模块执行期间（begin_session 与 end_session 之间）取用的组件被钉住，不会被卸载或释放
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # 每个checkpoint一把锁，避免多个线程同时解析同一个文件
+        self._path_locks = {}
+        # 已放置到设备上的组件: (path, name, dtype, device) -> 组件对象，按最近使用顺序排列
+        self._components = OrderedDict()
+        # 组件占用的字节数: key -> bytes
+        self._sizes = {}
+        # 因显存不足被卸载到CPU的组件key
+        self._offloaded = set()
+        # 被钉住的组件: key -> 引用计数
+        self._pins = {}
+        # 每个执行线程在当前会话中钉住的组件
+        self._local = threading.local()
+        # 全精度CPU母本: path -> {name: 组件对象}（分词器被领取后移出）
+        self._staged = {}
+        # 统计：实际读取checkpoint文件次数、命中次数、由已有副本转换的次数
+        self.file_loads = 0
+        self.hits = 0
+        self.conversions = 0
+        # 统计：卸载到CPU次数、从CPU恢复次数、彻底释放次数
+        self.offloads = 0
+        self.restores = 0
+        self.evictions = 0
+
+    def begin_session(self):
+        """开始一次模块执行，此后本线程取用的组件会被钉住"""
+        self._local.pinned = []
+
+    def end_session(self):
+        """结束模块执行，解除本线程钉住的组件"""
+        pinned = getattr(self._local, 'pinned', None)
+        if pinned is None:
+            return
+        with self._lock:
+            for key in pinned:
+                count = self._pins.get(key, 0) - 1
+                if count > 0:
+                    self._pins[key] = count
+                else:
+                    self._pins.pop(key, None)
+        self._local.pinned = None
+
+    def _pin(self, key):
+        """在当前会话中钉住组件（调用方需持有 self._lock）"""
+        pinned = getattr(self._local, 'pinned', None)
+        if pinned is None or key in pinned:
+            return
+        pinned.append(key)
+        self._pins[key] = self._pins.get(key, 0) + 1
+
+    def _touch(self, key):
+        """标记组件为最近使用并钉住（调用方需持有 self._lock）"""
+        self._components.move_to_end(key)
+        self._pin(key)
+
+    def _budgets(self):
+        """
+        计算当前预算
+        :return: (显存预算函数, 内存预算字节数或None)
+        """
+        vram_setting, ram_setting = _load_budget_settings()
+        vram = _parse_budget(vram_setting)
+        ram = _parse_budget(ram_setting)
+
+        def vram_budget(group):
+            if vram != 'auto':
+                return vram
+            # 自动：显卡总显存减去为激活值预留的部分；无法查询的设备不限制
+            if group.startswith('cuda') and torch.cuda.is_available():
+                try:
+                    index = int(group.split(':')[1])
+                    total = torch.cuda.get_device_properties(index).total_memory
+                    return max(total - AUTO_VRAM_RESERVE, 0)
+                except Exception:
+                    return None
+            return None
+
+        if ram == 'auto':
+            # 自动：物理内存的一半
+            total = _total_system_memory()
+            ram = total // 2 if total else None
+        return vram_budget, ram
+
+    def _used_bytes(self, group):
+        """统计某个设备上仓库组件占用的字节数（调用方需持有 self._lock）"""
+        used = sum(size for key, size in self._sizes.items() if _device_group(key[3]) == group)
+        if group == 'cpu':
+            used += sum(_component_bytes(comp) for parts in self._staged.values() for comp in parts.values())
+        return used
+
+    def _lru_victim(self, group):
+        """找出某个设备上最久未用且未被钉住的组件（调用方需持有 self._lock）"""
+        for key in self._components:
+            if _device_group(key[3]) == group and key not in self._pins and self._sizes.get(key, 0) > 0:
+                return key
+        return None
+
+    def _drop(self, key):
+        """彻底释放组件（调用方需持有 self._lock）"""
+        self._components.pop(key, None)
+        self._sizes.pop(key, None)
+        self._offloaded.discard(key)
+        self.evictions += 1
+        print(f"组件仓库: 释放 {os.path.basename(key[0])} 的 {key[1]} ({key[3]})")
+
+    def _offload(self, key):
+        """把组件卸载到CPU，CPU上已有同精度副本时直接释放（调用方需持有 self._lock）"""
+        path, name, dtype, device = key
+        cpu_key = (path, name, dtype, 'cpu')
+        if cpu_key in self._components:
+            self._components.pop(key)
+            self._sizes.pop(key, None)
+            self.evictions += 1
+            print(f"组件仓库: 释放 {os.path.basename(path)} 的 {name} ({device})，CPU上已有副本")
+            return
+        # 先移到CPU再从仓库中移除，移动失败时组件仍留在原条目下
+        component = self._components[key].to('cpu')
+        self._components.pop(key)
+        size = self._sizes.pop(key, 0)
+        self._components[cpu_key] = component
+        # 卸载的组件按最久未用处理，内存紧张时优先被释放
+        self._components.move_to_end(cpu_key, last=False)
+        self._sizes[cpu_key] = size
+        self._offloaded.add(cpu_key)
+        self.offloads += 1
+        print(f"组件仓库: 显存不足，卸载 {os.path.basename(path)} 的 {name} 到CPU")
+
+    def _return_offloaded(self, cpu_key, component):
+        """把从CPU恢复失败的组件放回原来的CPU条目（模块的 .to 可能只移动了一部分参数，先整体移回CPU）"""
+        try:
+            component = component.to('cpu')
+        except Exception as e:
+            print(f"组件仓库: 恢复失败的 {cpu_key[1]} 移回CPU时出错: {e}")
+            return
+        with self._lock:
+            if cpu_key in self._components:
+                return
+            self._components[cpu_key] = component
+            self._components.move_to_end(cpu_key, last=False)
+            self._sizes[cpu_key] = _component_bytes(component)
+            self._offloaded.add(cpu_key)
+
+    def _make_room(self, device, incoming_bytes):
+        """
+        为即将放到 device 上的组件腾出预算空间
+        显存不足时先卸载LRU组件到CPU；内存不足时先丢弃暂存组件，再释放LRU组件
+        """
+        # 分词器等不占显存/内存预算的组件无需腾空间
+        if device is None or incoming_bytes <= 0:
+            return
+        vram_budget, ram_budget = self._budgets()
+        group = _device_group(device)
+        changed = False
+        with self._lock:
+            if group != 'cpu':
+                budget = vram_budget(group)
+                while budget is not None and self._used_bytes(group) + incoming_bytes > budget:
+                    victim = self._lru_victim(group)
+                    if victim is None:
+                        print(f"组件仓库: {group} 上的组件都在使用中，暂时超出显存预算")
+                        break
+                    self._offload(victim)
+                    changed = True
+                incoming_ram = 0
+            else:
+                incoming_ram = incoming_bytes
+
+            while ram_budget is not None and self._used_bytes('cpu') + incoming_ram > ram_budget:
+                if self._staged:
+                    path = next(iter(self._staged))
+                    print(f"组件仓库: 内存不足，丢弃 {os.path.basename(path)} 的全精度母本")
+                    del self._staged[path]
+                    changed = True
+                    continue
+                victim = self._lru_victim('cpu')
+                if victim is None:
+                    print("组件仓库: CPU上的组件都在使用中，暂时超出内存预算")
+                    break
+                self._drop(victim)
+                changed = True
+        if changed:
+            _free_memory()
+
+    def _path_lock(self, path):
+        with self._lock:
+            if path not in self._path_locks:
+                self._path_locks[path] = threading.Lock()
+            return self._path_locks[path]
+
+    def _parse_checkpoint(self, path):
+        """按全精度解析checkpoint文件，返回 {组件名: 组件对象}（都在CPU上，fp32）"""
+        from diffusers import StableDiffusionPipeline
+
+        print(f"组件仓库: 解析checkpoint {path}")
+        try:
+            pipe = StableDiffusionPipeline.from_single_file(
+                path,
+                torch_dtype=torch.float32,
+                use_safetensors=True,
+                safety_checker=None,
+                requires_safety_checker=False,
+                local_files_only=True
+            )
+            components = {name: getattr(pipe, name) for name in COMPONENT_NAMES}
+            del pipe
+        except Exception as e:
+            # 单独的VAE文件无法作为完整checkpoint解析，退回只加载VAE
+            print(f"按完整checkpoint解析失败，尝试作为单独的VAE文件加载: {e}")
+            from diffusers import AutoencoderKL
+            vae = AutoencoderKL.from_single_file(
+                path,
+                torch_dtype=torch.float32,
+                use_safetensors=True,
+                local_files_only=True
+            )
+            components = {'vae': vae}
+
+        self.file_loads += 1
+        _free_memory()
+        return components
+
+    def _place(self, component, name, dtype, device):
+        """把组件移动到目标设备/精度，并切换到评估模式"""
+        if name == 'tokenizer':
+            return component
+        component = component.to(device=device, dtype=dtype)
+        component.eval()
+        return component
+
+    def _claim(self, path, name, master, dtype, device):
+        """
+        由CPU母本得到目标设备/精度的组件
+        分词器没有权重，直接移出母本交给调用方；其他组件复制一份再转换，母本保持全精度不被修改
+        """
+        if name == 'tokenizer':
+            with self._lock:
+                self._staged.get(path, {}).pop(name, None)
+                if path in self._staged and not self._staged[path]:
+                    del self._staged[path]
+            return master
+        self._make_room(device, _component_bytes(master, dtype))
+        return self._place(copy.deepcopy(master), name, dtype, device)
+
+    def get(self, path, name, dtype, device):
+        """
+        获取checkpoint中的某个组件
+        :param path: checkpoint文件路径
+        :param name: 组件名（unet/vae/text_encoder/tokenizer）
+        :param dtype: 目标数据类型
+        :param device: 目标设备字符串
+        :return: 组件对象
+        """
+        if name not in COMPONENT_NAMES:
+            raise ValueError(f"未知的组件: {name}")
+        path = os.path.normpath(path)
+        # 分词器与设备/精度无关
+        if name == 'tokenizer':
+            dtype, device = None, None
+        key = (path, name, dtype, str(device) if device is not None else None)
+
+        with self._lock:
+            if key in self._components:
+                self.hits += 1
+                self._touch(key)
+                return self._components[key]
+
+        with self._path_lock(path):
+            with self._lock:
+                if key in self._components:
+                    self.hits += 1
+                    self._touch(key)
+                    return self._components[key]
+                cpu_key = (path, name, key[2], 'cpu')
+                offloaded = (key[3] != 'cpu' and cpu_key in self._offloaded
+                             and cpu_key not in self._pins)
+                if offloaded:
+                    # 之前因显存不足卸载到CPU的组件，直接移回目标设备
+                    source = self._components.pop(cpu_key)
+                    self._sizes.pop(cpu_key, None)
+                    self._offloaded.discard(cpu_key)
+                master = None if offloaded else self._staged.get(path, {}).get(name)
+
+            if offloaded:
+                print(f"组件仓库: 从CPU恢复 {name} -> {device}")
+                try:
+                    self._make_room(device, _component_bytes(source, dtype))
+                    component = self._place(source, name, dtype, device)
+                except Exception:
+                    # 恢复失败时把组件放回CPU条目，不因为一次显存不足丢掉已加载的组件
+                    self._return_offloaded(cpu_key, source)
+                    raise
+                self.restores += 1
+            else:
+                if master is not None:
+                    # 母本仍在：复制转换，不重新读文件
+                    print(f"组件仓库: 由全精度母本转换 {name} -> {device}, {dtype}")
+                    self.conversions += 1
+                else:
+                    parsed = self._parse_checkpoint(path)
+                    if name not in parsed:
+                        raise ValueError(f"文件 {path} 中没有组件 {name}")
+                    master = parsed[name]
+                    with self._lock:
+                        self._staged[path] = parsed
+                component = self._claim(path, name, master, dtype, device)
+
+            with self._lock:
+                self._components[key] = component
+                self._sizes[key] = _component_bytes(component)
+                self._touch(key)
+            return component
+
+    def release(self, path=None):
+        """
+        释放组件（被钉住的组件除外）
+        :param path: 只释放该checkpoint的组件；为None时释放全部
+        """
+        with self._lock:
+            if path is not None:
+                path = os.path.normpath(path)
+            for key in [k for k in self._components if path is None or k[0] == path]:
+                if key in self._pins:
+                    continue
+                self._components.pop(key)
+                self._sizes.pop(key, None)
+                self._offloaded.discard(key)
+            if path is None:
+                self._staged.clear()
+            else:
+                self._staged.pop(path, None)
+        _free_memory()
+
+    def stats(self):
+        """返回仓库统计信息"""
+        vram_budget, ram_budget = self._budgets()
+        with self._lock:
+            groups = sorted({_device_group(k[3]) for k in self._components if k[3] is not None} | {'cpu'})
+            usage = {}
+            for group in groups:
+                budget = ram_budget if group == 'cpu' else vram_budget(group)
+                usage[group] = {'used_bytes': self._used_bytes(group), 'budget_bytes': budget}
+            return {
+                'file_loads': self.file_loads,
+                'hits': self.hits,
+                'conversions': self.conversions,
+                'offloads': self.offloads,
+                'restores': self.restores,
+                'evictions': self.evictions,
+                'usage': usage,
+                'components': [
+                    {'path': p, 'component': n, 'dtype': str(d) if d is not None else None, 'device': dev,
+                     'bytes': self._sizes.get((p, n, d, dev), 0),
+                     'pinned': (p, n, d, dev) in self._pins,
+                     'offloaded': (p, n, d, dev) in self._offloaded}
+                    for (p, n, d, dev) in self._components
+                ],
+                'staged': {p: sorted(parts) for p, parts in self._staged.items()}
+            }
+
+
+# 进程内唯一的组件仓库
+checkpoint_store = CheckpointComponentStore()
@@ -0,0 +1,132 @@
+"""
+模块头部索引
+功能：缓存每个模块文件的 #key=value 配置头部，只有文件变化（mtime或大小改变）时才重新解析
+- 模块库清单（/api/modules）直接由索引生成，并带有版本号（ETag），清单未变化时浏览器收到 304
+- 后台监视线程定时检查模块文件夹，新增、修改、删除的模块文件会自动反映到清单中
+- 执行模块、查看源代码时从索引读取参数，不再重复打开文件
+"""
+
+import os
+import hashlib
+import threading
+
+
+class ModuleIndex:
+    """
+    模块头部索引
+    parse_params 由 app.py 注入，签名为 parse_params(文件路径)，返回参数字典
+    directories 为 [(文件夹路径, 来源标记)]，排在后面的文件夹中的同名模块覆盖前面的
+    """
+
+    def __init__(self, parse_params, directories):
+        self.parse_params = parse_params
+        self.directories = directories
+        self._lock = threading.RLock()
+        # 文件绝对路径 -> {'mtime', 'size', 'params'}
+        self._entries = {}
+        self._manifest = {}
+        self._etag = None
+        self._watcher = None
+        # 统计：解析次数、命中次数、清单重建次数
+        self.parses = 0
+        self.hits = 0
+        self.rebuilds = 0
+
+    def _stat_key(self, abs_path):
+        stat = os.stat(abs_path)
+        return stat.st_mtime_ns, stat.st_size
+
+    def _entry(self, abs_path):
+        """获取文件的索引条目，文件变化时重新解析（调用方需持有 self._lock）"""
+        mtime, size = self._stat_key(abs_path)
+        entry = self._entries.get(abs_path)
+        if entry is not None and entry['mtime'] == mtime and entry['size'] == size:
+            self.hits += 1
+            return entry, False
+        entry = {'mtime': mtime, 'size': size, 'params': self.parse_params(abs_path)}
+        self._entries[abs_path] = entry
+        self.parses += 1
+        return entry, True
+
+    def scan(self):
+        """
+        检查模块文件夹，重新解析有变化的文件并重建清单
+        :return: 清单是否发生变化
+        """
+        with self._lock:
+            manifest = {}
+            seen = set()
+            changed = False
+            for directory, source in self.directories:
+                if not os.path.exists(directory):
+                    continue
+                for filename in sorted(os.listdir(directory)):
+                    if not filename.endswith('.py'):
+                        continue
+                    abs_path = os.path.abspath(os.path.join(directory, filename))
+                    try:
+                        entry, parsed = self._entry(abs_path)
+                    except OSError:
+                        # 文件在列目录之后被删除
+                        continue
+                    seen.add(abs_path)
+                    changed = changed or parsed
+                    params = dict(entry['params'])
+                    params['source'] = source  # 添加来源信息
+                    manifest[os.path.splitext(filename)[0]] = params
+            removed = set(self._entries) - seen
+            for abs_path in removed:
+                del self._entries[abs_path]
+            if changed or removed or self._etag is None:
+                self._manifest = manifest
+                digest = hashlib.sha1()
+                for abs_path in sorted(self._entries):
+                    entry = self._entries[abs_path]
+                    digest.update(f"{abs_path}|{entry['mtime']}|{entry['size']}\n".encode('utf-8'))
+                self._etag = digest.hexdigest()
+                self.rebuilds += 1
+                return True
+            return False
+
+    def manifest(self):
+        """返回 (模块清单, 版本号)；监视线程未启动时先检查一次文件夹"""
+        if self._watcher is None:
+            self.scan()
+        with self._lock:
+            return self._manifest, self._etag
+
+    def params(self, module_path):
+        """获取单个模块文件的参数（副本），文件变化时重新解析"""
+        abs_path = os.path.abspath(module_path)
+        with self._lock:
+            entry, _ = self._entry(abs_path)
+            return dict(entry['params'])
+
+    def start_watcher(self, interval=2.0):
+        """启动后台监视线程，定时检查模块文件夹的变化"""
+        if self._watcher is not None:
+            return
+        self.scan()
+
+        def watch():
+            stop = threading.Event()
+            while not stop.wait(interval):
+                try:
+                    if self.scan():
+                        print('模块文件夹有变化，已更新模块清单')
+                except Exception as e:
+                    print(f'检查模块文件夹失败: {e}')
+
+        self._watcher = threading.Thread(target=watch, daemon=True)
+        self._watcher.start()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'parses': self.parses,
+                'hits': self.hits,
+                'rebuilds': self.rebuilds,
+                'modules': len(self._manifest),
+                'etag': self._etag,
+                'watching': self._watcher is not None,
+            }
@@ -0,0 +1,107 @@
+"""
+模块注册表
+功能：每个模块文件只导入一次并常驻内存，只有文件发生变化时才重新导入
+这样模块内的 _model_cache 等模块级缓存可以在多次执行之间保留，第二次运行不再重复加载权重
+"""
+
+import os
+import hashlib
+import threading
+import importlib.util
+
+
+def _file_digest(file_path):
+    """计算文件内容的哈希值"""
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+
+class ModuleRegistry:
+    """
+    常驻模块注册表
+    以模块文件路径为键，记录模块对象、文件mtime、大小和内容哈希
+    - 命中(hit)：文件未变化，直接返回已导入的模块对象
+    - 未命中(miss)：第一次导入该模块
+    - 重新导入(reload)：文件内容发生变化，重新执行模块代码
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+
+    def _import(self, module_name, module_path):
+        spec = importlib.util.spec_from_file_location(module_name, module_path)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+        return module
+
+    def get(self, module_name, module_path):
+        """
+        获取模块对象，必要时导入或重新导入
+        :param module_name: 模块名称
+        :param module_path: 模块文件路径
+        :return: 模块对象
+        """
+        abs_path = os.path.abspath(module_path)
+        stat = os.stat(abs_path)
+        
+        with self._lock:
+            entry = self._entries.get(abs_path)
+            
+            if entry is not None:
+                # mtime和大小都没变，认为文件未变化
+                if entry['mtime'] == stat.st_mtime and entry['size'] == stat.st_size:
+                    self.hits += 1
+                    return entry['module']
+                
+                # mtime变了但内容没变（例如只是保存了一次），只更新记录
+                digest = _file_digest(abs_path)
+                if digest == entry['digest']:
+                    entry['mtime'] = stat.st_mtime
+                    entry['size'] = stat.st_size
+                    self.hits += 1
+                    return entry['module']
+                
+                print(f'模块文件已变化，重新导入: {module_name}')
+                module = self._import(module_name, abs_path)
+                self._release(entry['module'])
+                self.reloads += 1
+            else:
+                digest = _file_digest(abs_path)
+                print(f'首次导入模块: {module_name}')
+                module = self._import(module_name, abs_path)
+                self.misses += 1
+            
+            self._entries[abs_path] = {
+                'name': module_name,
+                'module': module,
+                'mtime': stat.st_mtime,
+                'size': stat.st_size,
+                'digest': digest
+            }
+            return module
+
+    def _release(self, old_module):
+        """旧模块被替换时，调用其清理函数释放模型缓存"""
+        cleaner = getattr(old_module, 'clean_model_cache', None)
+        if callable(cleaner):
+            try:
+                cleaner()
+            except Exception as e:
+                print(f'清理旧模块缓存失败: {e}')
+
+    def stats(self):
+        """返回命中/未命中/重新导入计数以及已常驻的模块列表"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'reloads': self.reloads,
+                'modules': sorted(entry['name'] for entry in self._entries.values())
+            }
@@ -0,0 +1,132 @@
+"""
+采样进度与实时预览
+功能：长时间运行的模块（K采样器）按步报告进度，进度事件经运行的进度通道推送到浏览器（SSE）
+- 每步报告：步数、速度（it/s）、预计剩余时间
+- 每隔若干步附带一张低分辨率预览图：把4个Latent通道线性投影到RGB，不经过VAE，几乎没有额外开销
+- 模块声明 progress_callback 参数时由 app.py 注入回调，签名为 progress_callback(当前步, 总步数, latents=None)，
+  模块只在需要预览的步传入 latents（间隔由模块设置决定）
+"""
+
+import io
+import time
+import base64
+import threading
+
+# SD1.x Latent通道到RGB的近似线性投影（每行对应一个Latent通道）
+LATENT_RGB_FACTORS = [
+    [0.3512, 0.2297, 0.3227],
+    [0.3250, 0.4974, 0.2350],
+    [-0.2829, 0.1762, 0.2721],
+    [-0.2120, -0.0256, -0.7187],
+]
+
+# 进度通道保留的事件数量（浏览器断线重连时从这里补发）
+CHANNEL_LIMIT = 200
+
+
+def latent_preview(latents, max_size=256):
+    """
+    Latent张量 -> 预览图（base64 PNG），只取批量中的第一张
+    :param latents: [B, 4, H, W] 或 [4, H, W]
+    :return: data:image/png;base64,... ；失败时返回None
+    """
+    try:
+        import torch
+        from PIL import Image
+        sample = latents[0] if latents.dim() == 4 else latents
+        if sample.shape[0] != len(LATENT_RGB_FACTORS):
+            return None
+        factors = torch.tensor(LATENT_RGB_FACTORS, dtype=torch.float32, device=sample.device)
+        with torch.no_grad():
+            rgb = torch.einsum('chw,cr->hwr', sample.float(), factors)
+            rgb = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8).cpu().numpy()
+        image = Image.fromarray(rgb)
+        # Latent分辨率只有原图的1/8，放大后更容易看清构图
+        scale = max(1, max_size // max(image.size))
+        if scale > 1:
+            image = image.resize((image.width * scale, image.height * scale), Image.NEAREST)
+        buffered = io.BytesIO()
+        image.save(buffered, format="PNG")
+        return f'data:image/png;base64,{base64.b64encode(buffered.getvalue()).decode("utf-8")}'
+    except Exception as e:
+        print(f'生成Latent预览失败: {e}')
+        return None
+
+
+class StepProgress:
+    """
+    模块内按步调用的进度回调
+    emit 为事件回调，事件类型为 module_progress
+    """
+
+    def __init__(self, emit, module_id=None, name=None):
+        self.emit = emit
+        self.module_id = module_id
+        self.name = name
+        self._start = None
+        self._start_step = 0
+
+    def __call__(self, step, total, latents=None):
+        """
+        :param step: 已完成的步数（从1开始）
+        :param total: 总步数
+        :param latents: 当前Latent，传入时附带预览图
+        """
+        now = time.time()
+        if self._start is None or step <= self._start_step:
+            # 第一次报告：从上一步结束算起，首步包含模型预热时间，不计入速度
+            self._start, self._start_step = now, step
+        elapsed = now - self._start
+        done = step - self._start_step
+        rate = done / elapsed if elapsed > 0 and done > 0 else 0.0
+        event = {'type': 'module_progress', 'module_id': self.module_id, 'name': self.name,
+                 'step': step, 'total': total, 'it_s': rate,
+                 'eta': (total - step) / rate if rate > 0 else None}
+        if latents is not None:
+            event['preview'] = latent_preview(latents)
+        try:
+            self.emit(event)
+        except Exception as e:
+            print(f'发送进度事件失败: {e}')
+
+
+class ProgressChannel:
+    """
+    一次运行的进度通道：模块线程发布事件，SSE 连接按序号读取
+    通道关闭（运行结束）后，读完剩余事件的连接随之结束
+    """
+
+    def __init__(self, limit=CHANNEL_LIMIT):
+        self._cond = threading.Condition()
+        self._events = []
+        self._offset = 0
+        self._limit = limit
+        self.closed = False
+
+    def publish(self, event):
+        with self._cond:
+            if self.closed:
+                return
+            self._events.append(event)
+            if len(self._events) > self._limit:
+                drop = len(self._events) - self._limit
+                del self._events[:drop]
+                self._offset += drop
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+    def read(self, since=0, timeout=15):
+        """
+        读取第 since 个之后的事件，没有新事件时等待（最多 timeout 秒）
+        :return: (事件列表, 下一个序号, 通道是否已关闭)
+        """
+        with self._cond:
+            if self._offset + len(self._events) <= since and not self.closed:
+                self._cond.wait(timeout)
+            start = max(0, since - self._offset)
+            events = self._events[start:]
+            return events, self._offset + len(self._events), self.closed
@@ -0,0 +1,109 @@
+"""
+采样器基准测试
+功能：固定种子和提示词，用注册表中的每个采样器在其推荐步数下生成一次，报告耗时和与参考结果的差距
+- 参考结果：Euler + karras 50步（认为已收敛）
+- 质量指标：解码后图像与参考图像的 PSNR（越高越接近参考）；祖先采样/SDE 每步注入新噪声，不会收敛到参考，PSNR 只作参考
+用法（在项目目录下运行）：
+    python -m core.sampler_benchmark 模型文件路径 --prompt "a beautiful cat" --seed 42 --size 512
+"""
+
+import time
+import argparse
+
+import torch
+
+from core.model_store import checkpoint_store
+from core.sampling import SAMPLERS, create_scheduler, CFGPredictor
+
+REFERENCE = ('euler', 'karras', 50)
+
+
+def _encode(checkpoint_path, prompt, device, dtype):
+    text_encoder = checkpoint_store.get(checkpoint_path, 'text_encoder', dtype, device)
+    tokenizer = checkpoint_store.get(checkpoint_path, 'tokenizer', dtype, device)
+    embeds = []
+    for text in ("", prompt):
+        tokens = tokenizer(text, padding="max_length", max_length=tokenizer.model_max_length,
+                           truncation=True, return_tensors="pt")
+        with torch.no_grad():
+            embeds.append(text_encoder(tokens.input_ids.to(device))[0].to(dtype))
+    return embeds[1], embeds[0]
+
+
+def _sample(unet, scheduler, noise, positive, negative, cfg_scale):
+    """文生图采样循环（与K采样器相同的CFG计算，不含遮罩逻辑）"""
+    latents = noise * scheduler.init_noise_sigma
+    predictor = CFGPredictor(unet, positive, negative, cfg_scale)
+    with torch.no_grad():
+        for t in scheduler.timesteps:
+            model_input = scheduler.scale_model_input(latents, t)
+            noise_pred = predictor(model_input, t)
+            latents = scheduler.step(noise_pred, t, latents).prev_sample
+    return latents
+
+
+def _decode(vae, latents):
+    with torch.no_grad():
+        image = vae.decode(latents / vae.config.scaling_factor).sample
+    return (image / 2 + 0.5).clamp(0, 1).float()
+
+
+def _psnr(image, reference):
+    mse = torch.mean((image - reference) ** 2).item()
+    return float('inf') if mse == 0 else 10 * torch.log10(torch.tensor(1.0 / mse)).item()
+
+
+def benchmark(checkpoint_path, prompt="a beautiful cat", seed=42, size=512, cfg_scale=7.0,
+              samplers=None, schedule="karras"):
+    """
+    运行基准测试
+    :return: [{'sampler', 'schedule', 'steps', 'seconds', 'psnr'}]
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    dtype = torch.float16 if device == "cuda" else torch.float32
+    unet = checkpoint_store.get(checkpoint_path, 'unet', dtype, device)
+    vae = checkpoint_store.get(checkpoint_path, 'vae', dtype, device)
+    positive, negative = _encode(checkpoint_path, prompt, device, dtype)
+    generator = torch.Generator(device="cpu").manual_seed(seed)
+    noise = torch.randn((1, 4, size // 8, size // 8), generator=generator).to(device=device, dtype=dtype)
+
+    def run(sampler_name, schedule_name, steps):
+        scheduler = create_scheduler(sampler_name, schedule_name, steps, device)
+        torch.manual_seed(seed)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        latents = _sample(unet, scheduler, noise, positive, negative,
+                          SAMPLERS[sampler_name]['cfg'][1] if SAMPLERS[sampler_name]['cfg'] else cfg_scale)
+        if device == "cuda":
+            torch.cuda.synchronize()
+        return latents, time.perf_counter() - start
+
+    print(f"生成参考结果: {REFERENCE[0]} + {REFERENCE[1]} {REFERENCE[2]}步")
+    reference_latents, _ = run(*REFERENCE)
+    reference = _decode(vae, reference_latents)
+
+    results = []
+    for name in samplers or SAMPLERS:
+        steps = SAMPLERS[name]['steps'][1]
+        latents, seconds = run(name, schedule, steps)
+        results.append({'sampler': name, 'schedule': schedule, 'steps': steps, 'seconds': seconds,
+                        'psnr': _psnr(_decode(vae, latents), reference)})
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="采样器基准测试")
+    parser.add_argument("checkpoint", help="checkpoint文件路径")
+    parser.add_argument("--prompt", default="a beautiful cat")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--size", type=int, default=512)
+    parser.add_argument("--cfg", type=float, default=7.0)
+    parser.add_argument("--schedule", default="karras")
+    parser.add_argument("--samplers", nargs="*", help="只测试这些采样器")
+    args = parser.parse_args()
+
+    rows = benchmark(args.checkpoint, args.prompt, args.seed, args.size, args.cfg, args.samplers, args.schedule)
+    print(f"\n{'采样器':<18}{'步数':>6}{'耗时(秒)':>12}{'PSNR(dB)':>12}")
+    for row in rows:
+        print(f"{SAMPLERS[row['sampler']]['label']:<18}{row['steps']:>6}{row['seconds']:>12.2f}{row['psnr']:>12.2f}")
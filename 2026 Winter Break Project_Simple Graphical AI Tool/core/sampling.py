@@ -0,0 +1,313 @@
+"""
+采样工具
+功能一：批量CFG。K采样器一次处理一批Latent和多组条件（正面/负面文本向量），每个采样步只做一次（或按微批做几次）UNet推理
+- 条件与Latent的批量对齐规则见 align_batch
+- 每个微批把负面条件和正面条件拼在一起送入UNet，输出再按CFG公式合成
+功能二：调度器工厂。按 (采样器, 调度器, 步数, 设备) 缓存已计算好时间步/sigma表的调度器模板，
+每次运行复制一份并重置步进状态，多个任务可以同时采样而不共享可变状态
+功能三：采样器注册表。每个采样器声明推荐步数和CFG范围，前端据此提供步数预设
+功能四：采样循环的预计算。遮罩混合的背景项、CFG的拼接条件在循环外只算一次，UNet输入使用预分配的缓冲区
+"""
+
+import copy
+import inspect
+import threading
+
+import torch
+import torch.nn.functional as F
+
+
+def stack_conditioning(embeds):
+    """
+    把条件输入整理成一个批量张量
+    :param embeds: 文本向量张量 [N, T, D] / [T, D]，或多个文本向量组成的列表（多连一时）
+    :return: [N, T, D] 张量，无法识别时返回None
+    """
+    if isinstance(embeds, torch.Tensor):
+        return embeds.unsqueeze(0) if embeds.dim() == 2 else embeds
+    if isinstance(embeds, (list, tuple)):
+        tensors = [stack_conditioning(e) for e in embeds]
+        tensors = [t for t in tensors if t is not None]
+        if tensors:
+            return torch.cat(tensors)
+    return None
+
+
+def _repeat_to(tensor, size):
+    """把批量维度为1或能整除size的张量重复到size"""
+    if tensor.shape[0] == size:
+        return tensor
+    return tensor.repeat_interleave(size // tensor.shape[0], dim=0)
+
+
+def align_batch(latents, positive, negative):
+    """
+    对齐Latent批量和条件批量
+    - 条件只有1组：广播到每个Latent
+    - Latent只有1个、条件有N组：Latent复制N份，每组条件生成一张
+    - Latent批量是条件组数的整数倍：每组条件依次对应连续的 B/N 个Latent
+    - 负面条件只有1组时广播到所有正面条件
+    :return: (latents, positive, negative)，三者批量相同
+    """
+    if negative.shape[0] != positive.shape[0]:
+        if negative.shape[0] == 1:
+            negative = _repeat_to(negative, positive.shape[0])
+        elif positive.shape[0] == 1:
+            positive = _repeat_to(positive, negative.shape[0])
+        else:
+            raise ValueError(f"正面条件({positive.shape[0]}组)与负面条件({negative.shape[0]}组)数量不一致")
+
+    batch, pairs = latents.shape[0], positive.shape[0]
+    if batch == 1 and pairs > 1:
+        latents = _repeat_to(latents, pairs)
+    elif batch % pairs == 0:
+        positive = _repeat_to(positive, batch)
+        negative = _repeat_to(negative, batch)
+    else:
+        raise ValueError(f"Latent批量({batch})不是条件组数({pairs})的整数倍")
+    return latents, positive, negative
+
+
+class CFGPredictor:
+    """
+    批量CFG噪声预测（采样循环内重复调用）
+    - 每个微批的 [负面; 正面] 条件在构造时拼好，各步相同，不再每步拼接
+    - UNet输入 [Latent; Latent] 写入预分配的缓冲区，每步只做两次复制
+    - CFG合成用一次 lerp：uncond + cfg * (text - uncond)
+    """
+
+    def __init__(self, unet, positive, negative, cfg_scale, micro_batch=0, memory_format=torch.contiguous_format):
+        """
+        :param positive: 正面条件 [B, T, D]（已与Latent批量对齐）
+        :param negative: 负面条件 [B, T, D]
+        :param micro_batch: 每次UNet推理处理的Latent数量，0表示整批一次推理
+        :param memory_format: UNet输入缓冲区的内存格式（UNet使用 channels_last 时传 torch.channels_last）
+        """
+        batch = positive.shape[0]
+        step = batch if not micro_batch or micro_batch <= 0 else min(int(micro_batch), batch)
+        self.unet = unet
+        self.cfg_scale = float(cfg_scale)
+        self.memory_format = memory_format
+        self.chunks = [(start, min(start + step, batch)) for start in range(0, batch, step)]
+        self.hidden_states = [torch.cat([negative[start:end], positive[start:end]]) for start, end in self.chunks]
+        # 微批大小 -> UNet输入缓冲区 [2 * 微批, C, H, W]
+        self._buffers = {}
+
+    def _input_buffer(self, chunk):
+        size = chunk.shape[0]
+        buffer = self._buffers.get(size)
+        if (buffer is None or buffer.shape[1:] != chunk.shape[1:]
+                or buffer.dtype != chunk.dtype or buffer.device != chunk.device):
+            buffer = torch.empty((2 * size,) + tuple(chunk.shape[1:]), dtype=chunk.dtype, device=chunk.device,
+                                 memory_format=self.memory_format)
+            self._buffers[size] = buffer
+        buffer[:size].copy_(chunk)
+        buffer[size:].copy_(chunk)
+        return buffer
+
+    def __call__(self, scaled_latents, timestep):
+        """
+        :param scaled_latents: 已经过 scheduler.scale_model_input 的Latent [B, C, H, W]
+        :return: CFG合成后的噪声预测 [B, C, H, W]
+        """
+        predictions = []
+        for (start, end), hidden_states in zip(self.chunks, self.hidden_states):
+            model_input = self._input_buffer(scaled_latents[start:end])
+            noise_pred = self.unet(model_input, timestep, encoder_hidden_states=hidden_states).sample
+            noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
+            predictions.append(torch.lerp(noise_pred_uncond, noise_pred_text, self.cfg_scale))
+        return predictions[0] if len(predictions) == 1 else torch.cat(predictions)
+
+
+def cfg_noise_prediction(unet, scaled_latents, timestep, positive, negative, cfg_scale, micro_batch=0):
+    """
+    批量CFG噪声预测（单次调用；采样循环中请直接复用 CFGPredictor）
+    :param scaled_latents: 已经过 scheduler.scale_model_input 的Latent [B, C, H, W]
+    :param positive: 正面条件 [B, T, D]
+    :param negative: 负面条件 [B, T, D]
+    :param micro_batch: 每次UNet推理处理的Latent数量，0表示整批一次推理
+    :return: CFG合成后的噪声预测 [B, C, H, W]
+    """
+    return CFGPredictor(unet, positive, negative, cfg_scale, micro_batch)(scaled_latents, timestep)
+
+
+# ====================== 遮罩混合 ======================
+# 遮罩的缩放、模糊和缓存见 core/image_io.py 的 latent_mask
+
+
+class MaskBlend:
+    """
+    遮罩混合 mask * x + (1 - mask) * original
+    背景项 (1 - mask) * original 构造时算一次，之后每次混合是一次 addcmul
+    遮罩只有0和1时混合是幂等的（混合过的Latent再混合结果不变），binary 为True时采样循环可以跳过UNet前的混合
+    """
+
+    def __init__(self, mask, original):
+        self.mask = mask
+        self.background = (1 - mask) * original
+        self.binary = bool(((mask == 0) | (mask == 1)).all())
+
+    def __call__(self, x):
+        return torch.addcmul(self.background, self.mask, x)
+
+
+# ====================== 调度器工厂 ======================
+
+# 所有调度器共用的噪声表参数（SD1.x）
+_BASE_CONFIG = dict(
+    num_train_timesteps=1000,
+    beta_start=0.00085,
+    beta_end=0.012,
+    beta_schedule="scaled_linear",
+    steps_offset=1,
+)
+
+# 调度器模板缓存：(采样器, 调度器, 步数, 设备) -> 已调用过 set_timesteps 的调度器
+_templates = {}
+_templates_lock = threading.Lock()
+
+# 统计：模板创建次数、命中次数
+template_stats = {'builds': 0, 'hits': 0}
+
+
+# 采样器注册表
+# class 为 diffusers 中的调度器类名；kwargs 为该采样器的额外参数；
+# steps 为推荐步数 (最少, 默认, 最多)；cfg 为推荐CFG范围（None表示不限）
+SAMPLERS = {
+    'euler': {
+        'label': 'Euler', 'class': 'EulerDiscreteScheduler', 'kwargs': {},
+        'steps': (20, 25, 40), 'cfg': None,
+        'description': '稳定、通用，步数增加时结果收敛',
+    },
+    'euler_ancestral': {
+        'label': 'Euler a', 'class': 'EulerAncestralDiscreteScheduler', 'kwargs': {},
+        'steps': (20, 25, 40), 'cfg': None,
+        'description': '祖先采样，每步注入新噪声，细节多但不收敛',
+    },
+    'ddim': {
+        'label': 'DDIM', 'class': 'DDIMScheduler',
+        'kwargs': {'clip_sample': False, 'set_alpha_to_one': False, 'prediction_type': 'epsilon'},
+        'steps': (25, 30, 50), 'cfg': None,
+        'description': '确定性采样，适合图生图',
+    },
+    'dpmpp_2m': {
+        'label': 'DPM++ 2M', 'class': 'DPMSolverMultistepScheduler',
+        'kwargs': {'prediction_type': 'epsilon', 'solver_type': 'midpoint', 'algorithm_type': 'dpmsolver++'},
+        'steps': (15, 20, 30), 'cfg': None,
+        'description': '二阶多步求解器，配合karras在较少步数下质量最好',
+    },
+    'dpmpp_2m_sde': {
+        'label': 'DPM++ 2M SDE', 'class': 'DPMSolverMultistepScheduler',
+        'kwargs': {'prediction_type': 'epsilon', 'solver_type': 'midpoint', 'algorithm_type': 'sde-dpmsolver++'},
+        'steps': (20, 25, 40), 'cfg': None,
+        'description': 'SDE版本，细节更丰富，需要的步数略多',
+    },
+    'unipc': {
+        'label': 'UniPC', 'class': 'UniPCMultistepScheduler',
+        'kwargs': {'prediction_type': 'epsilon'},
+        'steps': (8, 12, 20), 'cfg': None,
+        'description': '预测-校正多步求解器，10步左右即可出图',
+    },
+    'lcm': {
+        'label': 'LCM', 'class': 'LCMScheduler',
+        'kwargs': {'prediction_type': 'epsilon', 'clip_sample': False, 'set_alpha_to_one': True},
+        'steps': (4, 6, 8), 'cfg': (1.0, 2.0),
+        'description': '需要LCM蒸馏模型或LCM-LoRA，4~8步出图，CFG保持在1~2',
+    },
+}
+
+DEFAULT_SAMPLER = 'euler'
+
+# sigma调度：参数名为调度器构造函数中的开关，None表示使用默认时间步
+SCHEDULES = {
+    'simple': None,
+    'karras': 'use_karras_sigmas',
+    'exponential': 'use_exponential_sigmas',
+}
+
+
+def sampler_info(sampler_name):
+    """返回采样器的注册信息，未注册的名称回退到默认采样器"""
+    name = (sampler_name or DEFAULT_SAMPLER).lower()
+    if name not in SAMPLERS:
+        print(f"未注册的采样器 {sampler_name}，使用 {DEFAULT_SAMPLER}")
+        name = DEFAULT_SAMPLER
+    return name, SAMPLERS[name]
+
+
+def list_samplers():
+    """返回采样器列表（供前端下拉菜单和步数预设使用）"""
+    return [{'name': name, 'label': info['label'], 'steps': list(info['steps']),
+             'cfg': list(info['cfg']) if info['cfg'] else None, 'description': info['description']}
+            for name, info in SAMPLERS.items()]
+
+
+def check_sampling_settings(sampler_name, steps, cfg_scale):
+    """检查步数和CFG是否在采样器推荐范围内，不在范围内时打印提示"""
+    name, info = sampler_info(sampler_name)
+    low, default, high = info['steps']
+    if steps < low or steps > high:
+        print(f"提示: {info['label']} 推荐步数 {low}~{high}（默认 {default}），当前 {steps}")
+    if info['cfg'] and not (info['cfg'][0] <= cfg_scale <= info['cfg'][1]):
+        print(f"提示: {info['label']} 推荐CFG {info['cfg'][0]}~{info['cfg'][1]}，当前 {cfg_scale}")
+
+
+def _build_scheduler(sampler_name, scheduler_name):
+    """根据采样器注册表和sigma调度创建调度器（未设置时间步）"""
+    import diffusers
+    name, info = sampler_info(sampler_name)
+    scheduler_class = getattr(diffusers, info['class'])
+    kwargs = dict(_BASE_CONFIG, **info['kwargs'])
+    switch = SCHEDULES.get(scheduler_name)
+    if scheduler_name not in SCHEDULES:
+        print(f"未知的调度器 {scheduler_name}，使用默认时间步")
+    elif switch is not None:
+        if switch in inspect.signature(scheduler_class.__init__).parameters:
+            kwargs[switch] = True
+        else:
+            print(f"采样器 {info['label']} 不支持 {scheduler_name} 调度，使用默认时间步")
+    return scheduler_class(**kwargs)
+
+
+def _reset_run_state(scheduler):
+    """重置调度器的步进状态（步进索引、多步求解器的历史输出等）"""
+    for name, value in (('_step_index', None), ('_begin_index', None), ('is_scale_input_called', False),
+                        ('lower_order_nums', 0), ('last_sample', None), ('this_order', None)):
+        if hasattr(scheduler, name):
+            setattr(scheduler, name, value)
+    if hasattr(scheduler, 'model_outputs'):
+        scheduler.model_outputs = [None] * scheduler.config.solver_order
+    if hasattr(scheduler, 'timestep_list'):
+        scheduler.timestep_list = [None] * scheduler.config.solver_order
+
+
+def create_scheduler(sampler_name, scheduler_name, steps, device):
+    """
+    获取本次运行使用的调度器
+    时间步/sigma表来自缓存的模板（只计算一次），返回的调度器是模板的独立副本，步进状态已重置
+    :param sampler_name: 采样器名称（见 SAMPLERS）
+    :param scheduler_name: sigma调度名称（见 SCHEDULES）
+    """
+    sampler_name, _ = sampler_info(sampler_name)
+    scheduler_name = (scheduler_name or "simple").lower()
+    key = (sampler_name, scheduler_name, int(steps), str(device))
+    with _templates_lock:
+        template = _templates.get(key)
+        if template is None:
+            print(f"创建调度器模板: 采样器={sampler_name}, 调度器={scheduler_name}, 步数={steps}")
+            template = _build_scheduler(sampler_name, scheduler_name)
+            template.set_timesteps(int(steps), device=device)
+            _templates[key] = template
+            template_stats['builds'] += 1
+        else:
+            template_stats['hits'] += 1
+    # 浅复制：时间步/sigma等表与模板共享（只读），可变状态逐项重置
+    scheduler = copy.copy(template)
+    _reset_run_state(scheduler)
+    return scheduler
+
+
+def clear_scheduler_templates():
+    """清空调度器模板缓存"""
+    with _templates_lock:
+        _templates.clear()
@@ -0,0 +1,75 @@
+"""
+设置服务
+功能：所有模块和后端组件共享的 gui_settings.json 读取
+- 只在文件的修改时间或大小变化时重新解析，其余调用只做一次 os.stat
+- 每次重新解析后版本号加一，依赖设置的缓存（例如设备策略）按版本号失效
+- 文件不存在或解析失败时返回空设置（解析失败时保留上一次成功读取的设置）
+"""
+
+import os
+import json
+import threading
+
+SETTINGS_FILE_NAME = "gui_settings.json"
+
+
+class SettingsService:
+    def __init__(self, path=None):
+        """
+        :param path: 设置文件路径，不传时使用当前工作目录下的 gui_settings.json（每次检查时按当前目录解析）
+        """
+        self._path = path
+        self._lock = threading.Lock()
+        self._settings = {}
+        self._signature = None
+        self.version = 0
+        self.loads = 0
+
+    @property
+    def path(self):
+        return self._path or os.path.join(os.getcwd(), SETTINGS_FILE_NAME)
+
+    def _refresh(self):
+        """文件有变化时重新读取（调用方需持有 self._lock）"""
+        path = self.path
+        try:
+            stat = os.stat(path)
+            signature = (path, stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            signature = (path, None, None)
+        if signature == self._signature:
+            return
+        self._signature = signature
+        if signature[1] is None:
+            self._settings = {}
+        else:
+            try:
+                with open(path, 'r', encoding='utf-8') as f:
+                    self._settings = json.load(f)
+                self.loads += 1
+            except Exception as e:
+                # GUI 保存设置时可能读到写了一半的文件：保留上一次的设置，文件写完（大小/修改时间变化）后重新读取
+                print(f"读取设置失败: {e}")
+                return
+        self.version += 1
+
+    def get(self):
+        """
+        返回当前设置字典（只读，调用方不要修改）
+        """
+        with self._lock:
+            self._refresh()
+            return self._settings
+
+    def value(self, key, default=None):
+        return self.get().get(key, default)
+
+    def current_version(self):
+        """检查文件后返回版本号"""
+        with self._lock:
+            self._refresh()
+            return self.version
+
+
+# 全局共享的设置服务
+settings_service = SettingsService()
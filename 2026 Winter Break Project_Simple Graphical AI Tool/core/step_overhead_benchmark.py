@@ -0,0 +1,133 @@
+"""
+采样循环开销微基准
+功能：在CPU上用一个极小的假UNet测量每个采样步在UNet调用之外的开销（遮罩混合、CFG拼接、设备/精度转换等）
+- 旧循环：每步两次 original.to()、两次完整的遮罩混合、每步拼接Latent和条件
+- 新循环：预计算背景项的 MaskBlend + 复用输入缓冲区的 CFGPredictor
+- 新循环（二值遮罩）：遮罩未模糊时跳过UNet前的混合
+假UNet和假调度器只做一次逐元素运算，两种循环的这部分耗时相同，报告中已扣除UNet调用时间
+用法（在项目目录下运行）：
+    python -m core.step_overhead_benchmark --batch 4 --size 64 --steps 50
+"""
+
+import time
+import argparse
+from types import SimpleNamespace
+
+import torch
+
+from core.sampling import CFGPredictor, MaskBlend
+from core.image_io import latent_mask
+
+
+class DummyUNet:
+    """只做一次逐元素运算的假UNet，记录调用耗时"""
+
+    def __init__(self):
+        self.elapsed = 0.0
+
+    def __call__(self, sample, timestep, encoder_hidden_states=None):
+        start = time.perf_counter()
+        output = sample * 0.9
+        self.elapsed += time.perf_counter() - start
+        return SimpleNamespace(sample=output)
+
+
+class DummyScheduler:
+    """固定步长的假调度器"""
+
+    def scale_model_input(self, sample, timestep):
+        return sample
+
+    def step(self, noise_pred, timestep, sample):
+        return SimpleNamespace(prev_sample=sample - 0.05 * noise_pred)
+
+
+def legacy_loop(unet, scheduler, latents, original, mask4, positive, negative, cfg_scale, steps, device, dtype):
+    """优化前的采样循环（逐行对应原K采样器模块）"""
+    for t in range(steps):
+        current = mask4 * latents + (1 - mask4) * original.to(device, dtype)
+        model_input = scheduler.scale_model_input(current, t)
+        noise_pred = unet(torch.cat([model_input, model_input]), t,
+                          encoder_hidden_states=torch.cat([negative, positive])).sample
+        uncond, text = noise_pred.chunk(2)
+        noise_pred = uncond + cfg_scale * (text - uncond)
+        new_latents = scheduler.step(noise_pred, t, current).prev_sample
+        latents = mask4 * new_latents + (1 - mask4) * original.to(device, dtype)
+    return latents
+
+
+def optimized_loop(unet, scheduler, latents, mask_blend, positive, negative, cfg_scale, steps):
+    """优化后的采样循环（与K采样器模块相同）"""
+    predictor = CFGPredictor(unet, positive, negative, cfg_scale)
+    blended = False
+    for t in range(steps):
+        current = latents
+        if not (mask_blend.binary and blended):
+            current = mask_blend(latents)
+        noise_pred = predictor(scheduler.scale_model_input(current, t), t)
+        latents = mask_blend(scheduler.step(noise_pred, t, current).prev_sample)
+        blended = True
+    return latents
+
+
+def _measure(run, unet, steps, repeat):
+    best = None
+    for _ in range(repeat):
+        unet.elapsed = 0.0
+        start = time.perf_counter()
+        run()
+        total = time.perf_counter() - start
+        overhead = (total - unet.elapsed) / steps
+        best = overhead if best is None else min(best, overhead)
+    return best
+
+
+def benchmark(batch=4, size=64, steps=50, repeat=5, cfg_scale=7.0, threads=None):
+    """
+    :return: {'legacy', 'optimized', 'optimized_binary'}：每步UNet之外的开销（秒，取 repeat 次中的最小值）
+    """
+    if threads:
+        torch.set_num_threads(threads)
+    device, dtype = "cpu", torch.float32
+    generator = torch.Generator().manual_seed(0)
+    latents = torch.randn((batch, 4, size, size), generator=generator)
+    original = torch.randn((batch, 4, size, size), generator=generator)
+    positive = torch.randn((batch, 77, 768), generator=generator)
+    negative = torch.randn((batch, 77, 768), generator=generator)
+    raw_mask = torch.zeros((1, 1, size, size))
+    raw_mask[:, :, size // 4: size * 3 // 4, size // 4: size * 3 // 4] = 1.0
+
+    unet, scheduler = DummyUNet(), DummyScheduler()
+    soft_mask = latent_mask(raw_mask, size, size, device, dtype, 2.0)
+    binary_mask = latent_mask(raw_mask, size, size, device, dtype, 0.0)
+    mask4 = soft_mask.repeat(1, 4, 1, 1)
+
+    # 结果一致性检查（软遮罩下新旧循环数学上相同）
+    reference = legacy_loop(unet, scheduler, latents, original, mask4, positive, negative, cfg_scale, 3, device, dtype)
+    result = optimized_loop(unet, scheduler, latents, MaskBlend(soft_mask, original), positive, negative, cfg_scale, 3)
+    print(f"新旧循环最大误差: {(reference - result).abs().max().item():.2e}")
+
+    return {
+        'legacy': _measure(lambda: legacy_loop(unet, scheduler, latents, original, mask4, positive, negative,
+                                               cfg_scale, steps, device, dtype), unet, steps, repeat),
+        'optimized': _measure(lambda: optimized_loop(unet, scheduler, latents, MaskBlend(soft_mask, original),
+                                                     positive, negative, cfg_scale, steps), unet, steps, repeat),
+        'optimized_binary': _measure(lambda: optimized_loop(unet, scheduler, latents, MaskBlend(binary_mask, original),
+                                                            positive, negative, cfg_scale, steps), unet, steps, repeat),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="采样循环开销微基准（CPU，假UNet）")
+    parser.add_argument("--batch", type=int, default=4)
+    parser.add_argument("--size", type=int, default=64, help="Latent边长（512图像对应64）")
+    parser.add_argument("--steps", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    results = benchmark(args.batch, args.size, args.steps, args.repeat, threads=args.threads)
+    labels = {'legacy': '旧循环', 'optimized': '新循环', 'optimized_binary': '新循环（二值遮罩）'}
+    print(f"\n批量 {args.batch}，Latent {args.size}x{args.size}，每步UNet之外的开销：")
+    for key, seconds in results.items():
+        print(f"  {labels[key]:<12}{seconds * 1000:>8.3f} ms/步  ({results['legacy'] / seconds:.2f}x)")
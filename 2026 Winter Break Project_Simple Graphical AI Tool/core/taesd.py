@@ -0,0 +1,68 @@
+"""
+草稿模式（TAESD 预览解码器）
+功能：用只有约百万参数的近似VAE（TAESD，diffusers 的 AutoencoderTiny）代替完整VAE做编码/解码，
+速度比完整VAE快一个数量级，画质为预览级，适合连续运行和快速调整参数
+- 每个节点可选：跟随设置 / 完整 / 草稿；跟随设置时由高级设置中的「草稿模式」开关决定
+- 模型优先从模型文件夹下的 taesd 目录（或 vae_approx/taesd）加载，没有时从镜像下载 madebyollin/taesd
+- 同一设备/精度只加载一次
+- TAESD 直接在缩放后的Latent空间工作（scaling_factor 为 1），与完整VAE用同一套缩放代码即可
+"""
+
+import os
+import threading
+
+QUALITY_OPTIONS = ["跟随设置", "完整", "草稿"]
+
+TAESD_REPO = "madebyollin/taesd"
+
+# (设备, 精度) -> AutoencoderTiny
+_tiny_vaes = {}
+_lock = threading.Lock()
+
+
+def draft_enabled(quality, settings):
+    """
+    节点上的质量选项 -> 是否使用草稿解码器
+    :param quality: 跟随设置 / 完整 / 草稿（空值视为跟随设置）
+    :param settings: 当前设置字典
+    """
+    if quality == "草稿":
+        return True
+    if quality == "完整":
+        return False
+    return bool(settings.get("草稿模式", False))
+
+
+def _local_taesd_dir(settings):
+    folder = settings.get("模型文件夹路径") or os.path.join(os.getcwd(), "models")
+    for candidate in (os.path.join(folder, "taesd"), os.path.join(folder, "vae_approx", "taesd")):
+        if os.path.isfile(os.path.join(candidate, "config.json")):
+            return candidate
+    return None
+
+
+def load_tiny_vae(device, dtype, settings):
+    """
+    获取指定设备/精度上的 TAESD（评估模式）
+    """
+    key = (str(device), dtype)
+    with _lock:
+        tiny = _tiny_vaes.get(key)
+        if tiny is not None:
+            return tiny
+        from diffusers import AutoencoderTiny
+
+        source = _local_taesd_dir(settings)
+        if source is None:
+            print(f"模型文件夹中没有 taesd 目录，从镜像下载 {TAESD_REPO}")
+            source = TAESD_REPO
+        print(f"加载草稿解码器: {source} ({device}, {dtype})")
+        tiny = AutoencoderTiny.from_pretrained(source, torch_dtype=dtype).to(device).eval()
+        _tiny_vaes[key] = tiny
+        return tiny
+
+
+def release_tiny_vaes():
+    """释放已加载的 TAESD"""
+    with _lock:
+        _tiny_vaes.clear()
@@ -0,0 +1,105 @@
+"""
+草稿解码器基准
+功能：比较完整VAE与 TAESD 的编码/解码耗时，以及解码结果的 PSNR
+- 测试图像先用完整VAE编码（取分布均值），同一份Latent分别用完整VAE和 TAESD 解码
+- PSNR 分别相对原图和相对完整VAE的解码结果计算（像素取值 [0, 1]）
+- 设备、精度按当前 gui_settings.json 解析（与VAE解码模块相同）；不传 --image 时使用合成的渐变测试图
+用法（在项目目录下运行）：
+    python -m core.taesd_benchmark 模型文件路径 --image 图片路径 --size 512 --iters 5
+"""
+
+import time
+import argparse
+import statistics
+
+import torch
+
+from core.model_store import checkpoint_store
+from core.device_policy import load_device_policy, prepare_model
+from core.settings_service import settings_service
+from core.taesd import load_tiny_vae
+
+
+def _test_image(path, size):
+    """:return: 图像张量 [1, 3, size, size]，取值 [-1, 1]"""
+    if path:
+        import numpy as np
+        from PIL import Image
+
+        image = Image.open(path).convert("RGB").resize((size, size), Image.Resampling.LANCZOS)
+        array = torch.from_numpy(np.asarray(image, dtype=np.float32) / 255.0)
+        return array.permute(2, 0, 1).unsqueeze(0) * 2.0 - 1.0
+    # 合成图：水平/垂直渐变加同心圆纹理，覆盖平滑区域和细节
+    axis = torch.linspace(-1.0, 1.0, size)
+    y, x = torch.meshgrid(axis, axis, indexing="ij")
+    rings = torch.sin(torch.sqrt(x ** 2 + y ** 2) * 40.0)
+    return torch.stack([x, y, rings * 0.8]).unsqueeze(0)
+
+
+def psnr(a, b):
+    """两张取值 [-1, 1] 的图像在 [0, 1] 像素范围下的 PSNR（dB）"""
+    mse = torch.mean(((a.clamp(-1, 1) - b.clamp(-1, 1)) / 2.0) ** 2).item()
+    return float("inf") if mse == 0 else 10.0 * torch.log10(torch.tensor(1.0 / mse)).item()
+
+
+def _time(policy, call, iters):
+    """:return: (中位耗时秒, 最后一次的结果)"""
+    timings, result = [], None
+    # 第一次调用包含预热（cudnn选算法等），不计时
+    for index in range(iters + 1):
+        if policy.is_cuda:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        with torch.no_grad(), policy.autocast_context():
+            result = call()
+        if policy.is_cuda:
+            torch.cuda.synchronize()
+        if index > 0:
+            timings.append(time.perf_counter() - start)
+    return statistics.median(timings), result
+
+
+def benchmark(checkpoint_path, image_path=None, size=512, iters=5):
+    """
+    :return: {'full_encode', 'tiny_encode', 'full_decode', 'tiny_decode'（中位耗时秒）,
+              'full_psnr', 'tiny_psnr'（相对原图）, 'tiny_vs_full_psnr'}
+    """
+    policy = load_device_policy('vae')
+    device, dtype = policy.device, policy.dtype
+    print(f"VAE: {policy}")
+    vae = prepare_model(checkpoint_store.get(checkpoint_path, 'vae', dtype, policy.load_device), policy)
+    tiny = load_tiny_vae(device, dtype, settings_service.get())
+
+    original = _test_image(image_path, size)
+    pixels = original.to(device=device, dtype=dtype).contiguous(memory_format=policy.memory_format)
+    result = {}
+    result['full_encode'], latents = _time(
+        policy, lambda: vae.encode(pixels).latent_dist.mean * vae.config.scaling_factor, iters)
+    result['tiny_encode'], _ = _time(policy, lambda: tiny.encode(pixels).latents, iters)
+
+    # 两个解码器使用同一份（完整VAE编码得到的）Latent
+    scaled = (latents / vae.config.scaling_factor).contiguous(memory_format=policy.memory_format)
+    result['full_decode'], full_image = _time(policy, lambda: vae.decode(scaled, return_dict=False)[0], iters)
+    result['tiny_decode'], tiny_image = _time(policy, lambda: tiny.decode(latents, return_dict=False)[0], iters)
+
+    full_image, tiny_image = full_image.float().cpu(), tiny_image.float().cpu()
+    result['full_psnr'] = psnr(full_image, original)
+    result['tiny_psnr'] = psnr(tiny_image, original)
+    result['tiny_vs_full_psnr'] = psnr(tiny_image, full_image)
+    return result
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="草稿解码器（TAESD）与完整VAE的耗时和PSNR对比")
+    parser.add_argument("checkpoint", help="checkpoint文件路径")
+    parser.add_argument("--image", help="测试图片路径，不传时使用合成图")
+    parser.add_argument("--size", type=int, default=512, help="图像边长（像素）")
+    parser.add_argument("--iters", type=int, default=5)
+    args = parser.parse_args()
+
+    r = benchmark(args.checkpoint, args.image, args.size, args.iters)
+    print(f"\n{args.size}x{args.size}，单张")
+    print(f"{'':<10}{'编码(ms)':>12}{'解码(ms)':>12}{'PSNR/原图(dB)':>16}")
+    print(f"{'完整VAE':<10}{r['full_encode'] * 1000:>12.1f}{r['full_decode'] * 1000:>12.1f}{r['full_psnr']:>16.2f}")
+    print(f"{'TAESD':<10}{r['tiny_encode'] * 1000:>12.1f}{r['tiny_decode'] * 1000:>12.1f}{r['tiny_psnr']:>16.2f}")
+    print(f"解码加速: {r['full_decode'] / r['tiny_decode']:.1f}x，TAESD相对完整VAE解码的PSNR: {r['tiny_vs_full_psnr']:.2f} dB")
@@ -0,0 +1,260 @@
+"""
+张量缓存
+功能：存放模块之间传递的张量、Latent字典和PIL图像，模块之间只传 TENSOR_REF/IMAGE_REF/IMAGE_LIST_REF 引用
+- 每个条目记录还有多少个下游端口要读取，全部读取后立即释放
+- 下游读取次数未知的条目保留到本次运行结束（停止执行时释放该运行的条目，不影响其他运行）
+- 内存中（CPU张量和PIL图像）的总字节数超过上限时，把最久未用的条目转存到磁盘，读取时再加载回来；
+  显卡上的张量不占内存，不计入上限，也不会为了节省内存被转存
+"""
+
+import os
+import shutil
+import tempfile
+import threading
+from collections import OrderedDict
+
+import torch
+
+from core.settings_service import settings_service
+
+# 缓存上限的可选值（GUI下拉菜单与此保持一致）
+CACHE_LIMIT_OPTIONS = ["1 GB", "2 GB", "4 GB", "8 GB", "不限制"]
+
+DEFAULT_CACHE_LIMIT = "2 GB"
+
+GB = 1024 ** 3
+
+
+def _load_cache_limit():
+    """从 gui_settings.json 读取张量缓存上限，返回字节数，None表示不限制"""
+    value = settings_service.value("张量缓存上限", DEFAULT_CACHE_LIMIT)
+    if value == "不限制":
+        return None
+    try:
+        return int(float(str(value).replace("GB", "").strip()) * GB)
+    except ValueError:
+        print(f"无法识别的张量缓存上限: {value}，使用默认值 {DEFAULT_CACHE_LIMIT}")
+        return 2 * GB
+
+
+def value_bytes(value):
+    """估算缓存值占用的字节数"""
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, dict):
+        return sum(value_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(value_bytes(v) for v in value)
+    if hasattr(value, 'getbands') and hasattr(value, 'size'):
+        # PIL图像
+        width, height = value.size
+        return width * height * len(value.getbands())
+    return 0
+
+
+def host_bytes(value):
+    """估算缓存值中驻留在内存（CPU张量、PIL图像）的字节数，显卡上的张量不计"""
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size() if value.device.type == 'cpu' else 0
+    if isinstance(value, dict):
+        return sum(host_bytes(v) for v in value.values())
+    if isinstance(value, (list, tuple)):
+        return sum(host_bytes(v) for v in value)
+    return value_bytes(value)
+
+
+def value_devices(value):
+    """记录缓存值中每个张量所在的设备（结构与缓存值相同，非张量为None），转存磁盘后据此放回原设备"""
+    if isinstance(value, torch.Tensor):
+        return value.device
+    if isinstance(value, dict):
+        return {k: value_devices(v) for k, v in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [value_devices(v) for v in value]
+    return None
+
+
+def restore_devices(value, devices):
+    """把从磁盘加载（在CPU上）的缓存值中的张量移回 value_devices 记录的设备"""
+    if isinstance(value, torch.Tensor):
+        return value if devices is None or devices.type == 'cpu' else value.to(devices)
+    if isinstance(value, dict) and isinstance(devices, dict):
+        return {k: restore_devices(v, devices.get(k)) for k, v in value.items()}
+    if isinstance(value, (list, tuple)) and isinstance(devices, list):
+        restored = [restore_devices(v, d) for v, d in zip(value, devices)]
+        return type(value)(restored) if isinstance(value, tuple) else restored
+    return value
+
+
+class TensorCache:
+    """
+    引用计数的张量缓存
+    条目: id -> {'value', 'bytes', 'host_bytes', 'remaining', 'spill_path', 'run_id', 'devices'}
+    bytes 为条目总字节数，host_bytes 为其中驻留在内存的部分（只有它计入张量缓存上限）
+    remaining 为还需读取的次数，None 表示未知（运行结束时释放）
+    run_id 为产生该条目的运行，运行结束时只释放该运行的条目
+    devices 为转存磁盘前各张量所在的设备，从磁盘加载时放回原设备
+    """
+
+    def __init__(self, spill_dir=None):
+        self._lock = threading.RLock()
+        # 按最近使用顺序排列，转存磁盘时从最久未用的开始
+        self._entries = OrderedDict()
+        self._spill_dir = spill_dir
+        # 未转存条目的 host_bytes 之和，随条目增删和转存/加载增量维护
+        self._host_total = 0
+        # 统计：读取后自动释放次数、转存磁盘次数、从磁盘加载次数
+        self.released = 0
+        self.spills = 0
+        self.loads = 0
+
+    def __contains__(self, entry_id):
+        with self._lock:
+            return entry_id in self._entries
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def _spill_path(self, entry_id):
+        if self._spill_dir is None:
+            self._spill_dir = tempfile.mkdtemp(prefix="tensor_cache_")
+        os.makedirs(self._spill_dir, exist_ok=True)
+        return os.path.join(self._spill_dir, f"{entry_id}.pt")
+
+    def _memory_bytes(self):
+        return self._host_total
+
+    def _pop(self, entry_id):
+        """移除条目并更新内存字节数，返回被移除的条目（调用方需持有 self._lock）"""
+        entry = self._entries.pop(entry_id)
+        if entry['spill_path'] is None:
+            self._host_total -= entry['host_bytes']
+        return entry
+
+    def _enforce_limit(self, keep_id=None):
+        """内存占用超过上限时，把最久未用且驻留在内存的条目转存到磁盘（调用方需持有 self._lock）"""
+        limit = _load_cache_limit()
+        if limit is None or self._host_total <= limit:
+            return
+        for entry_id, entry in list(self._entries.items()):
+            if self._host_total <= limit:
+                break
+            if entry_id == keep_id or entry['spill_path'] is not None or entry['host_bytes'] == 0:
+                continue
+            path = self._spill_path(entry_id)
+            try:
+                torch.save(entry['value'], path)
+            except Exception as e:
+                print(f"张量缓存转存磁盘失败: {entry_id}, {e}")
+                continue
+            entry['devices'] = value_devices(entry['value'])
+            entry['value'] = None
+            entry['spill_path'] = path
+            self._host_total -= entry['host_bytes']
+            self.spills += 1
+            print(f"张量缓存超出上限，已转存到磁盘: {entry_id}")
+
+    def put(self, entry_id, value, consumers=None, run_id=None):
+        """
+        存入缓存
+        :param entry_id: 条目id
+        :param value: 张量、Latent字典、PIL图像或图像列表
+        :param consumers: 下游读取次数；None表示未知；0表示没有下游，直接丢弃
+        :param run_id: 产生该条目的运行ID
+        """
+        if consumers == 0:
+            print(f"输出没有连接下游模块，不缓存: {entry_id}")
+            return
+        with self._lock:
+            if entry_id in self._entries:
+                self._pop(entry_id)
+            self._entries[entry_id] = {
+                'value': value,
+                'bytes': value_bytes(value),
+                'host_bytes': host_bytes(value),
+                'remaining': consumers,
+                'spill_path': None,
+                'run_id': run_id,
+                'devices': None,
+            }
+            self._host_total += self._entries[entry_id]['host_bytes']
+            self._enforce_limit(keep_id=entry_id)
+
+    def get(self, entry_id, consume=False):
+        """
+        读取缓存
+        :param consume: 为True时计为一次下游读取，读取次数用完后释放条目
+        :return: 缓存值，不存在时返回None
+        """
+        with self._lock:
+            entry = self._entries.get(entry_id)
+            if entry is None:
+                return None
+            if entry['spill_path'] is not None:
+                # 从磁盘加载回内存，再把张量放回转存前所在的设备（下游模块不需要再复制）
+                value = torch.load(entry['spill_path'], map_location='cpu', weights_only=False)
+                try:
+                    value = restore_devices(value, entry['devices'])
+                except Exception as e:
+                    print(f"张量缓存无法放回原设备，保留在CPU上: {entry_id}, {e}")
+                entry['value'] = value
+                entry['devices'] = None
+                os.remove(entry['spill_path'])
+                entry['spill_path'] = None
+                # 未能放回显卡时留在CPU上，按实际位置重新计算内存占用
+                entry['host_bytes'] = host_bytes(value)
+                self._host_total += entry['host_bytes']
+                self.loads += 1
+            self._entries.move_to_end(entry_id)
+            value = entry['value']
+
+            if consume and entry['remaining'] is not None:
+                entry['remaining'] -= 1
+                if entry['remaining'] <= 0:
+                    self._pop(entry_id)
+                    self.released += 1
+            else:
+                self._enforce_limit(keep_id=entry_id)
+            return value
+
+    def clear(self, run_id=None):
+        """
+        运行结束时释放条目，并删除磁盘上的转存文件
+        :param run_id: 只释放该运行的条目；None 表示释放全部
+        :return: 释放的条目数
+        """
+        with self._lock:
+            if run_id is None:
+                count = len(self._entries)
+                self._entries.clear()
+                self._host_total = 0
+                if self._spill_dir is not None and os.path.isdir(self._spill_dir):
+                    shutil.rmtree(self._spill_dir, ignore_errors=True)
+                return count
+            removed = [entry_id for entry_id, entry in self._entries.items() if entry['run_id'] == run_id]
+            for entry_id in removed:
+                entry = self._pop(entry_id)
+                if entry['spill_path'] is not None and os.path.exists(entry['spill_path']):
+                    os.remove(entry['spill_path'])
+            return len(removed)
+
+    def stats(self):
+        """返回缓存统计信息"""
+        with self._lock:
+            spilled = [e for e in self._entries.values() if e['spill_path'] is not None]
+            return {
+                'entries': len(self._entries),
+                'bytes': sum(e['bytes'] for e in self._entries.values()),
+                'memory_bytes': self._memory_bytes(),
+                'device_bytes': sum(e['bytes'] - e['host_bytes'] for e in self._entries.values()
+                                    if e['spill_path'] is None),
+                'spilled_entries': len(spilled),
+                'spilled_bytes': sum(e['bytes'] for e in spilled),
+                'limit_bytes': _load_cache_limit(),
+                'pending_unknown': sum(1 for e in self._entries.values() if e['remaining'] is None),
+                'runs': len({e['run_id'] for e in self._entries.values()}),
+                'released': self.released,
+                'spills': self.spills,
+                'loads': self.loads,
+            }
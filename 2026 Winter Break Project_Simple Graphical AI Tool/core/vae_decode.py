@@ -0,0 +1,163 @@
+"""
+VAE分块/逐张解码，分块编码
+功能：批量Latent逐张解码，大图按分块解码/编码并在重叠处线性融合
+- 分块大小按每次调用传入，不修改组件仓库中共享的VAE（不使用 diffusers 的 enable_tiling），
+  并发执行的编码/解码模块互不影响
+- 逐张：每次只解码批量中的一张，调用方转为图像后即释放，显卡上同时只有一张图的激活值
+- 不分块时解码结果留在设备上，由调用方在设备上量化为uint8后再复制到主机（core/image_io.py）
+- 分块：每次只解码一个分块，结果累加到CPU上的输出缓冲区，峰值显存只与分块大小有关、与图像尺寸无关
+- 融合：分块与相邻分块重叠的一侧权重线性过渡（图像边界一侧不过渡），按权重归一化消除接缝
+"""
+
+import torch
+
+from core.cancellation import check_cancelled
+
+DECODE_MODES = ["逐张", "整批"]
+
+
+def _tile_starts(size, tile, stride):
+    """一个方向上各分块的起点，最后一块与边界对齐"""
+    if size <= tile:
+        return [0]
+    starts = list(range(0, size - tile + 1, stride))
+    if starts[-1] + tile < size:
+        starts.append(size - tile)
+    return starts
+
+
+def _feather(length, overlap, at_start, at_end):
+    """一维融合权重：与相邻分块重叠的一侧从接近0线性升到1，图像边界一侧保持1"""
+    weight = torch.ones(length)
+    overlap = min(overlap, length // 2)
+    if overlap > 0:
+        ramp = torch.arange(1, overlap + 1, dtype=torch.float32) / (overlap + 1)
+        if not at_start:
+            weight[:overlap] = ramp
+        if not at_end:
+            weight[-overlap:] = torch.minimum(weight[-overlap:], ramp.flip(0))
+    return weight
+
+
+def vae_scale_factor(vae):
+    """VAE的下采样倍数（SD为8）"""
+    return 2 ** (len(vae.config.block_out_channels) - 1)
+
+
+def tiled_decode(vae, latents, tile_size=512, overlap=0.25, cancel_token=None,
+                 memory_format=torch.contiguous_format, on_tile=None):
+    """
+    分块解码一张Latent
+    :param latents: 已除以 scaling_factor 的单张Latent [1, C, h, w]
+    :param tile_size: 分块大小（像素）
+    :param overlap: 相邻分块重叠的比例（0~0.5）
+    :param on_tile: 可选，每解码完一个分块调用 on_tile(已完成数, 总数)
+    :return: 图像张量 [1, 3, H, W]（取值约 [-1, 1]；分块时在CPU上、float32，不需要分块时留在设备上）
+    """
+    scale = vae_scale_factor(vae)
+    tile = max(1, tile_size // scale)
+    _, _, height, width = latents.shape
+    if height <= tile and width <= tile:
+        check_cancelled(cancel_token)
+        return vae.decode(latents.contiguous(memory_format=memory_format), return_dict=False)[0]
+
+    overlap_latent = min(int(tile * overlap), tile // 2)
+    stride = tile - overlap_latent
+    ys = _tile_starts(height, tile, stride)
+    xs = _tile_starts(width, tile, stride)
+    output = None
+    weights = torch.zeros((1, 1, height * scale, width * scale))
+    done, total = 0, len(ys) * len(xs)
+    for y in ys:
+        for x in xs:
+            check_cancelled(cancel_token)
+            chunk = latents[:, :, y:y + tile, x:x + tile].contiguous(memory_format=memory_format)
+            decoded = vae.decode(chunk, return_dict=False)[0].float().cpu()
+            del chunk
+            if output is None:
+                output = torch.zeros((1, decoded.shape[1], height * scale, width * scale))
+            tile_h, tile_w = decoded.shape[-2:]
+            weight = (_feather(tile_h, overlap_latent * scale, y == 0, y + tile >= height)[:, None]
+                      * _feather(tile_w, overlap_latent * scale, x == 0, x + tile >= width)[None, :])
+            top, left = y * scale, x * scale
+            output[:, :, top:top + tile_h, left:left + tile_w].addcmul_(decoded, weight)
+            weights[:, :, top:top + tile_h, left:left + tile_w] += weight
+            done += 1
+            if on_tile is not None:
+                on_tile(done, total)
+    return output / weights
+
+
+def tiled_encode(vae, pixels, tile_size=512, overlap=0.25, cancel_token=None,
+                 memory_format=torch.contiguous_format):
+    """
+    分块编码一批图像
+    每个分块单独编码，各分块的分布参数（均值和对数方差）在Latent空间按重叠融合，再组成完整的分布
+    :param pixels: 图像张量 [B, 3, H, W]，取值 [-1, 1]
+    :param tile_size: 分块大小（像素）
+    :param overlap: 相邻分块重叠的比例（0~0.5）
+    :return: Latent分布，接口与 vae.encode(...).latent_dist 相同（mode() / sample()）
+    """
+    scale = vae_scale_factor(vae)
+    tile = max(1, tile_size // scale) * scale
+    _, _, height, width = pixels.shape
+    if (height <= tile and width <= tile) or height % scale or width % scale:
+        check_cancelled(cancel_token)
+        return vae.encode(pixels.contiguous(memory_format=memory_format)).latent_dist
+
+    overlap_latent = min(int(tile // scale * overlap), tile // scale // 2)
+    stride = tile - overlap_latent * scale
+    ys = _tile_starts(height, tile, stride)
+    xs = _tile_starts(width, tile, stride)
+    output, weights, dist_type = None, None, None
+    for y in ys:
+        for x in xs:
+            check_cancelled(cancel_token)
+            chunk = pixels[:, :, y:y + tile, x:x + tile].contiguous(memory_format=memory_format)
+            dist = vae.encode(chunk).latent_dist
+            del chunk
+            moments = dist.parameters.float()
+            if output is None:
+                dist_type = type(dist)
+                output = torch.zeros((moments.shape[0], moments.shape[1], height // scale, width // scale),
+                                     device=moments.device)
+                weights = torch.zeros((1, 1, height // scale, width // scale), device=moments.device)
+            tile_h, tile_w = moments.shape[-2:]
+            weight = (_feather(tile_h, overlap_latent, y == 0, y + tile >= height)[:, None]
+                      * _feather(tile_w, overlap_latent, x == 0, x + tile >= width)[None, :]).to(moments.device)
+            top, left = y // scale, x // scale
+            output[:, :, top:top + tile_h, left:left + tile_w].addcmul_(moments, weight)
+            weights[:, :, top:top + tile_h, left:left + tile_w] += weight
+            del dist, moments
+    return dist_type((output / weights).to(pixels.dtype))
+
+
+def decode_latents(vae, latents, mode="逐张", tile_size=None, overlap=0.25, cancel_token=None,
+                   memory_format=torch.contiguous_format, on_image=None):
+    """
+    解码一批Latent，逐张生成结果
+    :param latents: 已除以 scaling_factor 的Latent [B, C, h, w]
+    :param mode: 逐张 / 整批（整批为一次decode调用，显存充足时更快；分块时总是逐张）
+    :param tile_size: 分块大小（像素），None表示不分块
+    :param on_image: 可选，每解码完一张调用 on_image(已完成数, 总数)
+    :return: 生成器，依次产出每张图的张量 [1, 3, H, W]（不分块时在设备上，分块时在CPU上）
+    """
+    batch = latents.shape[0]
+    if mode == "整批" and tile_size is None:
+        check_cancelled(cancel_token)
+        decoded = vae.decode(latents.contiguous(memory_format=memory_format), return_dict=False)[0]
+        for index in range(batch):
+            if on_image is not None:
+                on_image(index + 1, batch)
+            yield decoded[index:index + 1]
+        return
+    for index in range(batch):
+        check_cancelled(cancel_token)
+        sample = latents[index:index + 1]
+        if tile_size is None:
+            image = vae.decode(sample.contiguous(memory_format=memory_format), return_dict=False)[0]
+        else:
+            image = tiled_decode(vae, sample, tile_size, overlap, cancel_token, memory_format)
+        if on_image is not None:
+            on_image(index + 1, batch)
+        yield image
@@ -0,0 +1,434 @@
+"""
+服务端工作流执行器
+功能：接收与 .aiud 中 project.json 相同结构的 modules/connections，
+在Python进程内按依赖顺序执行整个工作流
+- 模块之间直接传递Python对象（张量、图像、组件句柄），不经过JSON和引用字符串
+- 浏览器端模块（user输入、固定值输出、显示、缓存、对话输出）在这里按相同规则模拟
+- 每个模块开始/完成/出错都会通过 on_event 回调推送进度；K采样器等模块还会按步推送 module_progress 事件
+- 依赖已满足的模块并发执行：按模块头部的 #resource=gpu|cpu|io 分类，
+  同一GPU设备上同时执行的模块数不超过「GPU并发任务数」，CPU模块限制并发数，IO模块（加载、保存、LLM调用）只受线程池大小限制；
+  资源闸门由 app.py 创建，服务端运行、排队任务和前端逐个模块执行共用同一个闸门
+- 激活规则与前端一致：#excitedbydata=true 的模块所有已连接的输入都是None时（例如判断模块未选中的分支）不执行，
+  标记为跳过（下游由数据激活的模块同样收不到数据）；#time_late 大于0的模块延迟 time_late 秒（与前端每步1秒一致）后执行
+- 每次运行结束后报告关键路径（决定总耗时的那条依赖链）
+"""
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from core.progress import StepProgress
+
+# 由浏览器执行、后端没有对应执行逻辑的模块
+BROWSER_SIDE_MODULES = ('user输入', '固定值输出模块', '对话输出', '显示模块', '缓存模块')
+
+# 模块资源类型，未声明 #resource 的模块按CPU模块处理
+RESOURCE_KINDS = ('gpu', 'cpu', 'io')
+DEFAULT_RESOURCE = 'cpu'
+
+
+class WorkflowError(Exception):
+    """工作流结构错误（模块缺失、循环依赖等）"""
+
+
+def _is_true(value):
+    """模块头部的布尔参数（前端传 true/false，直接读文件时可能是 T/F 字符串）"""
+    if isinstance(value, str):
+        return value.strip().lower() in ('t', 'true')
+    return value is True
+
+
+def _parse_time_late(value):
+    """延迟步数，规则与前端一致：无法解析或为负数时按0处理"""
+    try:
+        time_late = int(value)
+    except (TypeError, ValueError):
+        return 0
+    return time_late if time_late > 0 else 0
+
+
+def describe_value(value):
+    """把模块输出转换为可以发给前端显示的简短描述"""
+    if value is None or isinstance(value, (bool, int, float, str)):
+        return value
+    if isinstance(value, dict) and 'samples' in value and hasattr(value['samples'], 'shape'):
+        return f"<Latent {tuple(value['samples'].shape)}>"
+    if hasattr(value, 'shape') and hasattr(value, 'dtype'):
+        return f"<Tensor {tuple(value.shape)} {value.dtype}>"
+    if hasattr(value, 'getbands') and hasattr(value, 'size'):
+        return f"<Image {value.size[0]}x{value.size[1]}>"
+    if isinstance(value, (list, tuple)):
+        if value and all(hasattr(v, 'getbands') for v in value):
+            return f"<Image x{len(value)}>"
+        return [describe_value(v) for v in value]
+    return repr(value)
+
+
+def topological_order(module_ids, connections):
+    """
+    Kahn算法计算执行顺序
+    :raises WorkflowError: 存在循环依赖时
+    """
+    dependents = {module_id: [] for module_id in module_ids}
+    in_degree = {module_id: 0 for module_id in module_ids}
+    for conn in connections:
+        start_id = conn.get('startModuleId')
+        end_id = conn.get('endModuleId')
+        if start_id in dependents and end_id in dependents and end_id not in dependents[start_id]:
+            dependents[start_id].append(end_id)
+            in_degree[end_id] += 1
+
+    queue = [module_id for module_id in module_ids if in_degree[module_id] == 0]
+    order = []
+    while queue:
+        module_id = queue.pop(0)
+        order.append(module_id)
+        for dependent_id in dependents[module_id]:
+            in_degree[dependent_id] -= 1
+            if in_degree[dependent_id] == 0:
+                queue.append(dependent_id)
+
+    if len(order) < len(module_ids):
+        cyclic = [module_id for module_id in module_ids if module_id not in order]
+        raise WorkflowError(f"工作流存在循环依赖，服务端执行不支持循环: {cyclic}")
+    return order
+
+
+def merge_input(existing, value):
+    """多连一时合并输入，规则与前端 transferDataFunc 一致"""
+    if existing is None:
+        return value
+    if isinstance(existing, list) and not isinstance(value, list):
+        return existing + [value]
+    if isinstance(existing, list) and isinstance(value, list):
+        return existing + value
+    if isinstance(existing, str) and isinstance(value, str):
+        return existing + '\n' + value
+    return value
+
+
+def critical_path(order, dependencies, durations):
+    """
+    计算关键路径：沿依赖关系累计执行时间最长的一条链
+    :param order: 拓扑顺序
+    :param dependencies: 模块id -> 上游模块id集合
+    :param durations: 模块id -> 执行时间（秒）
+    :return: (关键路径上的模块id列表, 关键路径总时间)
+    """
+    finish = {}
+    previous = {}
+    for module_id in order:
+        upstream = [dep for dep in dependencies.get(module_id, ()) if dep in finish]
+        best = max(upstream, key=lambda dep: finish[dep]) if upstream else None
+        finish[module_id] = durations.get(module_id, 0) + (finish[best] if best else 0)
+        previous[module_id] = best
+    if not finish:
+        return [], 0
+    end = max(finish, key=lambda module_id: finish[module_id])
+    total = finish[end]
+    path = []
+    while end is not None:
+        path.append(end)
+        end = previous[end]
+    return list(reversed(path)), total
+
+
+def resolve_resource(value):
+    """模块头部的 #resource 值 -> gpu / cpu / io（未声明或无法识别时按CPU模块处理）"""
+    resource = str(value or DEFAULT_RESOURCE).lower()
+    return resource if resource in RESOURCE_KINDS else DEFAULT_RESOURCE
+
+
+class ResourceGate:
+    """
+    按资源类型限制模块并发
+    - gpu：每个设备同时执行的模块数不超过 gpu_slots()（每次获取时读取，设置修改后立即生效）
+    - cpu：信号量限制并发数（默认CPU核数的一半）
+    - io：不额外限制
+    """
+
+    def __init__(self, cpu_slots=None, gpu_slots=None):
+        self._gpu_cond = threading.Condition()
+        self._gpu_active = {}
+        self._gpu_slots = gpu_slots or (lambda: 1)
+        self._cpu = threading.Semaphore(cpu_slots or max(1, (os.cpu_count() or 2) // 2))
+
+    def _acquire_gpu(self, device):
+        with self._gpu_cond:
+            while self._gpu_active.get(device, 0) >= max(1, self._gpu_slots()):
+                self._gpu_cond.wait()
+            self._gpu_active[device] = self._gpu_active.get(device, 0) + 1
+
+        def release():
+            with self._gpu_cond:
+                self._gpu_active[device] -= 1
+                self._gpu_cond.notify_all()
+        return release
+
+    def acquire(self, resource, device):
+        """获取资源，返回释放函数"""
+        if resource == 'gpu':
+            return self._acquire_gpu(device)
+        if resource == 'cpu':
+            self._cpu.acquire()
+            return self._cpu.release
+        return lambda: None
+
+
+class WorkflowNode:
+    """工作流中的一个模块实例"""
+
+    def __init__(self, module):
+        self.id = module.get('id')
+        module_data = module.get('moduleData') or {}
+        self.params = module_data.get('params') or {}
+        # 文件名（后端执行用）与显示名称（特殊模块判断用）
+        self.file_name = module_data.get('name') or module.get('name')
+        self.name = self.params.get('name') or module.get('name')
+        self.settings = module.get('settings') or {}
+        self.input_value = module.get('inputValue', '')
+        # 缓存模块上一次的缓存值（由前端随请求带上）
+        self.cached_value = module.get('cachedValue')
+        self.input_quantity = int(self.params.get('input_quantity') or 0)
+        self.output_quantity = int(self.params.get('output_quantity') or 0)
+        variables_name = self.params.get('variables_name') or ''
+        self.variable_names = [name.strip() for name in str(variables_name).split(',') if name.strip()]
+        self.resource = resolve_resource(self.params.get('resource'))
+        self.excited_by_data = _is_true(self.params.get('excitedbydata'))
+        # 延迟秒数（前端每个延迟步为1秒）
+        self.time_late = _parse_time_late(self.params.get('time_late'))
+
+    @property
+    def browser_side(self):
+        return self.name in BROWSER_SIDE_MODULES or self.params.get('userinput') is True
+
+
+class WorkflowExecutor:
+    """
+    工作流执行器
+    run_module 由 app.py 注入，签名为 run_module(module_name, input_values, settings, cancel_token=None, progress_callback=None)，
+    返回 {'result': [...]} 或 {'error': ...}
+    make_preview 可选，签名为 make_preview(模块显示名称, 输入列表)，返回前端可直接显示的预览数据
+    gpu_device 可选，返回当前GPU模块所用设备的标识，同一标识的GPU模块共用并发限制
+    gate 可选，与其他执行路径共用的 ResourceGate，不传时新建一个（GPU模块串行）
+    """
+
+    def __init__(self, run_module, make_preview=None, gpu_device=None, max_workers=4, gate=None):
+        self.run_module = run_module
+        self.make_preview = make_preview
+        self.gpu_device = gpu_device
+        self.max_workers = max_workers
+        self.gate = gate or ResourceGate()
+
+    def _emulate_browser_module(self, node, inputs):
+        """模拟浏览器端模块，返回 (输出列表, 显示内容)"""
+        if node.name == 'user输入' or node.name == '固定值输出模块' or node.params.get('userinput') is True:
+            return [node.input_value], None
+        data = inputs[0] if inputs else None
+        if node.name == '缓存模块' and data is None:
+            # 没有新输入时保持原有缓存值
+            data = node.cached_value
+        return [data], data
+
+    def _assemble_inputs(self, node, incoming, outputs):
+        """
+        组装输入端口的值，输入端口为空时使用设置中的默认值（与前端一致）
+        :return: (输入列表, 已连接的端口中是否收到了数据)；没有连接输入时视为已收到
+        """
+        inputs = [None] * node.input_quantity
+        received = not incoming
+        for conn in incoming:
+            port = int(conn.get('endPortIndex') or 0)
+            upstream = outputs.get(conn['startModuleId'], [])
+            start_port = int(conn.get('startPortIndex') or 0)
+            value = upstream[start_port] if start_port < len(upstream) else None
+            if value is None or port >= node.input_quantity:
+                continue
+            received = True
+            inputs[port] = merge_input(inputs[port], value)
+        for port in range(node.input_quantity):
+            if inputs[port] is None and port < len(node.variable_names):
+                inputs[port] = node.settings.get(node.variable_names[port])
+        return inputs, received
+
+    @staticmethod
+    def _delay(node, cancel_token):
+        """
+        按模块的 time_late 等待（可被取消令牌提前唤醒）
+        :return: 等待期间是否被取消
+        """
+        if node.time_late <= 0:
+            return False
+        wait_cancel = getattr(cancel_token, 'wait', None)
+        if wait_cancel is not None:
+            return bool(wait_cancel(node.time_late))
+        time.sleep(node.time_late)
+        return cancel_token is not None and cancel_token()
+
+    def _emulate_delayed(self, node, inputs, index, emit, cancel_token):
+        """
+        在工作线程中延迟后模拟有 time_late 的浏览器端模块
+        :return: (输出列表, 显示内容, 错误信息, 执行时间, 排队时间)
+        """
+        queued = time.time()
+        if self._delay(node, cancel_token):
+            return [], None, '执行已被用户取消', 0, time.time() - queued
+        emit({'type': 'module_start', 'module_id': node.id, 'name': node.name, 'index': index,
+              'resource': 'browser', 'waited': time.time() - queued})
+        module_outputs, display = self._emulate_browser_module(node, inputs)
+        return module_outputs, display, None, 0, time.time() - queued
+
+    def _execute_node(self, node, inputs, device, index, emit, cancel_token):
+        """
+        在工作线程中执行一个后端模块（先按 time_late 延迟，再按资源类型排队）
+        :return: (输出列表, 显示内容, 错误信息, 执行时间, 排队时间)
+        """
+        queued = time.time()
+        if self._delay(node, cancel_token):
+            return [], None, '执行已被用户取消', 0, time.time() - queued
+        release = self.gate.acquire(node.resource, device)
+        try:
+            waited = time.time() - queued
+            emit({'type': 'module_start', 'module_id': node.id, 'name': node.name, 'index': index,
+                  'resource': node.resource, 'waited': waited})
+            start = time.time()
+            outcome = self.run_module(node.file_name, inputs, node.settings, cancel_token=cancel_token,
+                                      progress_callback=StepProgress(emit, node.id, node.name))
+            return list(outcome.get('result') or []), None, outcome.get('error'), time.time() - start, waited
+        except Exception as e:
+            return [], None, str(e), time.time() - queued - waited, waited
+        finally:
+            release()
+
+    def run(self, modules, connections, on_event=None, cancel_token=None):
+        """
+        执行整个工作流
+        :param modules: project.json 中的 modules 列表
+        :param connections: project.json 中的 connections 列表
+        :param on_event: 进度回调，参数为事件字典（可能在工作线程中调用）
+        :param cancel_token: 取消令牌（可调用，返回True时不再启动新的模块），同时传给正在执行的模块
+        :return: {模块id: {'status', 'outputs', 'display', 'error', 'elapsed'}}
+        """
+        emit = on_event or (lambda event: None)
+        nodes = {}
+        for module in modules:
+            node = WorkflowNode(module)
+            if node.id is None:
+                raise WorkflowError("模块缺少id")
+            nodes[node.id] = node
+
+        order = topological_order(list(nodes.keys()), connections)
+        index_of = {module_id: index for index, module_id in enumerate(order)}
+        incoming = {module_id: [] for module_id in nodes}
+        dependencies = {module_id: set() for module_id in nodes}
+        for conn in connections:
+            if conn.get('endModuleId') in incoming and conn.get('startModuleId') in nodes:
+                incoming[conn['endModuleId']].append(conn)
+                dependencies[conn['endModuleId']].add(conn['startModuleId'])
+
+        device = self.gpu_device() if self.gpu_device else 'gpu'
+        emit({'type': 'start', 'total': len(order), 'order': order})
+        outputs = {}
+        results = {}
+        pending = list(order)
+        running = {}
+        stopped = False
+        run_start = time.time()
+
+        def finish(module_id, module_outputs, display, error, elapsed, waited=0):
+            node = nodes[module_id]
+            index = index_of[module_id]
+            if error:
+                results[module_id] = {'status': 'error', 'outputs': [], 'display': None,
+                                      'error': error, 'elapsed': elapsed, 'waited': waited}
+                emit({'type': 'module_error', 'module_id': module_id, 'name': node.name,
+                      'index': index, 'error': error, 'elapsed': elapsed})
+                return
+            while len(module_outputs) < node.output_quantity:
+                module_outputs.append(None)
+            outputs[module_id] = module_outputs
+            results[module_id] = {'status': 'done', 'outputs': module_outputs, 'display': display,
+                                  'error': None, 'elapsed': elapsed, 'waited': waited}
+            preview = self.make_preview(node.name, node_inputs.pop(module_id, [])) if self.make_preview else None
+            emit({'type': 'module_done', 'module_id': module_id, 'name': node.name, 'index': index,
+                  'outputs': [describe_value(v) for v in module_outputs],
+                  'display': describe_value(display), 'preview': preview, 'elapsed': elapsed})
+
+        node_inputs = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            while pending or running:
+                if not stopped and cancel_token is not None and cancel_token():
+                    stopped = True
+                    emit({'type': 'stopped', 'pending': list(pending)})
+                if stopped:
+                    pending = []
+
+                # 启动所有依赖已完成的模块
+                progressed = False
+                for module_id in list(pending):
+                    if not all(dep in results for dep in dependencies[module_id]):
+                        continue
+                    pending.remove(module_id)
+                    progressed = True
+                    node = nodes[module_id]
+
+                    # 上游出错或被跳过时，下游模块跳过；上游只是未被激活时按没有收到数据处理
+                    failed_upstream = [dep for dep in dependencies[module_id]
+                                       if results[dep]['status'] != 'done' and not results[dep].get('inactive')]
+                    if failed_upstream:
+                        results[module_id] = {'status': 'skipped', 'outputs': [], 'display': None,
+                                              'error': f'上游模块未完成: {failed_upstream}', 'elapsed': 0}
+                        emit({'type': 'module_skipped', 'module_id': module_id, 'name': node.name,
+                              'index': index_of[module_id], 'error': results[module_id]['error']})
+                        continue
+
+                    inputs, received = self._assemble_inputs(node, incoming[module_id], outputs)
+                    if node.excited_by_data and not received:
+                        # 与前端一致：由数据激活的模块没有收到任何数据时不执行（例如判断模块未选中的分支）
+                        results[module_id] = {'status': 'skipped', 'inactive': True, 'outputs': [],
+                                              'display': None, 'error': '未收到输入数据，模块未被激活',
+                                              'elapsed': 0}
+                        emit({'type': 'module_skipped', 'module_id': module_id, 'name': node.name,
+                              'index': index_of[module_id], 'error': results[module_id]['error']})
+                        continue
+                    node_inputs[module_id] = inputs
+                    if node.browser_side and node.time_late > 0:
+                        future = pool.submit(self._emulate_delayed, node, inputs, index_of[module_id], emit,
+                                             cancel_token)
+                        running[future] = module_id
+                        continue
+                    if node.browser_side:
+                        # 浏览器端模块只是转发数据，直接在调度线程中完成
+                        emit({'type': 'module_start', 'module_id': module_id, 'name': node.name,
+                              'index': index_of[module_id], 'resource': 'browser', 'waited': 0})
+                        module_outputs, display = self._emulate_browser_module(node, inputs)
+                        finish(module_id, module_outputs, display, None, 0)
+                        continue
+
+                    future = pool.submit(self._execute_node, node, inputs, device, index_of[module_id], emit,
+                                         cancel_token)
+                    running[future] = module_id
+
+                if progressed:
+                    continue
+                if not running:
+                    break
+
+                done, _ = wait(list(running), return_when=FIRST_COMPLETED)
+                for future in done:
+                    module_id = running.pop(future)
+                    module_outputs, display, error, elapsed, waited = future.result()
+                    finish(module_id, module_outputs, display, error, elapsed, waited)
+
+        # 关键路径报告
+        wall_time = time.time() - run_start
+        durations = {module_id: result.get('elapsed', 0) for module_id, result in results.items()}
+        path, path_time = critical_path(order, dependencies, durations)
+        serial_time = sum(durations.values())
+        print(f"工作流运行完成: 总用时 {wall_time:.2f}s, 串行累计 {serial_time:.2f}s, 关键路径 {path_time:.2f}s")
+        print("关键路径: " + " -> ".join(f"{nodes[m].name}({durations.get(m, 0):.2f}s)" for m in path))
+        emit({'type': 'done', 'elapsed': wall_time, 'serial_time': serial_time,
+              'critical_path': [{'module_id': m, 'name': nodes[m].name, 'elapsed': durations.get(m, 0)} for m in path],
+              'critical_path_time': path_time})
+        return results
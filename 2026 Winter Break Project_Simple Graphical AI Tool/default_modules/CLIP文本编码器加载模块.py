@@ -9,10 +9,13 @@
 #variables_name=模型文件夹路径,模型文件选择
 #kind=加载器
 #output_name=CLIP模型路径
+#resource=io
 
 import os
 import glob
 
+from core.settings_service import settings_service as default_settings_service
+
 """
 CLIP文本编码器加载模块
 功能：纯指路牌，只传CLIP模型文件路径，不加载不运算
@@ -49,22 +52,14 @@ def scan_model_files(directory="."):
         print(f"扫描CLIP模型文件失败: {str(e)}")
         return []
 
-def execute(model_folder=None, selected_model=None):
+def execute(model_folder=None, selected_model=None, settings_service=None):
     """
     执行模块逻辑
+    :param settings_service: 由后端注入的设置服务（读取默认的模型文件夹路径）
     :return: clip_path - CLIP模型文件路径字符串
     """
-    default_model_path = os.path.join(os.getcwd(), "models")
-    settings_file = os.path.join(os.getcwd(), "gui_settings.json")
-    if os.path.exists(settings_file):
-        try:
-            with open(settings_file, 'r', encoding='utf-8') as f:
-                import json
-                gui_settings = json.load(f)
-                if "模型文件夹路径" in gui_settings:
-                    default_model_path = gui_settings["模型文件夹路径"]
-        except Exception as e:
-            print(f"加载GUI设置失败: {e}")
+    gui_settings = (settings_service or default_settings_service).get()
+    default_model_path = gui_settings.get("模型文件夹路径") or os.path.join(os.getcwd(), "models")
     
     if model_folder is None or not model_folder:
         model_folder = default_model_path
@@ -9,14 +9,19 @@
 #variables_name=模型文件夹路径,模型文件选择
 #output_name=model,vae,clip
 #kind=加载器
+#resource=io
 
 import os
 import glob
 
+from core.model_store import CheckpointHandle
+from core.settings_service import settings_service as default_settings_service
+
 """
 Checkpoint加载器模块
-功能：纯指路牌，只传模型文件路径，不加载不运算
-输出：(model_path字符串, vae_path字符串, clip_path字符串)
+功能：输出checkpoint的组件句柄，不加载不运算
+权重由组件仓库统一加载一次，再分发给K采样器、VAE、CLIP等模块
+输出：(UNet句柄, VAE句柄, CLIP句柄)
 """
 
 def scan_model_files(directory="."):
@@ -49,22 +54,14 @@ def scan_model_files(directory="."):
         print(f"扫描模型文件失败: {str(e)}")
         return []
 
-def execute(model_folder=None, selected_model=None):
+def execute(model_folder=None, selected_model=None, settings_service=None):
     """
     执行模块逻辑
-    :return: (model_path, vae_path, clip_path) - 三个都是字符串路径
+    :param settings_service: 由后端注入的设置服务（读取默认的模型文件夹路径）
+    :return: (unet_handle, vae_handle, clip_handle) - 三个组件句柄
     """
-    default_model_path = os.path.join(os.getcwd(), "models")
-    settings_file = os.path.join(os.getcwd(), "gui_settings.json")
-    if os.path.exists(settings_file):
-        try:
-            with open(settings_file, 'r', encoding='utf-8') as f:
-                import json
-                gui_settings = json.load(f)
-                if "模型文件夹路径" in gui_settings:
-                    default_model_path = gui_settings["模型文件夹路径"]
-        except Exception as e:
-            print(f"加载GUI设置失败: {e}")
+    gui_settings = (settings_service or default_settings_service).get()
+    default_model_path = gui_settings.get("模型文件夹路径") or os.path.join(os.getcwd(), "models")
     
     if model_folder is None or not model_folder:
         model_folder = default_model_path
@@ -82,11 +79,13 @@ def execute(model_folder=None, selected_model=None):
                 model_path = model_files[0]
                 print(f"自动选择模型: {model_path}")
         
-        print(f"Checkpoint加载器完成: 只传路径={model_path}")
-        
         model_path = os.path.normpath(model_path)
         
-        return model_path, model_path, model_path
+        print(f"Checkpoint加载器完成: 输出组件句柄={model_path}")
+        
+        return (CheckpointHandle(model_path, 'unet'),
+                CheckpointHandle(model_path, 'vae'),
+                CheckpointHandle(model_path, 'clip'))
     except Exception as e:
         print(f"Checkpoint加载失败: {str(e)}")
         return f"加载失败: {str(e)}", None, None
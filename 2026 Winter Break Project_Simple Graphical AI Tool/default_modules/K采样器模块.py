@@ -1,14 +1,15 @@
 #input_quantity=4
-#variable_quantity=11
+#variable_quantity=14
 #userinput=false
 #setting=true
 #output_quantity=1
 #time_late=0
 #name=K采样器模块
 #excitedbydata=true
-#variables_name=模型,正面条件,负面条件,Latent图像,种子,生成后控制,步数,cfg,采样器名称,调度器,降噪
+#variables_name=模型,正面条件,负面条件,Latent图像,种子,生成后控制,步数,cfg,采样器名称,调度器,降噪,微批大小,预览间隔,遮罩模糊
 #kind=采样
 #output_name=生成的Latent张量
+#resource=gpu
 
 """
 K采样器模块（Inpaint增强版）
@@ -17,6 +18,13 @@ K采样器模块（Inpaint增强版）
 2. 新增mask边缘高斯模糊，增强提示词引导性
 3. 优化CFG默认值，提升提示词权重
 4. 修复inpaint mask处理逻辑，确保mask生效且边缘自然
+5. 批量采样：一批Latent配多组条件，每步一次UNet推理（可按微批拆分以控制显存）
+6. 调度器按 (采样器, 调度器, 步数) 缓存时间步表，每次运行使用独立副本，并发运行互不干扰
+7. 采样器来自 core.sampling 注册表（含 UniPC、LCM 与 exponential 调度），步数/CFG 超出推荐范围时打印提示
+8. 每步通过 progress_callback 报告进度，每隔「预览间隔」步附带Latent预览图（线性投影，不经过VAE）
+9. 每步开始前检查取消令牌，点击「停止」后最多再执行完当前一步即退出，部分Latent随之释放
+10. 循环外预计算遮罩混合的背景项和CFG条件，UNet输入复用缓冲区；遮罩模糊为0（二值遮罩）时跳过UNet前的重复混合
+11. 设备、精度和内存格式来自共享的设备策略（生成引擎的GPU序号、计算精度），输入张量不在同一设备上时打印警告
 """
 import os
 import gc
@@ -25,81 +33,38 @@ os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
 os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "0"
 
 import torch
-from diffusers import StableDiffusionPipeline
-from diffusers import EulerDiscreteScheduler, DDIMScheduler, DPMSolverMultistepScheduler
 # 新增：导入模糊所需模块
-from torchvision import transforms
 
-# 模型和调度器缓存
-_model_cache = {}
-_scheduler_cache = {}
+from core.model_store import checkpoint_store, resolve_checkpoint_path
+from core.sampling import (stack_conditioning, align_batch, CFGPredictor, create_scheduler,
+                           clear_scheduler_templates, check_sampling_settings, MaskBlend)
+from core.image_io import latent_mask
+from core.cancellation import ExecutionCancelled, check_cancelled
+from core.device_policy import device_service as default_device_service, prepare_model, ensure_on_device
 
 def clean_model_cache():
-    """清理缓存释放显存"""
-    global _model_cache, _scheduler_cache
-    for key in list(_model_cache.keys()):
-        del _model_cache[key]
-    _model_cache.clear()
-    _scheduler_cache.clear()
+    """清理缓存释放显存（UNet权重由组件仓库统一管理，这里只清理调度器模板）"""
+    clear_scheduler_templates()
     gc.collect()
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
 
-def get_scheduler(sampler_name, steps, device):
-    """
-    根据采样器名称创建对应的调度器
-    """
-    sampler_name = sampler_name or "euler"
-    sampler_name = sampler_name.lower()
-    
-    print(f"创建调度器: {sampler_name}")
-    
-    if "euler" in sampler_name:
-        return EulerDiscreteScheduler(
-            num_train_timesteps=1000,
-            beta_start=0.00085,
-            beta_end=0.012,
-            beta_schedule="scaled_linear",
-            steps_offset=1
-        )
-    elif "ddim" in sampler_name:
-        return DDIMScheduler(
-            num_train_timesteps=1000,
-            beta_start=0.00085,
-            beta_end=0.012,
-            beta_schedule="scaled_linear",
-            clip_sample=False,
-            set_alpha_to_one=False,
-            steps_offset=1,
-            prediction_type="epsilon"
-        )
-    elif "dpm" in sampler_name or "sde" in sampler_name:
-        # 支持dpmpp_2m_sde和其他DPM变体
-        return DPMSolverMultistepScheduler(
-            num_train_timesteps=1000,
-            beta_start=0.00085,
-            beta_end=0.012,
-            beta_schedule="scaled_linear",
-            steps_offset=1,
-            prediction_type="epsilon",
-            solver_type="midpoint"
-        )
-    else:
-        # 默认使用Euler调度器
-        return EulerDiscreteScheduler(
-            num_train_timesteps=1000,
-            beta_start=0.00085,
-            beta_end=0.012,
-            beta_schedule="scaled_linear",
-            steps_offset=1
-        )
-
 def execute(model_path=None, positive_embeds=None, negative_embeds=None, latents=None, 
              seed=None, post_control=None, steps=None, cfg=None, sampler_name=None, 
-             scheduler_name=None, denoise=None):
+             scheduler_name=None, denoise=None, micro_batch=None, preview_every=None, mask_blur=None,
+             progress_callback=None, cancel_token=None, device_service=None):
     """
     使用diffusers官方标准流程的K采样器实现
     增强Inpaint逻辑，确保提示词引导生效，mask区域精准生成
+    :param model_path: UNet组件句柄（来自Checkpoint加载器），也兼容checkpoint路径字符串
+    :param positive_embeds: 正面条件，可以是多组条件的批量张量或列表（多连一）
+    :param negative_embeds: 负面条件，只有1组时广播到所有正面条件
+    :param micro_batch: 微批大小，每次UNet推理处理的Latent数量，0或空表示整批一次推理
+    :param preview_every: 预览间隔，每隔几步随进度附带一张Latent预览图，0表示不预览
+    :param mask_blur: 遮罩边缘高斯模糊的sigma，0表示不模糊（二值遮罩，可跳过UNet前的混合）
+    :param progress_callback: 由后端注入，签名为 progress_callback(当前步, 总步数, latents=None)
+    :param cancel_token: 由后端注入的取消令牌，每步检查一次，已取消时抛出 ExecutionCancelled
+    :param device_service: 由后端注入的设备服务（设置未变化时直接返回缓存的策略）
     """
     # ====================== 1. 基础参数 ======================
     seed = int(seed) if seed is not None else 42
@@ -107,6 +72,9 @@ def execute(model_path=None, positive_embeds=None, negative_embeds=None, latents
     # 修改1：提升CFG默认值（从8→12），增强提示词引导力
     cfg_scale = float(cfg) if cfg is not None else 12.0
     denoise = max(0.0, min(1.0, float(denoise))) if denoise is not None else 0.6
+    micro_batch = int(micro_batch) if micro_batch not in (None, '') else 0
+    preview_every = max(0, int(preview_every)) if preview_every not in (None, '') else 5
+    mask_blur = max(0.0, float(mask_blur)) if mask_blur not in (None, '') else 2.0
     
     # 从字典中提取samples张量
     original_latents = latents
@@ -125,16 +93,15 @@ def execute(model_path=None, positive_embeds=None, negative_embeds=None, latents
     noise_mask = None
     if isinstance(original_latents, dict) and "noise_mask" in original_latents:
         noise_mask = original_latents["noise_mask"]
-        # 修复：正确的mask形状校验（只对比空间维度）
-        if noise_mask is not None and noise_mask.shape[2:] != original_samples.shape[2:]:
-            print(f"mask空间形状 {noise_mask.shape[2:]} 与latent空间形状 {original_samples.shape[2:]} 不一致，忽略mask")
-            noise_mask = None
-        else:
-            print(f"使用noise_mask，形状: {noise_mask.shape if noise_mask is not None else 'None'}")
+        # mask空间形状与latent不一致时，由 latent_mask 缩放到latent尺寸
+        if noise_mask is not None and noise_mask.shape[-2:] != original_samples.shape[2:]:
+            print(f"mask空间形状 {tuple(noise_mask.shape[-2:])} 与latent空间形状 {tuple(original_samples.shape[2:])} 不一致，缩放mask")
+        print(f"使用noise_mask，形状: {noise_mask.shape if noise_mask is not None else 'None'}")
     
     print(f"=== K采样器（Inpaint增强版）参数 ===")
     print(f"种子={seed}, 步数={steps}, CFG={cfg_scale}, 降噪={denoise}")
-    print(f"采样器: {sampler_name or 'euler'}")
+    print(f"采样器: {sampler_name or 'euler'}, 调度器: {scheduler_name or 'simple'}")
+    check_sampling_settings(sampler_name, steps, cfg_scale)
     print(f"初始Latent形状: {latents.shape}, 设备: {latents.device}")
     
     # 降噪为0时直接返回原图
@@ -145,56 +112,46 @@ def execute(model_path=None, positive_embeds=None, negative_embeds=None, latents
         return {"samples": latents}
     
     # ====================== 2. 设备和数据类型 ======================
-    device = "cuda" if torch.cuda.is_available() else "cpu"
-    dtype = torch.float16 if device == "cuda" else torch.float32
-    print(f"使用设备: {device}, 数据类型: {dtype}")
+    # 与其他SD模块使用同一设备策略（生成引擎中的GPU序号、计算精度）
+    policy = (device_service or default_device_service).policy('unet')
+    device, dtype = policy.device, policy.dtype
+    print(f"使用设备: {device}, 数据类型: {dtype}, channels_last: {policy.channels_last}")
     
-    # 所有张量移到对应设备
-    latents = latents.to(device=device, dtype=dtype)
-    positive_embeds = positive_embeds.to(device=device, dtype=dtype)
-    negative_embeds = negative_embeds.to(device=device, dtype=dtype)
-    text_embeddings = torch.cat([negative_embeds, positive_embeds])
+    # 输入张量应已在同一设备上（上游模块按同一策略放置），不在时警告并只转换这一次；再对齐Latent批量与条件组数
+    try:
+        positive_embeds = ensure_on_device("正面条件", stack_conditioning(positive_embeds), policy)
+        negative_embeds = ensure_on_device("负面条件", stack_conditioning(negative_embeds), policy)
+        latents, positive_embeds, negative_embeds = align_batch(
+            ensure_on_device("Latent", latents, policy), positive_embeds, negative_embeds)
+    except (AttributeError, ValueError) as e:
+        print(f"条件与Latent批量无法对齐: {e}")
+        if isinstance(original_latents, dict):
+            return original_latents
+        return {"samples": latents, "noise_mask": None}
+    if original_samples.shape[0] != latents.shape[0]:
+        original_samples = original_samples.repeat(latents.shape[0] // original_samples.shape[0], 1, 1, 1)
+    print(f"批量采样: {latents.shape[0]} 张, 微批大小: {micro_batch or '整批'}")
     
-    # 处理mask：对齐设备、精度+扩展4通道+边缘模糊（关键修改）
+    # 处理mask：单通道、对齐设备/精度/尺寸+边缘模糊（遮罩只在这里模糊一次），混合时按通道广播
+    # 同一遮罩（按内容摘要）以相同参数再次运行时直接使用缓存的结果
+    # 背景项 (1 - mask) * 原始latent 只算一次，循环内每次混合是一次 addcmul
+    mask_blend = None
     if noise_mask is not None:
-        noise_mask = noise_mask.to(device=device, dtype=dtype)
-        # 修改2：mask边缘高斯模糊，增强模型对mask区域的关注度
-        blur = transforms.GaussianBlur(kernel_size=5, sigma=2)  # 5核模糊，sigma=2（可调整）
-        noise_mask_single = noise_mask[:, 0:1, :, :]  # 先转回单通道
-        noise_mask_blurred = blur(noise_mask_single)
-        noise_mask = noise_mask_blurred.repeat(1, 4, 1, 1)  # 扩展回4通道
-        noise_mask = torch.clamp(noise_mask, 0.0, 1.0)  # 限制0~1范围
-        print(f"mask模糊+扩展后形状: {noise_mask.shape}")
+        noise_mask = latent_mask(noise_mask, original_samples.shape[2], original_samples.shape[3],
+                                 device, dtype, mask_blur)
+        mask_blend = MaskBlend(noise_mask, original_samples.to(device=device, dtype=dtype))
+        print(f"mask模糊后形状: {noise_mask.shape}, 二值遮罩: {mask_blend.binary}")
     
     # ====================== 3. 加载UNet和调度器 ======================
     try:
-        # 加载UNet
-        if model_path not in _model_cache:
-            print("加载UNet模型...")
-            pipe = StableDiffusionPipeline.from_single_file(
-                model_path,
-                torch_dtype=dtype,
-                use_safetensors=True,
-                safety_checker=None,
-                requires_safety_checker=False,
-                local_files_only=True
-            )
-            _model_cache[model_path] = pipe.unet.to(device).eval()
-            del pipe
-            gc.collect()
-            if torch.cuda.is_available():
-                torch.cuda.empty_cache()
-        
-        unet = _model_cache[model_path]
+        # 从组件仓库获取UNet（同一checkpoint只解析一次；顺序CPU卸载时留在CPU上）
+        checkpoint_path = resolve_checkpoint_path(model_path)
+        if checkpoint_path is None:
+            raise ValueError(f"无法识别的模型输入: {model_path}")
+        unet = prepare_model(checkpoint_store.get(checkpoint_path, 'unet', dtype, policy.load_device), policy)
         
-        # 加载或创建调度器
-        scheduler_key = f"{sampler_name or 'euler'}_{steps}"
-        if scheduler_key not in _scheduler_cache:
-            print("初始化调度器...")
-            scheduler = get_scheduler(sampler_name, steps, device)
-            _scheduler_cache[scheduler_key] = scheduler
-        
-        scheduler = _scheduler_cache[scheduler_key]
+        # 本次运行独立的调度器（时间步表来自缓存的模板，步进状态不与其他运行共享）
+        scheduler = create_scheduler(sampler_name, scheduler_name, steps, device)
         
     except Exception as e:
         print(f"模型或调度器加载失败: {e}")
@@ -208,11 +165,10 @@ def execute(model_path=None, positive_embeds=None, negative_embeds=None, latents
     try:
         # 设置随机种子
         torch.manual_seed(seed)
-        if device == "cuda":
+        if policy.is_cuda:
             torch.cuda.manual_seed_all(seed)
         
-        # 设置调度器时间步
-        scheduler.set_timesteps(steps, device=device)
+        # 调度器时间步（模板中已计算好）
         timesteps = scheduler.timesteps
         num_inference_steps = steps
         strength = denoise
@@ -224,6 +180,13 @@ def execute(model_path=None, positive_embeds=None, negative_embeds=None, latents
         
         print(f"实际时间步数量: {len(actual_timesteps)}")
         
+        # latents 当前是否已经过遮罩混合（二值遮罩下再次混合结果不变，可以跳过）
+        blended = False
+        
+        # CFG：各微批的拼接条件和UNet输入缓冲区在循环外准备好
+        cfg_predictor = CFGPredictor(unet, positive_embeds, negative_embeds, cfg_scale, micro_batch,
+                                     policy.memory_format)
+        
         # 图生图：添加噪声 + 关键修改3（仅mask区域保留噪声）
         if strength < 1.0:
             print("\n图生图：添加噪声（仅mask区域）...")
@@ -238,8 +201,9 @@ def execute(model_path=None, positive_embeds=None, negative_embeds=None, latents
             
             # 全图加噪后，仅mask区域保留噪声，非mask区域还原原始latent
             latents = scheduler.add_noise(latents, noise, start_timestep)
-            if noise_mask is not None:
-                latents = noise_mask * latents + (1 - noise_mask) * original_samples.to(device, dtype)
+            if mask_blend is not None:
+                latents = mask_blend(latents)
+                blended = True
             
             print(f"加噪完成，仅mask区域保留噪声")
         
@@ -247,51 +211,44 @@ def execute(model_path=None, positive_embeds=None, negative_embeds=None, latents
         print("\n开始采样循环...")
         with torch.no_grad():
             for i, t in enumerate(actual_timesteps):
+                check_cancelled(cancel_token)
                 if i % 5 == 0:
                     print(f"采样进度: {i+1}/{len(actual_timesteps)}")
                 
-                # 进模型前混合mask（核心逻辑）
+                # 进模型前混合mask（核心逻辑）；二值遮罩且上一步已混合时这一步是恒等变换，跳过
                 current_latents = latents
-                if noise_mask is not None:
-                    current_latents = noise_mask * latents + (1 - noise_mask) * original_samples.to(device, dtype)
+                if mask_blend is not None and not (mask_blend.binary and blended):
+                    current_latents = mask_blend(latents)
                 
-                # CFG逻辑
-                latent_model_input = torch.cat([current_latents] * 2)
-                latent_model_input = scheduler.scale_model_input(latent_model_input, t)
+                # CFG逻辑：整批（或按微批）一次UNet推理，负面/正面条件拼在同一批内
+                latent_model_input = scheduler.scale_model_input(current_latents, t)
                 
-                # UNet推理
+                # UNet推理（CUDA半精度 / CPU bf16 时在 autocast 中运行，输出转回Latent精度）
                 try:
-                    if device == "cuda":
-                        with torch.amp.autocast(device_type="cuda", dtype=dtype):
-                            noise_pred = unet(
-                                latent_model_input,
-                                t,
-                                encoder_hidden_states=text_embeddings
-                            ).sample
-                    else:
-                        noise_pred = unet(
-                            latent_model_input,
-                            t,
-                            encoder_hidden_states=text_embeddings
-                        ).sample
-                    
-                    # CFG计算（增强版）
-                    noise_pred_uncond, noise_pred_text = noise_pred.chunk(2)
-                    noise_pred = noise_pred_uncond + cfg_scale * (noise_pred_text - noise_pred_uncond)
+                    with policy.autocast_context():
+                        noise_pred = cfg_predictor(latent_model_input, t)
+                    noise_pred = noise_pred.to(current_latents.dtype)
                     
                     # 更新latent：使用混合后的current_latents而不是原始latents
                     # 这样模型的预测和更新才会基于相同的输入，确保提示词生效
                     new_latents = scheduler.step(noise_pred, t, current_latents).prev_sample
                     
                     # 模型输出后混合mask（核心逻辑）
-                    if noise_mask is not None:
-                        latents = noise_mask * new_latents + (1 - noise_mask) * original_samples.to(device, dtype)
+                    if mask_blend is not None:
+                        latents = mask_blend(new_latents)
+                        blended = True
                     else:
                         latents = new_latents
                     
                 except Exception as e:
                     print(f"UNet推理失败: {e}")
                     continue
+                
+                # 报告进度，每隔 preview_every 步（以及最后一步）附带预览
+                if progress_callback is not None:
+                    step, total = i + 1, len(actual_timesteps)
+                    show_preview = preview_every > 0 and (step % preview_every == 0 or step == total)
+                    progress_callback(step, total, latents if show_preview else None)
         
         print(f"\n采样完成！输出Latent设备: {latents.device}")
         
@@ -304,6 +261,9 @@ def execute(model_path=None, positive_embeds=None, negative_embeds=None, latents
         
         return result
     
+    except ExecutionCancelled:
+        print("采样已取消，放弃部分完成的Latent")
+        raise
     except Exception as e:
         print(f"采样异常: {e}")
         traceback.print_exc()
@@ -1,155 +1,45 @@
 #input_quantity=2
-#variable_quantity=2
+#variable_quantity=4
 #userinput=false
-#setting=false
+#setting=true
 #output_quantity=1
 #time_late=0
 #name=VAE图像编码模块
 #excitedbydata=true
-#variables_name=vae,图像
+#variables_name=vae,图像,编码质量,编码方式
 #kind=处理模块
 #output_name=Latent数据
+#resource=gpu
 
 """
 VAE图像编码模块（极致优化版）
 功能：将图像编码为Latent张量
-输入：VAE模型路径、PIL图像对象
+输入：VAE组件句柄（或模型路径）、PIL图像对象
 输出：Latent张量
 优化：
-1. 完全禁用缓存，每次重新加载VAE后立即清理
-2. 只加载VAE组件，不加载完整pipeline
-3. 及时清理中间张量，强制垃圾回收
-4. 使用 AutoencoderKL 直接加载 VAE，不通过 StableDiffusionPipeline
+1. VAE由进程内的Checkpoint组件仓库统一提供，同一checkpoint只解析一次
+2. 及时清理中间张量，强制垃圾回收
+3. 图像以uint8上传、在设备上归一化（core/image_io.py）
+4. 草稿模式下改用 TAESD 近似编码器（core/taesd.py），画质为预览级
+5. 编码方式为均值时结果按图像内容缓存（core/encode_cache.py），源图像不变时连续运行不再重复编码
 """
 
 import os
-import re
 import gc
-import json
 import traceback
 os.environ["HF_ENDPOINT"] = "https://hf-mirror.com"
 os.environ["HF_HUB_ENABLE_HF_TRANSFER"] = "0"
 
 import torch
-from diffusers import AutoencoderKL
 from PIL import Image
-import numpy as np
 
-def get_device_from_engine_setting():
-    """
-    从gui_settings.json读取生成引擎设置，返回对应的PyTorch设备
-    返回: (device_str, use_half_precision)
-    """
-    settings_file = os.path.join(os.getcwd(), "gui_settings.json")
-    default_engine = "CPU"
-    use_cpu_for_vae = False
-    
-    if os.path.exists(settings_file):
-        try:
-            with open(settings_file, 'r', encoding='utf-8') as f:
-                settings = json.load(f)
-                engine = settings.get("生成引擎", default_engine)
-                use_cpu_for_vae = settings.get("使用 CPU 运行 VAE", False)
-        except Exception as e:
-            print(f"读取生成引擎设置失败: {e}")
-            engine = default_engine
-    else:
-        engine = default_engine
-    
-    print(f"读取到的生成引擎设置: {engine}")
-    print(f"读取到的使用 CPU 运行 VAE 设置: {use_cpu_for_vae}")
-    
-    # 如果启用使用 CPU 运行 VAE
-    if use_cpu_for_vae:
-        print("使用 CPU 运行 VAE 已启用，强制使用 CPU")
-        return "cpu", False
-    
-    if engine == "CPU":
-        return "cpu", False
-    
-    has_cuda = torch.cuda.is_available()
-    
-    gpu_idx = 0
-    match = re.search(r'GPU\s+(\d+)', engine)
-    if match:
-        gpu_idx = int(match.group(1))
-    
-    if "CUDA" in engine:
-        if has_cuda:
-            if gpu_idx < torch.cuda.device_count():
-                return f"cuda:{gpu_idx}", True
-            return "cuda", True
-        else:
-            print("警告: 选择了CUDA引擎但CUDA不可用，回退到CPU")
-            return "cpu", False
-    elif "TensorRT" in engine:
-        if has_cuda:
-            print("注意: TensorRT引擎当前使用CUDA后端")
-            if gpu_idx < torch.cuda.device_count():
-                return f"cuda:{gpu_idx}", True
-            return "cuda", True
-        else:
-            print("警告: 选择了TensorRT引擎但CUDA不可用，回退到CPU")
-            return "cpu", False
-    elif "DML" in engine:
-        try:
-            import torch_directml
-            has_dml = True
-        except ImportError:
-            has_dml = False
-        
-        if has_dml:
-            print(f"使用DML后端，GPU索引: {gpu_idx}")
-            return f"privateuseone:{gpu_idx}", False
-        elif has_cuda:
-            print("警告: DML不可用，回退到CUDA")
-            if gpu_idx < torch.cuda.device_count():
-                return f"cuda:{gpu_idx}", True
-            return "cuda", True
-        else:
-            print("警告: 选择了DML引擎但DML和CUDA都不可用，回退到CPU")
-            return "cpu", False
-    elif "ZLUDA" in engine:
-        if has_cuda:
-            print("注意: ZLUDA引擎当前使用CUDA后端")
-            if gpu_idx < torch.cuda.device_count():
-                return f"cuda:{gpu_idx}", True
-            return "cuda", True
-        else:
-            print("警告: 选择了ZLUDA引擎但CUDA不可用，回退到CPU")
-            return "cpu", False
-    
-    return "cpu", False
-
-def pil_to_tensor(pil_image):
-    """
-    PIL图像转PyTorch张量（内存优化版）
-    """
-    if isinstance(pil_image, list):
-        if not pil_image:
-            raise ValueError("图像列表为空")
-        pil_image = pil_image[0]
-    
-    if not isinstance(pil_image, Image.Image):
-        raise TypeError(f"期望PIL.Image对象，实际得到: {type(pil_image)}")
-    
-    print(f"VAE编码输入: 图像尺寸={pil_image.size}, 模式={pil_image.mode}")
-    
-    # 转换为numpy数组（处理灰度/透明图）
-    image_np = np.array(pil_image)
-    if image_np.ndim == 2:  # 灰度图转RGB
-        image_np = np.expand_dims(image_np, axis=-1)
-        image_np = np.repeat(image_np, 3, axis=-1)
-    elif image_np.shape[-1] == 4:  # RGBA转RGB
-        image_np = image_np[..., :3]
-    
-    # 归一化到[-1, 1]（SD标准）
-    image_np = image_np.astype(np.float32) / 127.5 - 1.0
-    
-    # 转换为张量 [1, 3, H, W]
-    image_tensor = torch.from_numpy(image_np).permute(2, 0, 1).unsqueeze(0)
-    
-    return image_tensor
+from core.model_store import checkpoint_store, resolve_checkpoint_path
+from core.cancellation import ExecutionCancelled, check_cancelled
+from core.device_policy import device_service as default_device_service, prepare_model
+from core.taesd import draft_enabled, load_tiny_vae
+from core.image_io import pil_to_tensor
+from core.encode_cache import encode_cache, resolve_latent_mode
+from core.vae_decode import tiled_encode
 
 def force_cleanup():
     """强制清理内存"""
@@ -158,20 +48,21 @@ def force_cleanup():
         torch.cuda.empty_cache()
         torch.cuda.ipc_collect()
 
-def execute(vae_model_path=None, image=None):
+def execute(vae_model_path=None, image=None, quality=None, latent_mode=None, cancel_token=None, device_service=None):
     """
     执行模块逻辑（极致内存优化版）
-    :param vae_model_path: VAE模型路径
-    :param image: PIL图像对象或PIL图像列表
-    :return: Latent张量 [1,4,H/8,W/8]
+    :param vae_model_path: VAE组件句柄（来自Checkpoint加载器），也兼容VAE模型路径字符串
+    :param image: PIL图像对象或PIL图像列表（列表中的图像尺寸须相同，整体编码为一个批量）
+    :param quality: 编码质量，跟随设置（高级设置中的草稿模式）/ 完整 / 草稿（TAESD，不需要VAE输入）
+    :param latent_mode: 编码方式，采样（默认，每次从分布中采样，不缓存）/ 均值（取分布的均值，结果可复现并缓存）
+    :param cancel_token: 由后端注入的取消令牌，编码前后各检查一次
+    :param device_service: 由后端注入的设备服务，决定VAE的设备、精度和显存选项
+    :return: Latent字典 {"samples": [B,4,H/8,W/8]}
     """
     print(f"\n=== VAE编码开始（优化版） ===")
     print(f"模型路径: {vae_model_path if vae_model_path else '空'}")
     print(f"图像类型: {type(image)}")
     
-    # 初始清理
-    force_cleanup()
-    
     # 初始化变量
     vae = None
     image_tensor = None
@@ -179,69 +70,70 @@ def execute(vae_model_path=None, image=None):
     result = None
     
     try:
-        # 必要参数校验
-        if vae_model_path is None or not os.path.exists(vae_model_path):
+        # 必要参数校验（草稿模式不需要VAE）
+        devices = device_service or default_device_service
+        draft = draft_enabled(quality, devices.settings)
+        checkpoint_path = resolve_checkpoint_path(vae_model_path)
+        if not draft and (checkpoint_path is None or not os.path.exists(checkpoint_path)):
             raise ValueError(f"VAE模型路径无效或不存在: {vae_model_path}")
         if image is None:
             raise ValueError("输入图像为空")
         
-        # 获取设备和精度配置
-        device, use_half = get_device_from_engine_setting()
-        # 确定数据类型（CUDA用fp16，其他用fp32，VAE不支持bf16）
-        if device.startswith("cuda") and use_half:
-            dtype = torch.float16
-        else:
-            dtype = torch.float32
-        print(f"使用设备: {device}, 数据类型: {dtype}")
+        # 获取设备和精度配置（CUDA用fp16，其他用fp32，VAE不支持bf16；与VAE解码模块相同）
+        policy = devices.policy('vae')
+        device, dtype = policy.device, policy.dtype
+        # Latent交给K采样器，按UNet的设备和精度输出（与VAE重绘编码器模块相同）
+        unet_policy = devices.policy('unet')
+        print(f"使用设备: {device}, 数据类型: {dtype}, 草稿模式: {draft}")
         
-        # 加载VAE模型（仅加载核心组件）
-        print("加载VAE模型（仅加载VAE组件）...")
-        try:
-            vae = AutoencoderKL.from_single_file(
-                vae_model_path,
-                torch_dtype=dtype,
-                use_safetensors=True,
-                local_files_only=True  # 优先本地文件，避免下载
-            )
-        except Exception as e:
-            print(f"AutoencoderKL加载失败，尝试通过StableDiffusionPipeline加载: {e}")
-            from diffusers import StableDiffusionPipeline
-            pipe = StableDiffusionPipeline.from_single_file(
-                vae_model_path,
-                torch_dtype=dtype,
-                use_safetensors=True,
-                safety_checker=None,
-                requires_safety_checker=False,
-                local_files_only=True
-            )
-            vae = pipe.vae
-            del pipe  # 立即清理pipe，释放显存
-            force_cleanup()
+        # 编码结果缓存：同一图像、同一VAE、同样的设备和精度直接返回上次的Latent（TAESD本身就是确定性的）
+        latent_mode = resolve_latent_mode(latent_mode)
+        # 分块编码按高级设置中的「VAE分块」逐次处理（TAESD 不分块），分块与否会改变结果，计入缓存键
+        tile = None if draft else policy.memory.vae_tile
+        cache_key = None
+        if latent_mode == "均值" or draft:
+            cache_key = encode_cache.make_key(image, None, "taesd" if draft else checkpoint_path,
+                                              (device, dtype, unet_policy.device, unet_policy.dtype),
+                                              "草稿" if draft else f"完整/{tile}/{policy.memory.vae_tile_overlap}")
+            cached = encode_cache.get(cache_key)
+            if cached is not None:
+                print(f"编码结果缓存命中: Latent形状={tuple(cached['samples'].shape)}")
+                return cached
+        
+        # 初始清理
+        force_cleanup()
         
-        # 移到指定设备并设置为评估模式
-        vae = vae.to(device=device, dtype=dtype).eval()
-        print("VAE加载完成")
+        # 从组件仓库获取VAE（同一checkpoint只解析一次，不再每次重新加载），应用注意力实现等显存选项
+        if draft:
+            vae = load_tiny_vae(device, dtype, devices.settings)
+        else:
+            vae = prepare_model(checkpoint_store.get(checkpoint_path, 'vae', dtype, policy.load_device), policy)
         
         # 图像转张量并移到设备
-        image_tensor = pil_to_tensor(image)
-        image_tensor = image_tensor.to(device=device, dtype=dtype, non_blocking=device.startswith("cuda"))
+        # 图像以uint8上传，在设备上归一化（尺寸相同的图像列表编码为一个批量）
+        image_tensor = pil_to_tensor(image, device, dtype, policy.memory_format)
+        print(f"VAE编码输入: 张量形状={tuple(image_tensor.shape)}")
         
-        # 核心编码逻辑（修复autocast错误）
+        # 核心编码逻辑（CUDA半精度时在autocast中运行）
         print("开始编码...")
+        check_cancelled(cancel_token)
         with torch.no_grad():
-            # 正确的autocast用法：只指定device_type，不指定dtype
-            if device.startswith("cuda") and use_half:
-                autocast_ctx = torch.amp.autocast(device_type="cuda", enabled=True)
-            else:
-                autocast_ctx = torch.no_grad()  # 非CUDA/不使用半精度时，直接用no_grad
-            
-            with autocast_ctx:
-                # VAE编码：生成Latent分布并采样
-                latent_dist = vae.encode(image_tensor).latent_dist
-                latents = latent_dist.sample()
-                
-                # 关键：乘以scaling_factor（SD1.x=0.18215，SD2.x=0.13025）
-                latents = latents * vae.config.scaling_factor
+            with policy.autocast_context():
+                if draft:
+                    # TAESD 直接输出缩放后的Latent（scaling_factor 为 1），没有分布可采样
+                    latents = vae.encode(image_tensor).latents
+                else:
+                    # VAE编码：生成Latent分布（开启VAE分块时分块编码），均值模式取分布的均值（可复现），采样模式从分布中采样
+                    if tile is None:
+                        latent_dist = vae.encode(image_tensor).latent_dist
+                    else:
+                        latent_dist = tiled_encode(vae, image_tensor, tile, policy.memory.vae_tile_overlap,
+                                                   cancel_token, policy.memory_format)
+                    latents = latent_dist.mode() if latent_mode == "均值" else latent_dist.sample()
+                    
+                    # 关键：乘以scaling_factor（SD1.x=0.18215，SD2.x=0.13025）
+                    latents = latents * vae.config.scaling_factor
+        check_cancelled(cancel_token)
         
         # 校验Latent数值范围（关键调试信息）
         print(f"VAE编码完成:")
@@ -250,19 +142,26 @@ def execute(vae_model_path=None, image=None):
         print(f"  - 数值范围: min={latents.min().item():.4f}, max={latents.max().item():.4f}")  # 正常范围±1左右
         print(f"=== VAE编码结束 ===\n")
         
-        # 先克隆到CPU再清理（避免显存丢失）
-        result = {"samples": latents.detach().cpu().clone()}
+        # 按UNet的设备和精度输出，K采样器不需要再复制（使用 CPU 运行 VAE 时在这里移回显卡）
+        result = {"samples": latents.detach().to(device=unet_policy.device, dtype=unet_policy.dtype)}
+        if cache_key is not None:
+            encode_cache.put(cache_key, result)
         
+    except ExecutionCancelled:
+        print("VAE编码已取消")
+        raise
     except Exception as e:
         error_msg = f"VAE编码失败: {str(e)}"
         print(error_msg)
         traceback.print_exc()
     finally:
         # 强制清理所有临时变量（无论是否异常）
-        for var_name in ['vae', 'image_tensor', 'latents']:
+        for var_name in ['image_tensor', 'latents']:
             if var_name in locals():
                 del locals()[var_name]
-        force_cleanup()
+        # 缓存命中时没有加载VAE，不需要清理
+        if vae is not None:
+            force_cleanup()
     
     return result
 
@@ -11,6 +11,7 @@
 #kind=处理模块
 #variables_name=数据,判断,测试
 #output_name=out0,out1
+#resource=cpu
 
 def choose(data, select):
     print(f'判断模块输入: data={data}, select={select}, type={type(select)}')
@@ -10,6 +10,7 @@
 #kind=图像
 #output_name=图像,遮罩
 #showingwindow_quantity=1
+#resource=io
 
 """
 加载图像模块
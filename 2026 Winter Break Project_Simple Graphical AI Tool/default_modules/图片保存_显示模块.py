@@ -9,36 +9,31 @@
 #variables_name=RGB图像,保存路径,是否保存
 #kind=输出模块
 #showingwindow_quantity=1
+#resource=io
 
 import os
 import time
-import json
+
+from core.settings_service import settings_service as default_settings_service
 
 """
 图片保存/显示模块
 功能：纯 IO，不参与生成，只显示和写入文件
 """
 
-def execute(image=None, save_path=None, should_save=True):
+def execute(image=None, save_path=None, should_save=True, settings_service=None):
     """
     执行模块逻辑
     :param image: PIL图像对象或图像列表
     :param save_path: 保存路径
     :param should_save: 是否保存（默认True）
+    :param settings_service: 由后端注入的设置服务（读取默认图片保存路径）
     :return: 保存结果信息
     """
     fallback_save_path = os.path.join(os.getcwd(), "output")
-    settings_file = os.path.join(os.getcwd(), "gui_settings.json")
-    if os.path.exists(settings_file):
-        try:
-            with open(settings_file, 'r', encoding='utf-8') as f:
-                gui_settings = json.load(f)
-                if "默认图片保存路径" in gui_settings:
-                    default_save_path = gui_settings["默认图片保存路径"]
-                    if save_path is None or not save_path:
-                        save_path = default_save_path
-        except Exception as e:
-            print(f"加载GUI设置失败: {e}")
+    default_save_path = (settings_service or default_settings_service).value("默认图片保存路径")
+    if default_save_path and (save_path is None or not save_path):
+        save_path = default_save_path
     
     if save_path is None or not save_path:
         save_path = fallback_save_path
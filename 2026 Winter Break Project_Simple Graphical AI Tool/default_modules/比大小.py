@@ -11,6 +11,7 @@
 #kind=处理模块
 #variables_name=a,b,运算符
 #output_name=结果
+#resource=cpu
 
 def compare(a, b, operator='>'):
     """
@@ -11,6 +11,7 @@
 #kind=调用模块
 #variables_name=模型选择,提示词,上下文,对话,服务商,模型ID,API密钥
 #output_name=生成结果,更新后的上下文
+#resource=io
 
 import time
 import json